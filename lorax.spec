@@ -31,6 +31,7 @@ Requires:       lorax-templates-rhel
 Requires:       cpio
 Requires:       device-mapper
 Requires:       dosfstools
+Recommends:     mtools
 Requires:       e2fsprogs
 Requires:       findutils
 Requires:       gawk
@@ -49,6 +50,7 @@ Requires:       xz-lzma-compat
 Requires:       xz
 Requires:       pigz
 Requires:       pbzip2
+Requires:       zstd
 Requires:       dracut >= 030
 Requires:       kpartx
 Requires:       psmisc
@@ -59,11 +61,11 @@ Requires:       python3-mako
 Requires:       python3-kickstart >= 3.19
 Requires:       python3-libdnf5
 Requires:       python3-librepo
-Requires:       python3-pycdio
 
 %if 0%{?fedora}
 # Fedora specific deps
 %ifarch x86_64
+# mkfs.hfsplus is used when writing the Mac boot image without mounting it fails
 Requires:       hfsplus-tools
 %endif
 %endif
@@ -32,7 +32,6 @@ import os
 import configparser
 import tempfile
 import locale
-from subprocess import CalledProcessError
 import selinux
 from glob import glob
 
@@ -45,9 +44,10 @@ from pylorax.sysutils import joinpaths, remove, linktree
 
 from pylorax.treebuilder import RuntimeBuilder, TreeBuilder
 from pylorax.buildstamp import BuildStamp
+from pylorax.checkpoint import Checkpoints, hash_paths
+from pylorax.checksum import write_checksums
 from pylorax.treeinfo import TreeInfo
 from pylorax.discinfo import DiscInfo
-from pylorax.executils import runcmd, runcmd_output
 
 
 # get lorax version
@@ -239,20 +239,16 @@ class Lorax(BaseLoraxClass):
             verify=True,
             user_dracut_args=None,
             rootfs_type="squashfs",
-            skip_branding=False):
+            skip_branding=False,
+            resume=False,
+            dracut_jobs=1,
+            pkgcache=None):
 
         assert self._configured
 
         installpkgs = installpkgs or []
         excludepkgs = excludepkgs or []
 
-        if domacboot:
-            try:
-                runcmd(["rpm", "-q", "hfsplus-tools"])
-            except CalledProcessError:
-                logger.critical("you need to install hfsplus-tools to create mac images")
-                sys.exit(1)
-
         # set up work directory
         self.workdir = workdir or tempfile.mkdtemp(prefix="pylorax.work.")
         if not os.path.isdir(self.workdir):
@@ -312,6 +308,51 @@ class Lorax(BaseLoraxClass):
             logger.fatal("the volume id cannot be longer than 32 characters")
             sys.exit(1)
 
+        if rootfs_type not in ROOTFSTYPES:
+            raise RuntimeError(f"{rootfs_type} is not a supported type for the root filesystem")
+        if rootfs_type.startswith("squashfs"):
+            compression, compressargs = self.squashfs_args()
+        else:
+            compression, compressargs = self.erofs_args()
+
+        if not user_dracut_args:
+            dracut_args = DRACUT_DEFAULT
+        else:
+            dracut_args = []
+            for arg in user_dracut_args:
+                dracut_args += arg.split(" ", 1)
+
+        anaconda_args = dracut_args + ["--add", "anaconda pollcdrom qemu qemu-net prefixdevname-tools"]
+
+        installroot = joinpaths(self.workdir, "installroot")
+        runtime = "images/install.img"
+
+        # Compiled templates are kept in the workdir and reused when resuming
+        templatecache = joinpaths(self.workdir, "templates.cache")
+
+        # The build stages, in order. Each stage is skipped by resume when its
+        # inputs, and the inputs of every stage before it, are unchanged.
+        tmpl = lambda *names: [n if os.path.isabs(n) else joinpaths(self.templatedir, n) for n in names]
+        checkpoints = Checkpoints(self.workdir, [
+            ("install", dict(product=self.product, buildarch=buildarch,
+                             installpkgs=installpkgs, excludepkgs=excludepkgs,
+                             add_template_vars=add_template_vars, skip_branding=skip_branding,
+                             repos=repo_state(dbo),
+                             templates=hash_paths(tmpl("runtime-install.tmpl", *(add_templates or [])))), True),
+            ("postinstall", hash_paths(tmpl("runtime-postinstall.tmpl", "config_files")), False),
+            ("backup", None, False),
+            ("moduledata", None, False),
+            ("cleanup", dict(debug=self.debug, templates=hash_paths(tmpl("runtime-cleanup.tmpl"))), False),
+            ("verify", verify, True),
+            ("runtime", dict(rootfs_type=rootfs_type, compression=compression,
+                             compressargs=compressargs, size=size), True),
+            ("initrds", anaconda_args, True),
+            ("build", dict(isolabel=isolabel, domacboot=domacboot, doupgrade=doupgrade,
+                           add_arch_templates=add_arch_templates,
+                           add_arch_template_vars=add_arch_template_vars,
+                           templates=hash_paths([self.templatedir] + tmpl(*(add_arch_templates or [])))), True),
+        ], resume=resume)
+
         # NOTE: rb.root = dbo.get_config().installroot (== self.inroot)
         rb = RuntimeBuilder(product=self.product, arch=self.arch,
                             dbo=dbo, templatedir=self.templatedir,
@@ -319,83 +360,104 @@ class Lorax(BaseLoraxClass):
                             excludepkgs=excludepkgs,
                             add_templates=add_templates,
                             add_template_vars=add_template_vars,
-                            skip_branding=skip_branding)
-
-        logger.info("installing runtime packages")
-        rb.install()
-
-        # write .buildstamp
-        buildstamp = BuildStamp(self.product.name, self.product.version,
-                                self.product.bugurl, self.product.isfinal,
-                                self.arch.buildarch, self.product.variant)
-
-        buildstamp.write(joinpaths(self.inroot, ".buildstamp"))
-
-        if self.debug:
-            logger.info("writing debug data to pkglists and original-pkgsizes.txt")
-            rb.writepkglists(joinpaths(logdir, "pkglists"))
-            rb.writepkgsizes(joinpaths(logdir, "original-pkgsizes.txt"))
-
-        logger.info("doing post-install configuration")
-        rb.postinstall()
-
-        # write .discinfo
-        discinfo = DiscInfo(self.product.release, self.arch.basearch)
-        discinfo.write(joinpaths(self.outputdir, ".discinfo"))
-
-        logger.info("backing up installroot")
-        installroot = joinpaths(self.workdir, "installroot")
-        linktree(self.inroot, installroot)
-
-        logger.info("generating kernel module metadata")
-        rb.generate_module_data()
-
-        logger.info("cleaning unneeded files")
-        rb.cleanup()
-
-        if verify:
-            logger.info("verifying the installroot")
-            if not rb.verify():
+                            skip_branding=skip_branding,
+                            pkgcache=pkgcache,
+                            cachedir=templatecache)
+
+        if checkpoints.needed("install"):
+            if checkpoints.previous_run:
+                # Start over with an empty installroot
+                for f in os.listdir(self.inroot):
+                    remove(joinpaths(self.inroot, f))
+
+            logger.info("installing runtime packages")
+            rb.install()
+
+            # write .buildstamp
+            buildstamp = BuildStamp(self.product.name, self.product.version,
+                                    self.product.bugurl, self.product.isfinal,
+                                    self.arch.buildarch, self.product.variant)
+
+            buildstamp.write(joinpaths(self.inroot, ".buildstamp"))
+
+            if self.debug:
+                logger.info("writing debug data to pkglists and original-pkgsizes.txt")
+                rb.writepkglists(joinpaths(logdir, "pkglists"))
+                rb.writepkgsizes(joinpaths(logdir, "original-pkgsizes.txt"))
+            checkpoints.done("install", [self.inroot])
+
+        if checkpoints.needed("postinstall"):
+            logger.info("doing post-install configuration")
+            rb.postinstall()
+
+            # write .discinfo
+            discinfo = DiscInfo(self.product.release, self.arch.basearch)
+            discinfo.write(joinpaths(self.outputdir, ".discinfo"))
+            checkpoints.done("postinstall", [joinpaths(self.outputdir, ".discinfo")])
+
+        if checkpoints.needed("backup"):
+            logger.info("backing up installroot")
+            if os.path.exists(installroot):
+                remove(installroot)
+            linktree(self.inroot, installroot)
+            checkpoints.done("backup", [installroot])
+
+        if checkpoints.needed("moduledata"):
+            logger.info("generating kernel module metadata")
+            rb.generate_module_data(cachefile=joinpaths(self.workdir, "modinfo.cache"))
+            checkpoints.done("moduledata")
+
+        if checkpoints.needed("cleanup"):
+            logger.info("cleaning unneeded files")
+            rb.cleanup()
+
+            if self.debug:
+                rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"))
+            checkpoints.done("cleanup")
+
+        if checkpoints.needed("verify"):
+            if verify:
+                logger.info("verifying the installroot")
+                if not rb.verify():
+                    sys.exit(1)
+            else:
+                logger.info("Skipping verify")
+            checkpoints.done("verify")
+
+        if checkpoints.needed("runtime"):
+            logger.info("creating the runtime image")
+            # Remove the remains of an earlier, failed, attempt
+            for f in (runtime, "images/runtime-workdir"):
+                if os.path.exists(joinpaths(installroot, f)):
+                    remove(joinpaths(installroot, f))
+
+            if rootfs_type == "squashfs":
+                # Create a squashfs compressed rootfs.img
+                rc = rb.create_squashfs_runtime(joinpaths(installroot,runtime),
+                        compression=compression, compressargs=compressargs,
+                        size=size)
+            elif rootfs_type == "squashfs-ext4":
+                # Create an ext4 rootfs.img and compress it with squashfs
+                rc = rb.create_ext4_runtime(joinpaths(installroot,runtime),
+                        compression=compression, compressargs=compressargs,
+                        size=size)
+            elif rootfs_type == "erofs":
+                # Create a erofs compressed rootfs.img
+                rc = rb.create_erofs_runtime(joinpaths(installroot,runtime),
+                        compression=compression, compressargs=compressargs,
+                        size=size)
+            else:
+                # erofs-ext4, rootfs_type has already been checked against ROOTFSTYPES
+                # Create an ext4 rootfs.img and compress it with erofs
+                rc = rb.create_erofs_ext4_runtime(joinpaths(installroot,runtime),
+                        compression=compression, compressargs=compressargs,
+                        size=size)
+            if rc != 0:
+                logger.error("rootfs.img creation failed. See program.log")
                 sys.exit(1)
-        else:
-            logger.info("Skipping verify")
 
-        if self.debug:
-            rb.writepkgsizes(joinpaths(logdir, "final-pkgsizes.txt"))
-
-        logger.info("creating the runtime image")
-        runtime = "images/install.img"
-        if rootfs_type == "squashfs":
-            # Create a squashfs compressed rootfs.img
-            compression, compressargs = self.squashfs_args()
-            rc = rb.create_squashfs_runtime(joinpaths(installroot,runtime),
-                    compression=compression, compressargs=compressargs,
-                    size=size)
-        elif rootfs_type == "squashfs-ext4":
-            # Create an ext4 rootfs.img and compress it with squashfs
-            compression, compressargs = self.squashfs_args()
-            rc = rb.create_ext4_runtime(joinpaths(installroot,runtime),
-                    compression=compression, compressargs=compressargs,
-                    size=size)
-        elif rootfs_type == "erofs":
-            # Create a erofs compressed rootfs.img
-            compression, compressargs = self.erofs_args()
-            rc = rb.create_erofs_runtime(joinpaths(installroot,runtime),
-                    compression=compression, compressargs=compressargs,
-                    size=size)
-        elif rootfs_type == "erofs-ext4":
-            # Create an ext4 rootfs.img and compress it with erofs
-            compression, compressargs = self.erofs_args()
-            rc = rb.create_erofs_ext4_runtime(joinpaths(installroot,runtime),
-                    compression=compression, compressargs=compressargs,
-                    size=size)
-        else:
-            raise RuntimeError(f"{rootfs_type} is not a supported type for the root filesystem")
-        if rc != 0:
-            logger.error("rootfs.img creation failed. See program.log")
-            sys.exit(1)
-
-        rb.finished()
+            rb.finished()
+            checkpoints.done("runtime", [joinpaths(installroot, runtime)])
 
         logger.info("preparing to build output tree and boot images")
         treebuilder = TreeBuilder(product=self.product, arch=self.arch,
@@ -405,37 +467,57 @@ class Lorax(BaseLoraxClass):
                                   templatedir=self.templatedir,
                                   add_templates=add_arch_templates,
                                   add_template_vars=add_arch_template_vars,
-                                  workdir=self.workdir)
-
-        logger.info("rebuilding initramfs images")
-        if not user_dracut_args:
-            dracut_args = DRACUT_DEFAULT
-        else:
-            dracut_args = []
-            for arg in user_dracut_args:
-                dracut_args += arg.split(" ", 1)
-
-        anaconda_args = dracut_args + ["--add", "anaconda pollcdrom qemu qemu-net prefixdevname-tools"]
-
-        logger.info("dracut args = %s", dracut_args)
-        logger.info("anaconda args = %s", anaconda_args)
-        treebuilder.rebuild_initrds(add_args=anaconda_args)
-
-        logger.info("populating output tree and building boot images")
-        treebuilder.build()
-
-        # write .treeinfo file and we're done
-        treeinfo = TreeInfo(self.product.name, self.product.version,
-                            self.product.variant, self.arch.basearch)
-        for section, data in treebuilder.treeinfo_data.items():
-            treeinfo.add_section(section, data)
-        treeinfo.write(joinpaths(self.outputdir, ".treeinfo"))
+                                  workdir=self.workdir,
+                                  cachedir=templatecache)
+
+        if checkpoints.needed("initrds"):
+            logger.info("rebuilding initramfs images")
+            logger.info("dracut args = %s", dracut_args)
+            logger.info("anaconda args = %s", anaconda_args)
+            treebuilder.rebuild_initrds(add_args=anaconda_args, jobs=dracut_jobs)
+            checkpoints.done("initrds")
+
+        if checkpoints.needed("build"):
+            if checkpoints.previous_run:
+                # Remove the partial output tree of an earlier attempt, but only when that
+                # attempt wrote to this output directory
+                leftovers = [f for f in os.listdir(self.outputdir) if f != ".discinfo"]
+                if leftovers and joinpaths(self.outputdir, ".discinfo") not in checkpoints.previous_outputs():
+                    raise RuntimeError("output directory %s was not written by the build being resumed, "
+                                       "not removing its contents. Empty it, or use a new one." % self.outputdir)
+                for f in leftovers:
+                    remove(joinpaths(self.outputdir, f))
+
+            logger.info("populating output tree and building boot images")
+            treebuilder.build()
+
+            # write .treeinfo file and we're done
+            treeinfo = TreeInfo(self.product.name, self.product.version,
+                                self.product.variant, self.arch.basearch)
+            for section, data in treebuilder.treeinfo_data.items():
+                treeinfo.add_section(section, data)
+            treeinfo.write(joinpaths(self.outputdir, ".treeinfo"))
+            manifest = write_checksums(self.outputdir)
+            checkpoints.done("build", [joinpaths(self.outputdir, ".treeinfo"), manifest])
 
         # cleanup
         if remove_temp:
             remove(self.workdir)
 
 
+def repo_state(dbo):
+    """Return the id and metadata revision of the enabled repositories
+
+    :param dbo: dnf base object
+    :type dbo: libdnf5.base.Base
+    :returns: Sorted list of (id, revision, timestamp) tuples
+    :rtype: list
+    """
+    rq = dnf5.repo.RepoQuery(dbo)
+    rq.filter_enabled(True)
+    return sorted((r.get_id(), r.get_revision(), r.get_max_timestamp()) for r in rq)
+
+
 def get_buildarch(dbo):
     # get architecture of the available anaconda package
     buildarch = None
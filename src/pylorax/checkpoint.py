@@ -0,0 +1,205 @@
+#
+# checkpoint.py
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.checkpoint")
+
+import hashlib
+import json
+import os
+
+from pylorax.sysutils import joinpaths
+
+CHECKPOINT_FILE = "checkpoints.json"
+
+
+def hash_paths(paths):
+    """Return a sha256 hex digest of the contents of a list of files and directories
+
+    :param paths: Files or directories to hash
+    :type paths: list of str
+    :returns: sha256 hex digest
+    :rtype: str
+
+    Directories are walked in sorted order and the relative path of each entry
+    is included in the hash. Missing paths are hashed by name so that creating
+    them changes the digest.
+    """
+    h = hashlib.sha256()
+
+    def _hash_file(path):
+        if os.path.islink(path):
+            h.update(os.readlink(path).encode("utf-8", "surrogateescape"))
+            return
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(1024**2)
+                if not data:
+                    break
+                h.update(data)
+
+    for path in paths:
+        h.update(path.encode("utf-8", "surrogateescape") + b"\0")
+        if not os.path.lexists(path):
+            h.update(b"missing\0")
+        elif os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    fullpath = joinpaths(root, f)
+                    h.update(os.path.relpath(fullpath, path).encode("utf-8", "surrogateescape") + b"\0")
+                    _hash_file(fullpath)
+        else:
+            _hash_file(path)
+    return h.hexdigest()
+
+
+def _output_state(path):
+    """Return a description of an output that changes when it is modified or removed
+
+    Files are described by their size and modification time, directories only
+    by their existence.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if os.path.isdir(path):
+        return "dir"
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Checkpoints(object):
+    """Record the completed stages of a build in its work directory
+
+    Each stage has a name, a set of inputs and a flag that says whether the
+    stage can be restarted on its own. The digest of a stage covers its inputs
+    and the digest of the stage before it, so a change to one stage invalidates
+    every stage that follows it.
+
+    Stages that modify the tree in place cannot be repeated on their own output,
+    so when one of them needs to run the build restarts at the closest earlier
+    stage that is marked restartable.
+    """
+    def __init__(self, workdir, stages, resume=False):
+        """
+        :param str workdir: Directory to store the checkpoint file in
+        :param stages: The build stages, in the order they are run
+        :type stages: list of (name, inputs, restartable) tuples
+        :param bool resume: Skip the completed stages recorded by a previous run
+
+        The inputs of a stage can be anything that can be serialized as JSON.
+        """
+        self.path = joinpaths(workdir, CHECKPOINT_FILE)
+        self._order = [name for name, _inputs, _restart in stages]
+        self._digests = {}
+
+        previous = ""
+        for name, inputs, _restart in stages:
+            data = json.dumps([previous, name, inputs], sort_keys=True, default=str)
+            previous = hashlib.sha256(data.encode("utf-8")).hexdigest()
+            self._digests[name] = previous
+
+        # True when there are leftovers from an earlier run that need to be cleaned up
+        self.previous_run = resume and os.path.exists(self.path)
+        self._completed = self._load() if resume else {}
+        # What the previous run recorded, before the stages that are rerun are forgotten
+        self._previous = dict(self._completed)
+
+        # Find the first stage that needs to run
+        self.first = len(stages)
+        for idx, name in enumerate(self._order):
+            if not self._is_complete(name):
+                self.first = idx
+                break
+
+        # Back up to a stage that can be restarted
+        while self.first < len(stages) and self.first > 0 and not stages[self.first][2]:
+            self.first -= 1
+
+        if resume and self.first > 0:
+            logger.info("resuming build at stage %s",
+                        self._order[self.first] if self.first < len(stages) else "(finished)")
+
+        # Forget everything from the restart point on, it is going to be rebuilt
+        for name in self._order[self.first:]:
+            self._completed.pop(name, None)
+        self._save()
+
+    def _load(self):
+        """Read the checkpoints of a previous run"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning("ignoring corrupt checkpoint file %s: %s", self.path, e)
+            return {}
+
+    def _save(self):
+        """Atomically write the checkpoints to the work directory"""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._completed, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def _is_complete(self, name):
+        """Return True if the stage was completed with the same inputs and its outputs are unchanged"""
+        record = self._completed.get(name)
+        if not record or record.get("digest") != self._digests[name]:
+            return False
+        for path, state in record.get("outputs", {}).items():
+            if _output_state(path) != state:
+                logger.debug("output %s of stage %s has changed", path, name)
+                return False
+        return True
+
+    def previous_outputs(self):
+        """Return the outputs recorded by the previous run
+
+        :returns: The files and directories created by the stages of the previous run
+        :rtype: set of str
+
+        This is used to make sure the leftovers that are cleaned up are really from that run.
+        """
+        return set(p for record in self._previous.values() for p in record.get("outputs", {}))
+
+    def needed(self, name):
+        """Return True if the stage needs to be run
+
+        :param str name: Name of the stage
+        :rtype: bool
+        """
+        if self._order.index(name) >= self.first:
+            return True
+        logger.info("skipping stage %s, it has already been completed", name)
+        return False
+
+    def done(self, name, outputs=None):
+        """Record a stage as completed
+
+        :param str name: Name of the stage
+        :param outputs: Files or directories created by the stage
+        :type outputs: list of str
+        """
+        self._completed[name] = {"digest": self._digests[name],
+                                 "outputs": {p: _output_state(p) for p in outputs or []}}
+        self._save()
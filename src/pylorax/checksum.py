@@ -0,0 +1,223 @@
+#
+# checksum.py - checksums of build artifacts
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.checksum")
+
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+
+from pylorax.sysutils import joinpaths
+
+CHECKSUM_FILE = "CHECKSUM"
+
+# Holes are hashed from this buffer instead of being read from the disk
+_ZEROS = memoryview(bytes(4 * 1024**2))
+
+# Checksums calculated while the files were written, {path: (size, mtime_ns, hexdigest)}
+_recorded = {}
+_recorded_lock = threading.Lock()
+
+
+def record_checksum(path, hexdigest):
+    """Remember the sha256 of a file that was hashed while it was written
+
+    :param str path: The file that was written
+    :param str hexdigest: sha256 hex digest of its contents
+
+    file_checksum returns it instead of reading the file again, as long as the
+    size and modification time of the file have not changed.
+    """
+    st = os.stat(path)
+    with _recorded_lock:
+        _recorded[os.path.realpath(path)] = (st.st_size, st.st_mtime_ns, hexdigest)
+
+
+def tee_copy(src, dst, h, bufsize=1024**2):
+    """Copy a file object to another one, updating a hash with the data
+
+    :param src: File object to read from until EOF
+    :param dst: File object to write to
+    :param h: hashlib object to update
+    :param int bufsize: Size of the reads
+    :returns: Number of bytes copied
+    :rtype: int
+    """
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        h.update(view[:n])
+        dst.write(view[:n])
+        total += n
+    return total
+
+
+class HashingWriter(object):
+    """File object wrapper that hashes and counts the data written through it"""
+    def __init__(self, fobj):
+        """
+        :param fobj: File object to write the data to
+        """
+        self.fobj = fobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fobj.write(data)
+
+    def flush(self):
+        self.fobj.flush()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    @property
+    def digest(self):
+        """The digest in the algorithm:hex form used by OCI"""
+        return "sha256:" + self.sha256.hexdigest()
+
+
+def _hash_zeros(h, count):
+    while count > 0:
+        n = min(count, len(_ZEROS))
+        h.update(_ZEROS[:n])
+        count -= n
+
+def _hash_data(h, fd, offset, count):
+    """Hash part of a file using mmap, so the data isn't copied into python"""
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with mmap.mmap(fd, offset + count - start, access=mmap.ACCESS_READ, offset=start) as mm:
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            h.update(view[offset - start:])
+
+def sparse_sha256(path):
+    """Return the sha256 hex digest of a file, skipping over the holes in sparse files
+
+    :param str path: The file to hash
+    :rtype: str
+
+    The data regions are found with SEEK_DATA and SEEK_HOLE and hashed directly
+    from an mmap of the file. The holes still need to be hashed as zeros, but they
+    are never read from the disk, which makes a big difference for disk images.
+    """
+    h = hashlib.sha256()
+    fd = os.open(path, os.O_RDONLY|os.O_CLOEXEC)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+                hole = os.lseek(fd, data, os.SEEK_HOLE)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # The rest of the file is a hole
+                    data = hole = size
+                else:
+                    # SEEK_DATA isn't supported, hash everything
+                    data, hole = offset, size
+            _hash_zeros(h, data - offset)
+            if hole > data:
+                _hash_data(h, fd, data, hole - data)
+            offset = hole
+    finally:
+        os.close(fd)
+    return h.hexdigest()
+
+
+def file_checksum(path):
+    """Return the sha256 hex digest of a file
+
+    :param str path: The file to hash
+    :rtype: str
+
+    If the checksum was recorded while the file was written it is returned without
+    reading the file, otherwise it is calculated with sparse_sha256.
+    """
+    st = os.stat(path)
+    with _recorded_lock:
+        recorded = _recorded.get(os.path.realpath(path))
+    if recorded and recorded[:2] == (st.st_size, st.st_mtime_ns):
+        return recorded[2]
+    return sparse_sha256(path)
+
+
+def checksum_files(paths, workers=None):
+    """Calculate the sha256 of several files in parallel
+
+    :param paths: Files to hash
+    :type paths: list of str
+    :param int workers: Number of files to hash at the same time, defaults to the number of cpus
+    :returns: {path: hexdigest}
+    :rtype: dict
+
+    hashlib releases the GIL while hashing so the files are hashed by threads.
+    """
+    if not paths:
+        return {}
+    workers = min(workers or multiprocessing.cpu_count(), len(paths))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(file_checksum, paths)))
+
+
+def write_checksums(directory, paths=None, name=CHECKSUM_FILE):
+    """Write a CHECKSUM manifest of the files in a directory
+
+    :param str directory: Directory to write the manifest to
+    :param paths: Files to include, defaults to all of the files under directory
+    :type paths: list of str
+    :param str name: Name of the manifest file
+    :returns: Path of the manifest
+    :rtype: str
+
+    The manifest uses the same format as the Fedora CHECKSUM files so it can be
+    checked with ``sha256sum -c``. Paths are relative to the directory.
+    """
+    start = time.time()
+    manifest = joinpaths(directory, name)
+    if paths is None:
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for f in sorted(files):
+                path = joinpaths(root, f)
+                if path != manifest and os.path.isfile(path) and not os.path.islink(path):
+                    paths.append(path)
+    checksums = checksum_files(paths)
+
+    with open(manifest, "w") as f:
+        f.write("# The image checksum(s) are generated with sha256sum.\n")
+        for path in sorted(checksums, key=lambda p: os.path.relpath(p, directory)):
+            relpath = os.path.relpath(path, directory)
+            f.write("# %s: %d bytes\n" % (relpath, os.path.getsize(path)))
+            f.write("SHA256 (%s) = %s\n" % (relpath, checksums[path]))
+    logger.info("wrote checksums of %d files to %s in %.1fs", len(checksums), manifest, time.time() - start)
+    return manifest
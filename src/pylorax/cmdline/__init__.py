@@ -79,10 +79,19 @@ def lorax_parser(dracut_default=""):
                         help="Top level temporary directory" )
     optional.add_argument("--cachedir", default=None, type=os.path.abspath,
                         help="DNF cache directory. Default is a temporary dir.")
+    optional.add_argument("--pkgcache", default=None, type=os.path.abspath, metavar="PKGCACHE",
+                        help="Package store shared by builds, packages found in it are not downloaded again.")
+    optional.add_argument("--pkgcache-size", default=20, type=int, metavar="GiB",
+                        help="Size of the --pkgcache store in GiB, the least recently used packages are "
+                             "removed when it is larger. Defaults to 20.")
     optional.add_argument("--workdir", default=None, type=os.path.abspath,
                         help="Work directory, overrides --tmp. Default is a temporary dir under /var/tmp/lorax")
     optional.add_argument("--force", default=False, action="store_true",
                         help="Run even when the destination directory exists")
+    optional.add_argument("--resume", default=False, action="store_true",
+                        help="Resume a failed build in --workdir, skipping the stages that have "
+                             "already been completed with the same inputs. The workdir is kept "
+                             "after the build finishes.")
     optional.add_argument("--add-template", dest="add_templates",
                         action="append", help="Additional template for runtime image",
                         default=[])
@@ -104,7 +113,8 @@ def lorax_parser(dracut_default=""):
     optional.add_argument("--disablerepo", action="append", default=[], dest="disablerepos",
                           metavar="[repo]", help="Names of repos to disable")
     optional.add_argument("--rootfs-size", type=int, default=2,
-                          help="Size of root filesystem in GiB. Defaults to 2.")
+                          help="Size of root filesystem in GiB. Defaults to 2. "
+                               "Use 0 to size it to fit the installroot.")
     optional.add_argument("--noverifyssl", action="store_true", default=False,
                           help="Do not verify SSL certificates")
     optional.add_argument("--dnfplugin", action="append", default=[], dest="dnfplugins",
@@ -127,6 +137,9 @@ def lorax_parser(dracut_default=""):
                                    "rebuilding the initramfs. Pass this "
                                    "once for each argument. NOTE: this "
                                    "overrides the defaults.")
+    dracut_group.add_argument("--dracut-jobs", type=int, default=1, metavar="JOBS",
+                              help="Number of initramfs images to build at the same time, "
+                                   "0 uses one job per cpu. Defaults to 1.")
 
     # add the show version option
     parser.add_argument("-V", help="show program's version number and exit",
@@ -166,6 +179,10 @@ def lmc_parser(dracut_default=""):
                         help="Build an Open Container Initiative image")
     action.add_argument("--make-vagrant", action="store_true",
                         help="Build a Vagrant Box image")
+    action.add_argument("--make-multi", metavar="OUTPUT[,OUTPUT...]",
+                        type=lambda s: [o.strip() for o in s.split(",") if o.strip()],
+                        help="Build several outputs from one installation, in parallel. "
+                             "Comma separated list of iso, pxe-live, tar, oci, qcow2, vagrant")
 
     parser.add_argument("--iso", type=os.path.abspath,
                         help="Anaconda installation .iso path to use for qemu")
@@ -250,9 +267,15 @@ def lmc_parser(dracut_default=""):
     image_group.add_argument("--qcow2-arg", action="append", dest="qemu_args", default=[],
                              help="Arguments to pass to qemu-img. Pass once for each argument, they will be used for ALL calls to qemu-img.")
     image_group.add_argument("--compression", default="xz",
-                             help="Compression binary for make-tar. xz, lzma, gzip, and bzip2 are supported. xz is the default.")
+                             help="Compression binary for make-tar. xz, lzma, gzip, bzip2, and zstd are supported. xz is the default.")
     image_group.add_argument("--compress-arg", action="append", dest="compress_args", default=[],
                              help="Arguments to pass to compression. Pass once for each argument")
+    image_group.add_argument("--image-cache", default=None, type=os.path.abspath, metavar="CACHEDIR",
+                             help="Directory of installed images. When the kickstart, repositories, and "
+                                  "installer are unchanged the cached image is used instead of installing.")
+    image_group.add_argument("--image-cache-size", default=50, type=int, metavar="GiB",
+                             help="Size of the --image-cache in GiB, the least recently used images are "
+                                  "removed when it is larger. Defaults to 50.")
     # Group of arguments for appliance creation
     app_group = parser.add_argument_group("appliance arguments")
     app_group.add_argument("--app-name", default=None,
@@ -298,6 +321,9 @@ def lmc_parser(dracut_default=""):
                                    "rebuilding the initramfs. Pass this "
                                    "once for each argument. NOTE: this "
                                    "overrides the defaults.")
+    dracut_group.add_argument("--dracut-jobs", type=int, default=1, metavar="JOBS",
+                              help="Number of initramfs images to build at the same time, "
+                                   "0 uses one job per cpu. Defaults to 1.")
 
     # pxe to live arguments
     pxelive_group = parser.add_argument_group("pxe to live arguments")
@@ -312,6 +338,9 @@ def lmc_parser(dracut_default=""):
                               help="config.json OCI configuration file")
     oci_group.add_argument("--oci-runtime",
                               help="runtime.json OCI configuration file")
+    oci_group.add_argument("--oci-layout", action="store_true",
+                              help="Build an OCI image layout archive that can be loaded by podman or "
+                                   "skopeo instead of a runtime bundle. --oci-config is optional.")
 
     # Vagrant specific commands
     vagrant_group = parser.add_argument_group("Vagrant arguments")
@@ -333,6 +362,12 @@ def lmc_parser(dracut_default=""):
                         help="Type of rootfs: %s" % ",".join(ROOTFSTYPES))
     parser.add_argument("--timeout", default=None, type=int,
                         help="Cancel installer after X minutes")
+    parser.add_argument("--multi-jobs", default=0, type=int,
+                        help="Number of --make-multi outputs to build at the same time. "
+                             "Default is all of them")
+    parser.add_argument("--error-rules", type=os.path.abspath,
+                        help="File with extra log messages that indicate the installation failed. "
+                             "One per line, lines starting with re: are regular expressions.")
 
     # add the show version option
     parser.add_argument("-V", help="show program's version number and exit",
@@ -29,8 +29,9 @@ import tempfile
 # Use the Lorax treebuilder branch for iso creation
 from pylorax import setup_logging, find_templates, vernum, log_selinux_state
 from pylorax.cmdline import lmc_parser
-from pylorax.creator import run_creator, DRACUT_DEFAULT
-from pylorax.imgutils import default_image_name
+from pylorax.creator import run_creator, DRACUT_DEFAULT, MULTI_OUTPUTS
+from pylorax.checksum import write_checksums
+from pylorax.imgutils import default_image_name, default_compress_args
 from pylorax.sysutils import joinpaths
 
 
@@ -59,7 +60,24 @@ def main():
     if opts.ks and not os.path.exists(opts.ks[0]):
         errors.append("kickstart file (%s) is missing." % opts.ks[0])
 
-    if opts.make_iso and not os.path.exists(opts.lorax_templates):
+    if opts.make_multi:
+        unknown = [o for o in opts.make_multi if o not in MULTI_OUTPUTS]
+        if unknown:
+            errors.append("Unknown --make-multi output(s): %s. Use one or more of %s" % (
+                          ", ".join(unknown), ", ".join(MULTI_OUTPUTS)))
+        # Drop duplicates, keeping the order
+        opts.make_multi = list(dict.fromkeys(opts.make_multi))
+        if opts.fs_image:
+            errors.append("--make-multi needs a partitioned disk image, not --fs-image")
+        if opts.image_type or opts.qcow2:
+            errors.append("--make-multi cannot be used with --image-type, use the qcow2 output")
+        if any(o in opts.make_multi for o in ("qcow2", "vagrant")) \
+           and not os.path.exists("/usr/bin/qemu-img"):
+            errors.append("The qcow2 and vagrant outputs require the qemu-img utility to be installed.")
+        if opts.multi_jobs < 0:
+            errors.append("--multi-jobs must be 0 or more")
+
+    if (opts.make_iso or "iso" in (opts.make_multi or [])) and not os.path.exists(opts.lorax_templates):
         errors.append("The lorax templates directory (%s) doesn't "
                       "exist." % opts.lorax_templates)
 
@@ -130,29 +148,33 @@ def main():
     if opts.image_type and opts.make_tar:
         errors.append("image-type cannot be used to make a tar.")
 
-    if opts.make_oci and not (opts.oci_config and opts.oci_runtime):
+    make_oci = opts.make_oci or "oci" in (opts.make_multi or [])
+    if make_oci and not opts.oci_layout and not (opts.oci_config and opts.oci_runtime):
         errors.append("--make-oci requires --oci-config and --oci-runtime")
 
-    if opts.make_oci and not os.path.exists(opts.oci_config):
-        errors.append("oci % file is missing" % opts.oci_config)
+    if make_oci and opts.oci_config and not os.path.exists(opts.oci_config):
+        errors.append("oci %s file is missing" % opts.oci_config)
 
-    if opts.make_oci and not os.path.exists(opts.oci_runtime):
-        errors.append("oci % file is missing" % opts.oci_runtime)
+    if make_oci and opts.oci_runtime and not os.path.exists(opts.oci_runtime):
+        errors.append("oci %s file is missing" % opts.oci_runtime)
 
-    if opts.make_vagrant and opts.vagrant_metadata and not os.path.exists(opts.vagrant_metadata):
+    if opts.error_rules and not os.path.exists(opts.error_rules):
+        errors.append("The error rules file %s is missing" % opts.error_rules)
+
+    if (opts.make_vagrant or "vagrant" in (opts.make_multi or [])) \
+       and opts.vagrant_metadata and not os.path.exists(opts.vagrant_metadata):
         errors.append("Vagrant metadata file %s is missing" % opts.vagrant_metadata)
 
     if opts.virt_uefi and not os.path.isdir(opts.fw_path):
         errors.append("The UEFI firmware directory is missing: %s" % opts.fw_path)
 
-    if opts.domacboot and not shutil.which("mkfs.hfsplus"):
-        errors.append("mkfs.hfsplus is missing. Install hfsplus-tools, or pass --nomacboot")
-
     if os.getuid() != 0:
         errors.append("You need to run this as root")
 
     if opts.dracut_args and opts.dracut_conf:
         errors.append("argument --dracut-arg: not allowed with argument --dracut-conf")
+    if opts.dracut_jobs < 0:
+        errors.append("--dracut-jobs must be 0 or more")
 
     if errors:
         list(log.error(e) for e in errors)
@@ -175,26 +197,39 @@ def main():
     elif opts.make_tar:
         if not opts.image_name:
             opts.image_name = default_image_name(opts.compression, "root.tar")
-        if opts.compression == "xz" and not opts.compress_args:
-            opts.compress_args = ["-9"]
+        if not opts.compress_args:
+            opts.compress_args = default_compress_args(opts.compression)
+    elif opts.make_oci and opts.oci_layout:
+        # OCI layers can only be gzip or zstd compressed
+        if opts.compression not in ("gzip", "zstd"):
+            log.info("OCI image layers cannot use %s compression, using zstd", opts.compression)
+            opts.compression = "zstd"
+            opts.compress_args = []
+        if not opts.image_name:
+            opts.image_name = "oci-archive.tar"
     elif opts.make_oci:
         if not opts.image_name:
             opts.image_name = default_image_name(opts.compression, "bundle.tar")
-        if opts.compression == "xz" and not opts.compress_args:
-            opts.compress_args = ["-9"]
+        if not opts.compress_args:
+            opts.compress_args = default_compress_args(opts.compression)
     elif opts.make_vagrant:
         if not opts.image_name:
             opts.image_name = default_image_name(opts.compression, "vagrant.tar")
-        if opts.compression == "xz" and not opts.compress_args:
-            opts.compress_args = ["-9"]
+        if not opts.compress_args:
+            opts.compress_args = default_compress_args(opts.compression)
+    elif opts.make_multi:
+        # Install to a partitioned disk image, the outputs are made from it
+        opts.make_disk = True
+        if not opts.compress_args:
+            opts.compress_args = default_compress_args(opts.compression)
     elif opts.make_tar_disk:
         opts.make_disk = True
         if not opts.image_name:
             opts.image_name = "root.img"
         if not opts.tar_disk_name:
             opts.tar_disk_name = default_image_name(opts.compression, "root.tar")
-        if opts.compression == "xz" and not opts.compress_args:
-            opts.compress_args = ["-9"]
+        if not opts.compress_args:
+            opts.compress_args = default_compress_args(opts.compression)
 
     if opts.app_file:
         opts.app_file = joinpaths(opts.result_dir, opts.app_file)
@@ -215,6 +250,16 @@ def main():
         log.error(str(e))
         sys.exit(1)
 
+    # Write a CHECKSUM manifest of the results, or just the disk image when it is in --tmp
+    try:
+        if (result_dir or opts.result_dir) != opts.tmp:
+            write_checksums(result_dir or opts.result_dir)
+        elif disk_img:
+            write_checksums(os.path.dirname(disk_img), [disk_img],
+                            name="%s-CHECKSUM" % os.path.basename(disk_img))
+    except OSError as e:
+        log.error("Problem writing the checksums: %s", e)
+
     log.info("SUMMARY")
     log.info("-------")
     log.info("Logs are in %s", os.path.abspath(os.path.dirname(opts.logfile)))
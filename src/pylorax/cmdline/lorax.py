@@ -40,6 +40,7 @@ import pylorax
 from pylorax import DRACUT_DEFAULT, ROOTFSTYPES, log_selinux_state
 from pylorax.cmdline import lorax_parser
 from pylorax.dnfbase import get_dnf_base_object
+from pylorax.pkgcache import PackageCache
 
 def exit_handler(tempdir):
     """Handle cleanup of tmpdir, if it still exists
@@ -90,7 +91,10 @@ def main():
     if not opts.source and not opts.repos:
         parser.error("--source, --repo, or both are required.")
 
-    if not opts.force and os.path.exists(opts.outputdir):
+    if opts.resume and not opts.workdir:
+        parser.error("--resume requires --workdir")
+
+    if not opts.force and not opts.resume and os.path.exists(opts.outputdir):
         parser.error("output directory %s should not exist." % opts.outputdir)
 
     if not os.path.exists(os.path.dirname(opts.logfile)):
@@ -103,6 +107,8 @@ def main():
         parser.error("argument --dracut-arg: not allowed with argument --dracut-conf")
     if opts.dracut_conf and not os.path.exists(opts.dracut_conf):
         parser.error("dracut config file %s doesn't exist." % opts.dracut_conf)
+    if opts.dracut_jobs < 0:
+        parser.error("--dracut-jobs must be 0 or more")
 
     if opts.rootfs_type not in ROOTFSTYPES:
         parser.error("--rootfs-type must be one of %s" % ",".join(ROOTFSTYPES))
@@ -171,6 +177,11 @@ def main():
             raise ValueError("Missing '=' for key=value in %s" % kv)
         parsed_add_arch_template_vars[k] = v
 
+    if opts.pkgcache:
+        pkgcache = PackageCache(opts.pkgcache, opts.pkgcache_size * 1024**3)
+    else:
+        pkgcache = None
+
     if 'SOURCE_DATE_EPOCH' in os.environ:
         log.info("Using SOURCE_DATE_EPOCH=%s as the current time.", os.environ["SOURCE_DATE_EPOCH"])
 
@@ -202,10 +213,13 @@ def main():
               add_template_vars=parsed_add_template_vars,
               add_arch_templates=opts.add_arch_templates,
               add_arch_template_vars=parsed_add_arch_template_vars,
-              remove_temp=True, verify=opts.verify,
+              remove_temp=not opts.resume, verify=opts.verify,
               user_dracut_args=user_dracut_args,
               rootfs_type=opts.rootfs_type,
-              skip_branding=opts.skip_branding)
+              skip_branding=opts.skip_branding,
+              resume=opts.resume,
+              dracut_jobs=opts.dracut_jobs,
+              pkgcache=pkgcache)
 
     # Release the lock on the tempdir
     os.close(dir_fd)
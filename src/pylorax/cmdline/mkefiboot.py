@@ -25,8 +25,8 @@ log = logging.getLogger()
 import os, tempfile, argparse
 from subprocess import check_call, PIPE
 from pylorax.imgutils import mkdosimg, round_to_blocks, LoopDev, DMDev, dm_detach
-from pylorax.imgutils import mkhfsimg, Mount, estimate_size
-import struct, shutil, glob
+from pylorax.hfsimage import new_hfsplus_image
+import shutil
 
 def mkefiboot(bootdir, outfile, label):
     '''Make an EFI boot image with the contents of bootdir in EFI/BOOT'''
@@ -35,15 +35,14 @@ def mkefiboot(bootdir, outfile, label):
 def mkmacboot(bootdir, outfile, label, icon=None, product='Generic',
               diskname=None):
     '''Make an EFI boot image for Apple's EFI implementation'''
-    graft = {'EFI/BOOT':bootdir}
+    img = new_hfsplus_image(label)
+    img.add('EFI/BOOT', bootdir)
     if icon and os.path.exists(icon):
-        graft['.VolumeIcon.icns'] = icon
+        img.add('.VolumeIcon.icns', icon)
     if diskname and os.path.exists(diskname):
-        graft['EFI/BOOT/.disk_label'] = diskname
-    # shim and grub2 are in 2 places so double the estimate
-    size = estimate_size(None, graft=graft) * 2
-    mkhfsimg(None, outfile, label=label, graft=graft, size=size)
-    macmunge(outfile, product)
+        img.add('EFI/BOOT/.disk_label', diskname)
+    macmunge(img, product)
+    img.write(outfile)
 
 # To make an HFS+ image bootable, we need to fill in parts of the
 # HFSPlusVolumeHeader structure - specifically, finderInfo[0,1,5].
@@ -52,23 +51,20 @@ def mkmacboot(bootdir, outfile, label, icon=None, product='Generic',
 #
 # Additionally, we want to do some fixups to make it play nicely with
 # the startup disk preferences panel.
-def macmunge(imgfile, product):
-    '''"bless" the EFI bootloader inside the given Mac EFI boot image, by
-    writing its inode info into the HFS+ volume header.'''
-    # Get the inode number for the boot image and its parent directory
-    with LoopDev(imgfile) as loopdev:
-        with Mount(loopdev) as mnt:
-            shim = glob.glob(os.path.join(mnt, 'EFI/BOOT/BOOT*.EFI'))[0]
-            loader = glob.glob(os.path.join(mnt,'EFI/BOOT/grub*.efi'))[0]
-            config = glob.glob(os.path.join(mnt,'EFI/*/grub*.cfg'))[0]
-            blessnode = os.stat(loader).st_ino
-            dirnode = os.stat(os.path.dirname(loader)).st_ino
-            with open(os.path.join(mnt,'mach_kernel'), 'w') as kernel:
-                kernel.write('Dummy kernel for booting')
-            sysdir = os.path.join(mnt,'System/Library/CoreServices/')
-            os.makedirs(sysdir)
-            with open(os.path.join(sysdir,'SystemVersion.plist'), 'w') as plist:
-                plist.write('''<?xml version="1.0" encoding="UTF-8"?>
+def macmunge(img, product):
+    '''"bless" the EFI bootloader inside the given Mac EFI boot image.
+
+    img is an HFSPlusImage that has not been written yet. The catalog node
+    IDs of the bootloader and its directory are written into the HFS+ volume
+    header when the image is written.'''
+    shim = img.glob('EFI/BOOT/BOOT*.EFI')
+    loader = img.glob('EFI/BOOT/grub*.efi')
+    config = img.glob('EFI/*/grub*.cfg')
+    if not shim or not loader or not config:
+        raise RuntimeError("EFI/BOOT is missing the shim, grub, or grub.cfg")
+    img.add_data('mach_kernel', b'Dummy kernel for booting')
+    sysdir = 'System/Library/CoreServices/'
+    img.add_data(sysdir + 'SystemVersion.plist', ('''<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
 <plist version="1.0">
 <dict>
@@ -80,24 +76,14 @@ def macmunge(imgfile, product):
 <string>%s</string>
 </dict>
 </plist>
-''' % (product,))
-            # NOTE: OSX won't boot if we hardlink to /EFI/BOOT and grub2
-            # can't read the config file if we hardlink the other direction
-            # So copy the files.
-            shutil.copy(shim, os.path.join(sysdir,'boot.efi'))
-            shutil.copy(loader, sysdir)
-            shutil.copy(config, sysdir)
-
-    # format data properly (big-endian UInt32)
-    nodedata = struct.pack(">i", blessnode)
-    dirdata = struct.pack(">i", dirnode)
-    # Write it to the volume header
-    with open(imgfile, "r+b") as img:
-        img.seek(0x450)      # HFSPlusVolumeHeader->finderInfo
-        img.write(dirdata)   # finderInfo[0]
-        img.write(nodedata)  # finderInfo[1]
-        img.seek(0x464)      #
-        img.write(dirdata)   # finderInfo[5]
+''' % (product,)).encode("utf-8"))
+    # NOTE: OSX won't boot if we hardlink to /EFI/BOOT and grub2
+    # can't read the config file if we hardlink the other direction
+    # So copy the files.
+    img.copy(shim[0], sysdir + 'boot.efi')
+    img.copy(loader[0], sysdir)
+    img.copy(config[0], sysdir)
+    img.bless(os.path.dirname(loader[0]), loader[0])
 
 def mkefidisk(efiboot, outfile):
     '''Make a bootable EFI disk image out of the given EFI boot image.'''
@@ -146,7 +132,8 @@ def main():
     # sanity checks
     if not os.path.isdir(opt.bootdir):
         parser.error("%s is not a directory" % opt.bootdir)
-    if os.getuid() > 0:
+    # The EFI images are written without mounting them, only --disk needs root
+    if os.getuid() > 0 and opt.disk:
         parser.error("need root permissions")
     if opt.icon and not opt.imgtype == "apple":
         print("Warning: --icon is only useful for Apple EFI images")
@@ -17,6 +17,9 @@
 #
 import argparse
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import logging as log
 import os
 import shutil
@@ -24,11 +27,37 @@ import shlex
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+
+# mkksiso can run without the rest of lorax, when it is installed the isos
+# are read, their md5 implanted, and the efiboot.img written, in-process
+# instead of by running xorriso, osirrox, implantisomd5, and mkefiboot
+try:
+    from pylorax.isoreader import ISOReader
+    from pylorax.isomd5sum import implant_isomd5
+    from pylorax.fatimage import mkfatimg
+except ImportError:
+    ISOReader = None
+    implant_isomd5 = None
+    mkfatimg = None
 
 
 # Maximum filename length
 MAX_FNAME = 253
 
+# Config files that are extracted from the iso and edited
+KNOWN_CONFIGS = set([".discinfo", "isolinux/isolinux.cfg",
+                     "boot/grub2/grub.cfg", "boot/grub/grub.cfg",
+                     "EFI/BOOT/BOOT.conf", "EFI/BOOT/grub.cfg",
+                     "images/generic.prm", "images/cdboot.prm",
+                     "images/kernel.img", "images/initrd.img"])
+
+# Keys of the --batch entries and the MakeKickstartISO argument they set
+BATCH_KEYS = {"output": "output_iso", "ks": "ks", "updates": "updates_image",
+              "add": "add_paths", "cmdline": "cmdline", "rm_args": "rm_args",
+              "volid": "new_volid", "replace": "replace_list"}
+
 
 def SplitCmdline(cmdline):
     """
@@ -144,12 +173,18 @@ def WrapKernelArgs(kernel_args, width=80):
 
 def GetISODetails(isopath):
     """
-    Use xorriso to list the contents of the iso and get the volume id
+    Use ISOReader, or xorriso, to list the contents of the iso and get the volume id
 
     Metadata about the iso is output to stderr, file listing is sent to stdout.
 
     Returns a tuple of volume id, and the list of files on the iso
     """
+    if ISOReader:
+        with ISOReader(isopath) as iso:
+            if not iso.volume_id:
+                raise RuntimeError(f"{isopath} is missing a volume id")
+            return iso.volume_id, iso.find()
+
     cmd = ["xorriso", "-indev", isopath, "-pkt_output", "on", "-find"]
     out =  subprocess.run(cmd, check=True, capture_output=True, env={"LANG": "C"})
 
@@ -175,6 +210,15 @@ def ExtractISOFiles(isopath, files, tmpdir):
     Extract the given files (which must exist on the iso) into the temporary
     directory.
     """
+    if ISOReader:
+        with ISOReader(isopath) as iso:
+            for f in files:
+                try:
+                    iso.extract(f, tmpdir + "/" + f)
+                except OSError as e:
+                    raise RuntimeError(f"Problem extracting {f} from {isopath}: {e}")
+        return
+
     # Make sure the user can write to any extracted directories using -chmod_r
     cmd = ["osirrox", "-indev", isopath, "-chmod_r", "u+rwx", "/", "--"]
     for f in files:
@@ -227,6 +271,10 @@ def ImplantMD5(output_iso):
     """
     Add md5 checksums to the final iso
     """
+    if implant_isomd5:
+        implant_isomd5(output_iso)
+        return
+
     cmd = ["implantisomd5", output_iso]
     log.debug(" ".join(cmd))
     try:
@@ -236,10 +284,13 @@ def ImplantMD5(output_iso):
         raise RuntimeError("implantisomd5 failed")
 
 
-def RebuildEFIBoot(input_iso, tmpdir):
+def RebuildEFIBoot(input_iso, tmpdir, efidir=None):
     """
     On x86 the efiboot.img needs to be rebuilt from the new /EFI/BOOT/ files
 
+    If efidir is passed it is a copy of the iso's EFI directory that was already
+    extracted, and it is used instead of extracting it again.
+
     returns new efiboot.img file with a temporary name.
     """
     if not os.path.exists(tmpdir+"/EFI/BOOT"):
@@ -247,12 +298,24 @@ def RebuildEFIBoot(input_iso, tmpdir):
 
     # Extract the EFI directory files from the iso
     with tempfile.TemporaryDirectory(prefix="mkksiso-") as tmpefi:
-        ExtractISOFiles(input_iso, ["EFI"], tmpefi)
+        if efidir:
+            shutil.copytree(efidir, tmpefi+"/EFI")
+        else:
+            ExtractISOFiles(input_iso, ["EFI"], tmpefi)
 
         # Copy the modified config files over
         shutil.copytree(tmpdir+"/EFI", tmpefi+"/EFI", dirs_exist_ok=True)
 
         efibootimg = tempfile.NamedTemporaryFile(prefix="efibootimg-")
+        if mkfatimg:
+            try:
+                mkfatimg(efibootimg.name, graft={"EFI/BOOT": tmpefi + "/EFI/BOOT"}, label="ANACONDA")
+            except OSError as e:
+                raise RuntimeError("Writing efiboot.img: %s" % e)
+            return efibootimg
+
+        if os.getuid() != 0:
+            raise RuntimeError("mkefiboot requires root privileges")
         cmd = ["mkefiboot", "--label=ANACONDA"]
         if log.root.level < log.INFO:
             cmd.append("--debug")
@@ -431,36 +494,118 @@ def CheckDiscinfo(path):
             raise RuntimeError("iso arch does not match the host arch.")
 
 
+class SourceISO():
+    """
+    The details and config files of an input iso
+
+    The iso is listed, and the known config files are extracted, once. They are
+    then shared by all of the isos made from it. The EFI directory is only
+    extracted when an efiboot.img needs to be rebuilt, and the rebuilt images
+    are kept so that isos with identical EFI config files use the same one.
+    """
+    def __init__(self, input_iso):
+        self.input_iso = input_iso
+
+        # Gather information about the input iso
+        self.volid, self.files = GetISODetails(input_iso)
+
+        log.debug("ISO files:")
+        for f in self.files:
+            log.debug("    %s", f)
+
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="mkksiso-src-")
+        self._lock = threading.Lock()
+        self._efidir = None
+        self._efiboot = {}
+        self._efiboot_locks = {}
+
+        # Extract files that match the known config files.
+        self.configdir = self._tmpdir.name + "/configs"
+        os.makedirs(self.configdir)
+        ExtractISOFiles(input_iso, set(self.files) & KNOWN_CONFIGS, self.configdir)
+        CheckDiscinfo(self.configdir + "/.discinfo")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        Remove the extracted files and the rebuilt efiboot images
+        """
+        for efibootimg in self._efiboot.values():
+            efibootimg.close()
+        self._efiboot = {}
+        self._tmpdir.cleanup()
+
+    def CopyConfigs(self, tmpdir):
+        """
+        Copy the extracted config files into tmpdir so that they can be edited
+        """
+        shutil.copytree(self.configdir, tmpdir, dirs_exist_ok=True)
+
+    def EFIBoot(self, tmpdir):
+        """
+        Return an efiboot.img made with the EFI/BOOT/ config files from tmpdir
+
+        The images are stored by the sha256 of the config files, when another
+        iso has the same config files its image is returned instead of running
+        mkefiboot again.
+        """
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(tmpdir + "/EFI"):
+            dirs.sort()
+            for f in sorted(files):
+                path = root + "/" + f
+                h.update(os.path.relpath(path, tmpdir).encode("utf-8") + b"\0")
+                with open(path, "rb") as fp:
+                    h.update(fp.read())
+        key = h.hexdigest()
+
+        with self._lock:
+            key_lock = self._efiboot_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in self._efiboot:
+                log.info("Reusing the efiboot.img with identical EFI config files")
+                return self._efiboot[key]
+
+            with self._lock:
+                if self._efidir is None:
+                    ExtractISOFiles(self.input_iso, ["EFI"], self._tmpdir.name)
+                    self._efidir = self._tmpdir.name + "/EFI"
+            self._efiboot[key] = RebuildEFIBoot(self.input_iso, tmpdir, self._efidir)
+            return self._efiboot[key]
+
+
 def MakeKickstartISO(input_iso, output_iso, ks="", updates_image="", add_paths=None,
                     cmdline="", rm_args="", new_volid="", replace_list=None, implantmd5=True,
-                    skip_efi=False, source_date_epoch=None):
+                    skip_efi=False, source_date_epoch=None, source=None):
     """
     Make a kickstart ISO from a boot.iso or dvd
+
+    source is an optional SourceISO of input_iso, it is used to share the work of
+    reading input_iso when making several isos from it.
     """
     if add_paths is None:
         add_paths = []
     if replace_list is None:
         replace_list = []
 
-    # Gather information about the input iso
-    old_volid, files = GetISODetails(input_iso)
+    if source is None:
+        with SourceISO(input_iso) as source:
+            MakeKickstartISO(input_iso, output_iso, ks, updates_image, add_paths, cmdline,
+                             rm_args, new_volid, replace_list, implantmd5, skip_efi,
+                             source_date_epoch, source)
+        return
+
+    old_volid, files = source.volid, source.files
     if not old_volid and not new_volid:
         raise RuntimeError("No volume id found, cannot create iso.")
 
-    log.debug("ISO files:")
-    for f in files:
-        log.debug("    %s", f)
-
-    # Extract files that match the known config files.
-    known_configs = set([".discinfo", "isolinux/isolinux.cfg",
-                         "boot/grub2/grub.cfg", "boot/grub/grub.cfg",
-                         "EFI/BOOT/BOOT.conf", "EFI/BOOT/grub.cfg",
-                         "images/generic.prm", "images/cdboot.prm",
-                         "images/kernel.img", "images/initrd.img"])
-    extract_files = set(files) & known_configs
     with tempfile.TemporaryDirectory(prefix="mkksiso-") as tmpdir:
-        ExtractISOFiles(input_iso, extract_files, tmpdir)
-        CheckDiscinfo(tmpdir + "/.discinfo")
+        source.CopyConfigs(tmpdir)
         new_volid = new_volid or old_volid
         log.info("Volume Id = %s", new_volid)
 
@@ -492,10 +637,7 @@ def MakeKickstartISO(input_iso, output_iso, ks="", updates_image="", add_paths=N
         # If this is a UEFI iso, rebuild the efiboot.img file and put it in /efiboot.img
         efibootimg = None
         if not skip_efi and ("EFI/BOOT/grub.cfg" in files or "EFI/BOOT/BOOT.conf" in files):
-            if os.getuid() != 0:
-                raise RuntimeError("mkefiboot requires root privileges")
-
-            efibootimg = RebuildEFIBoot(input_iso, tmpdir)
+            efibootimg = source.EFIBoot(tmpdir)
 
         # Build the command to rebuild the iso with the changes and additions
         cmd = ["xorriso", "-indev", input_iso, "-outdev", output_iso, "-boot_image", "any", "replay"]
@@ -548,6 +690,110 @@ def MakeKickstartISO(input_iso, output_iso, ks="", updates_image="", add_paths=N
         subprocess.run(cmd, check=False, capture_output=False, env={"LANG": "C"})
 
 
+def ReadBatchSpecs(specfile, outdir, defaults=None):
+    """
+    Read the list of isos to make from a --batch file
+
+    The file is either a JSON list of objects, or one JSON object per line. Each
+    object describes one iso and uses the keys from BATCH_KEYS, only output is
+    required. Relative output paths are under outdir, other relative paths are
+    relative to the directory of specfile. Keys that are not set use the values
+    from the defaults dictionary.
+
+    Returns a list of dictionaries with the MakeKickstartISO argument names
+    Raises a RuntimeError if the file cannot be parsed
+    """
+    with open(specfile, "r") as f:
+        data = f.read()
+
+    try:
+        entries = json.loads(data)
+        if isinstance(entries, dict):
+            entries = [entries]
+    except json.JSONDecodeError:
+        try:
+            entries = [json.loads(l) for l in data.splitlines() if l.strip()]
+        except json.JSONDecodeError as e:
+            raise RuntimeError(f"Problem reading {specfile}: {e}") from e
+
+    topdir = os.path.dirname(os.path.abspath(specfile))
+    def abspath(p):
+        return os.path.normpath(os.path.join(topdir, p))
+
+    specs = []
+    for n, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            raise RuntimeError(f"{specfile} entry {n} is not an object")
+        unknown = set(entry) - set(BATCH_KEYS)
+        if unknown:
+            raise RuntimeError(f"{specfile} entry {n} has unknown keys: {', '.join(sorted(unknown))}")
+        if not entry.get("output"):
+            raise RuntimeError(f"{specfile} entry {n} is missing the output")
+
+        spec = dict(defaults or {})
+        for key, arg in BATCH_KEYS.items():
+            if key in entry:
+                spec[arg] = entry[key]
+        spec["output_iso"] = os.path.normpath(os.path.join(outdir, entry["output"]))
+        if "ks" in entry:
+            spec["ks"] = abspath(entry["ks"])
+        if "updates" in entry:
+            spec["updates_image"] = abspath(entry["updates"])
+        if isinstance(spec.get("add_paths"), str):
+            spec["add_paths"] = [spec["add_paths"]]
+        if "add" in entry:
+            spec["add_paths"] = [abspath(p) for p in spec["add_paths"]]
+        spec["add_paths"] = list(spec.get("add_paths") or [])
+        spec["replace_list"] = [tuple(r) for r in spec.get("replace_list") or []]
+
+        # Replace any previous inst.ks on the iso
+        rm_args = spec.get("rm_args") or ""
+        if spec.get("ks") and "inst.ks" not in rm_args:
+            rm_args = ("inst.ks " + rm_args).strip()
+        spec["rm_args"] = rm_args
+
+        specs.append(spec)
+
+    return specs
+
+
+def MakeKickstartISOs(input_iso, specs, implantmd5=True, skip_efi=False,
+                      source_date_epoch=None, jobs=None):
+    """
+    Make several kickstart ISOs from one boot.iso or dvd
+
+    specs is a list of dictionaries with the MakeKickstartISO arguments for
+    each iso, as returned by ReadBatchSpecs. The input iso is only read once,
+    and the isos are written by up to jobs xorriso processes at the same time.
+
+    Raises a RuntimeError if any of the isos failed
+    """
+    start = time.time()
+    with SourceISO(input_iso) as source:
+        def make_iso(spec):
+            iso_start = time.time()
+            log.info("Making %s", spec["output_iso"])
+            MakeKickstartISO(input_iso, implantmd5=implantmd5, skip_efi=skip_efi,
+                             source_date_epoch=source_date_epoch, source=source, **spec)
+            return time.time() - iso_start
+
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            futures = [(spec["output_iso"], executor.submit(make_iso, spec)) for spec in specs]
+
+        failed = []
+        log.info("%-60s %s", "iso", "result")
+        for output_iso, future in futures:
+            try:
+                log.info("%-60s done in %.1fs", output_iso, future.result())
+            except Exception as e:                          # pylint: disable=broad-except
+                log.info("%-60s FAILED: %s", output_iso, e)
+                failed.append(output_iso)
+    log.info("Made %d of %d isos in %.1fs", len(specs) - len(failed), len(specs), time.time() - start)
+
+    if failed:
+        raise RuntimeError("Failed to make %s" % ", ".join(failed))
+
+
 def setup_arg_parser():
     """ Return argparse.Parser object of cmdline."""
     parser = argparse.ArgumentParser(description="Add a kickstart and files to an iso")
@@ -575,11 +821,16 @@ def setup_arg_parser():
                         help="Skip running mkefiboot")
     parser.add_argument("--tmp", default=None, type=os.path.abspath,
                         help="Top level temporary directory")
+    parser.add_argument("--batch", type=os.path.abspath, metavar="SPECFILE",
+                        help="Make several isos described by a JSON file, output_iso is the output directory")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of isos to write at the same time with --batch, defaults to the number of cpus")
 
     parser.add_argument("ks_pos", nargs="?", type=os.path.abspath, metavar="KICKSTART",
                         help="Optional kickstart to add to the ISO")
     parser.add_argument("input_iso", type=os.path.abspath, help="ISO to modify")
-    parser.add_argument("output_iso", type=os.path.abspath, help="Full pathname of iso to be created")
+    parser.add_argument("output_iso", type=os.path.abspath,
+                        help="Full pathname of iso to be created, or the output directory with --batch")
 
     return parser
 
@@ -596,19 +847,44 @@ def main():
                 log.error("%s binary is missing", t)
                 errors = True
 
+        remove_args = args.rm_args
+        if (args.ks or args.ks_pos) and "inst.ks" not in remove_args:
+            # Add inst.ks to the list of args to remove so that any previous use is overriden
+            remove_args = ("inst.ks " + remove_args).strip()
+
+        if args.batch:
+            if not os.path.exists(args.batch):
+                raise RuntimeError("%s is missing" % args.batch)
+            defaults = {"ks": args.ks or args.ks_pos, "updates_image": args.updates,
+                        "add_paths": args.add_paths, "cmdline": args.cmdline,
+                        "rm_args": remove_args, "new_volid": args.volid,
+                        "replace_list": args.replace}
+            specs = ReadBatchSpecs(args.batch, args.output_iso, defaults)
+            if not specs:
+                raise RuntimeError("%s does not list any isos" % args.batch)
+        else:
+            specs = [{"output_iso": args.output_iso, "ks": args.ks or args.ks_pos,
+                      "rm_args": remove_args}]
+
         files = [args.input_iso, *args.add_paths]
-        if args.ks or args.ks_pos:
-            files += [args.ks or args.ks_pos]
-        for f in files:
+        for spec in specs:
+            files += spec.get("add_paths") or []
+            files += [f for f in (spec.get("ks"), spec.get("updates_image")) if f]
+        for f in sorted(set(files)):
             if not os.path.exists(f):
                 log.error("%s is missing", f)
                 errors = True
 
-        if os.path.exists(args.output_iso):
-            log.error("%s already exists", args.output_iso)
-            errors = True
+        outputs = [spec["output_iso"] for spec in specs]
+        for f in sorted(set(outputs)):
+            if os.path.exists(f):
+                log.error("%s already exists", f)
+                errors = True
+            if outputs.count(f) > 1:
+                log.error("%s is used by more than one iso", f)
+                errors = True
 
-        if "=" in args.rm_args:
+        if "=" in args.rm_args or any("=" in (spec.get("rm_args") or "") for spec in specs):
             log.error("--rm-args should only list the arguments to remove, not values")
             errors = True
 
@@ -616,7 +892,7 @@ def main():
             log.error("Use either --ks KICKSTART or positional KICKSTART but not both")
             errors = True
 
-        if not any([args.ks or args.ks_pos, args.updates, args.add_paths, args.cmdline, args.rm_args, args.volid, args.replace]):
+        if not args.batch and not any([args.ks or args.ks_pos, args.updates, args.add_paths, args.cmdline, args.rm_args, args.volid, args.replace]):
             log.error("Nothing to do - pass one or more of --ks, --updates, --add, --cmdline, --rm-args, --volid, --replace")
             errors = True
 
@@ -630,14 +906,15 @@ def main():
         if errors:
             raise RuntimeError("Problems running %s" % sys.argv[0])
 
-        remove_args = args.rm_args
-        if args.ks and "inst.ks" not in remove_args:
-            # Add inst.ks to the list of args to remove so that any previous use is overriden
-            remove_args = ("inst.ks " + remove_args).strip()
-
-        MakeKickstartISO(args.input_iso, args.output_iso, args.ks or args.ks_pos, args.updates,
-                         args.add_paths, args.cmdline, remove_args,
-                         args.volid, args.replace, args.no_md5sum, args.skip_efi, os.getenv("SOURCE_DATE_EPOCH"))
+        if args.batch:
+            for f in outputs:
+                os.makedirs(os.path.dirname(f), exist_ok=True)
+            MakeKickstartISOs(args.input_iso, specs, args.no_md5sum, args.skip_efi,
+                              os.getenv("SOURCE_DATE_EPOCH"), args.jobs)
+        else:
+            MakeKickstartISO(args.input_iso, args.output_iso, args.ks or args.ks_pos, args.updates,
+                             args.add_paths, args.cmdline, remove_args,
+                             args.volid, args.replace, args.no_md5sum, args.skip_efi, os.getenv("SOURCE_DATE_EPOCH"))
     except RuntimeError as e:
         log.error(str(e))
         return 1
@@ -23,6 +23,11 @@ import subprocess
 import shutil
 import hashlib
 import glob
+import copy
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 # Use Mako templates for appliance builder descriptions
 from mako.template import Template
@@ -36,15 +41,18 @@ from pykickstart.version import makeVersion
 # Use the Lorax treebuilder branch for iso creation
 from pylorax import DEFAULT_RELEASEVER, ArchData
 from pylorax.base import DataHolder
-from pylorax.executils import execWithRedirect
+from pylorax.checksum import file_checksum
+from pylorax.executils import execWithRedirect, execWithCapture
+from pylorax.imgcache import ImageCache, hash_file, hash_url, repo_state
 from pylorax.imgutils import DracutChroot, PartitionMount
 from pylorax.imgutils import mount, umount, Mount
 from pylorax.imgutils import mksquashfs, mkrootfsimg
-from pylorax.imgutils import copytree
+from pylorax.imgutils import copytree, mktar, default_image_name, convert_image
 from pylorax.installer import novirt_install, virt_install, InstallError
+from pylorax.installer import make_oci, make_vagrant
 from pylorax.treebuilder import TreeBuilder, RuntimeBuilder
 from pylorax.treebuilder import findkernels
-from pylorax.sysutils import joinpaths, remove, safe_joinpaths
+from pylorax.sysutils import joinpaths, remove, safe_joinpaths, clone_file
 
 
 # Default parameters for rebuilding initramfs, override with --dracut-arg or --dracut-conf
@@ -53,6 +61,11 @@ DRACUT_DEFAULT = ["--xz", "--add", "livenet dmsquash-live dmsquash-live-ntfs con
 
 RUNTIME = "images/install.img"
 
+# Outputs that --make-multi can create from a single installation
+MULTI_OUTPUTS = ["iso", "pxe-live", "tar", "oci", "qcow2", "vagrant"]
+# The --make-multi outputs that read from the shared mount of the root partition
+MOUNTED_OUTPUTS = ["pxe-live", "tar", "oci"]
+
 class FakeDNF(object):
     """
     A minimal DNF object suitable for passing to RuntimeBuilder
@@ -177,16 +190,10 @@ def make_appliance(disk_img, name, template, outfile, networks=None, ram=1024,
         arch = "x86_64"
 
     log.info("Calculating SHA256 checksum of %s", disk_img)
-    sha256 = hashlib.sha256()
-    with open(disk_img, "rb") as f:
-        while True:
-            data = f.read(1024**2)
-            if not data:
-                break
-            sha256.update(data)
-    log.info("SHA256 of %s is %s", disk_img, sha256.hexdigest())
+    sha256 = file_checksum(disk_img)
+    log.info("SHA256 of %s is %s", disk_img, sha256)
     disk_info = DataHolder(name=os.path.basename(disk_img), format="raw",
-                           checksum_type="sha256", checksum=sha256.hexdigest())
+                           checksum_type="sha256", checksum=sha256)
     try:
         result = Template(filename=template).render(disks=[disk_info], name=name,
                           arch=arch, memory=ram, vcpus=vcpus, networks=networks,
@@ -283,18 +290,20 @@ def rebuild_initrds_for_live(opts, sys_root_dir, results_dir):
 
     # Write the new initramfs directly to the results directory
     os.mkdir(joinpaths(sys_root_dir, "results"))
-    with DracutChroot(sys_root_dir, bind=[(results_dir, "/results")]) as dracut:
-        for kernel in kernels:
-            if hasattr(kernel, "initrd"):
-                outfile = os.path.basename(kernel.initrd.path)
-            else:
-                # Construct an initrd from the kernel name
-                outfile = os.path.basename(kernel.path.replace("vmlinuz-", "initrd-") + ".img")
-            log.info("rebuilding %s", outfile)
+    jobs = []
+    for kernel in kernels:
+        if hasattr(kernel, "initrd"):
+            outfile = os.path.basename(kernel.initrd.path)
+        else:
+            # Construct an initrd from the kernel name
+            outfile = os.path.basename(kernel.path.replace("vmlinuz-", "initrd-") + ".img")
+        log.info("rebuilding %s", outfile)
+        jobs.append(args + ["/results/"+outfile, kernel.version])
 
-            kver = kernel.version
-            dracut.Run(args + ["/results/"+outfile, kver])
-            shutil.copy2(joinpaths(sys_root_dir, kernel.path), results_dir)
+    with DracutChroot(sys_root_dir, bind=[(results_dir, "/results")]) as dracut:
+        dracut.RunJobs(jobs, opts.dracut_jobs)
+    for kernel in kernels:
+        shutil.copy2(joinpaths(sys_root_dir, kernel.path), results_dir)
 
 def create_pxe_config(template, images_dir, live_image_name, add_args = None):
     """
@@ -379,7 +388,7 @@ def make_livecd(opts, mount_dir, work_dir):
                      extra_boot_args=opts.extra_boot_args)
     log.info("Rebuilding initrds")
     log.info("dracut args = %s", dracut_args(opts))
-    tb.rebuild_initrds(add_args=dracut_args(opts))
+    tb.rebuild_initrds(add_args=dracut_args(opts), jobs=opts.dracut_jobs)
     log.info("Building boot.iso")
     tb.build()
 
@@ -455,6 +464,69 @@ def calculate_disk_size(opts, ks):
     log.info("Using disk size of %sMiB", disk_size)
     return disk_size
 
+def image_cache_key(opts, ks):
+    """
+    Calculate the --image-cache key of the image installed by a kickstart
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param ks: Parsed Kickstart object
+    :type ks: pykickstart.parser.KickstartParser
+    :returns: sha256 hex digest, or None if the install cannot be cached
+    :rtype: str
+
+    The key covers the kickstart with its %include files, the repomd.xml of each
+    repository (or the ref of an ostree), the boot.iso or the installed anaconda
+    for --no-virt, and the options that change the installed image.
+    """
+    if opts.make_tar or opts.make_oci or opts.make_vagrant or opts.make_tar_disk:
+        log.info("image cache: only disk and filesystem images are cached")
+        return None
+
+    arch = ArchData(opts.arch or os.uname().machine)
+    def expand(url):
+        if not url:
+            return url
+        url = url.replace("$releasever", opts.releasever).replace("$basearch", arch.basearch)
+        if "$" in url:
+            raise RuntimeError("Cannot expand the variables in %s" % url)
+        return url
+
+    repos = []
+    if ks.handler.ostreesetup.seen:
+        ostree = ks.handler.ostreesetup
+        repos.append(hash_url(expand(ostree.url).rstrip("/") + "/refs/heads/" + ostree.ref))
+    elif ks.handler.method.method == "url":
+        method = ks.handler.method
+        repos.append(repo_state(expand(method.url), expand(method.mirrorlist), expand(method.metalink)))
+    else:
+        log.info("image cache: the %s install method cannot be cached", ks.handler.method.method)
+        return None
+    for repo in ks.handler.repo.repoList:
+        repos.append(repo_state(expand(repo.baseurl), expand(repo.mirrorlist), expand(repo.metalink)))
+
+    if opts.no_virt:
+        installer = execWithCapture("rpm", ["-q", "anaconda-core"], raise_err=True).strip()
+    else:
+        installer = hash_file(opts.iso)
+
+    if opts.make_fsimage or (opts.no_virt and (opts.make_iso or opts.make_pxe_live)):
+        layout = "fsimage"
+    else:
+        layout = "disk"
+
+    data = {
+        "kickstart": str(ks.handler),
+        "kickstarts": [hash_file(path) for path in opts.ks[1:]],
+        "repos": repos,
+        "installer": installer,
+        "layout": layout,
+        "options": [opts.no_virt, opts.image_type, opts.qemu_args, opts.fs_label,
+                    opts.image_size_align, opts.virt_uefi, opts.arch, opts.kernel_args,
+                    opts.anaconda_args, opts.releasever],
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
 def make_image(opts, ks, cancel_func=None):
     """
     Install to a disk image
@@ -488,6 +560,19 @@ def make_image(opts, ks, cancel_func=None):
     else:
         tar_img = None
 
+    # Reuse the image from an earlier install with the same inputs
+    image_cache = None
+    cache_key = None
+    if opts.image_cache:
+        try:
+            cache_key = image_cache_key(opts, ks)
+        except Exception as e:                              # pylint: disable=broad-except
+            log.warning("image cache: cannot calculate the key, not using the cache: %s", e)
+        if cache_key:
+            image_cache = ImageCache(opts.image_cache, opts.image_cache_size * 1024**3)
+            if image_cache.get(cache_key, disk_img):
+                return disk_img
+
     try:
         if opts.no_virt:
             novirt_install(opts, disk_img, disk_size, cancel_func=cancel_func, tar_img=tar_img)
@@ -509,13 +594,19 @@ def make_image(opts, ks, cancel_func=None):
 
     log.info("Disk Image install successful")
 
+    if image_cache:
+        try:
+            image_cache.put(cache_key, disk_img, {"kickstart": opts.ks[0], "disk_size": disk_size})
+        except OSError as e:
+            log.warning("image cache: cannot store the image: %s", e)
+
     if opts.make_tar_disk:
         return tar_img
 
     return disk_img
 
 
-def make_live_images(opts, work_dir, disk_img):
+def make_live_images(opts, work_dir, disk_img, img_mount=None):
     """
     Create live images from direcory or rootfs image
 
@@ -523,6 +614,8 @@ def make_live_images(opts, work_dir, disk_img):
     :type opts: argparse options
     :param str work_dir: Directory for storing results
     :param str disk_img: Path to disk image (fsimage or partitioned)
+    :param img_mount: Already mounted partitioned disk_img to use, it is only read from
+    :type img_mount: imgutils.PartitionMount
     :returns: Path of directory with created images or None
     :rtype: str
 
@@ -537,7 +630,7 @@ def make_live_images(opts, work_dir, disk_img):
     os.makedirs(liveos_dir)
     rootfs_img = joinpaths(liveos_dir, "rootfs.img")
 
-    if opts.fs_image or opts.no_virt:
+    if not img_mount and (opts.fs_image or opts.no_virt):
         # Find the ostree root in the fsimage
         if opts.ostree:
             with Mount(disk_img, opts="loop") as mnt_dir:
@@ -551,7 +644,7 @@ def make_live_images(opts, work_dir, disk_img):
         is_root_part = None
         if opts.ostree:
             is_root_part = lambda dir: os.path.exists(dir+"/ostree/deploy")
-        with PartitionMount(disk_img, mount_ok=is_root_part) as img_mount:
+        with nullcontext(img_mount) if img_mount else PartitionMount(disk_img, mount_ok=is_root_part) as img_mount:
             if img_mount and img_mount.mount_dir:
                 mounted_sysroot_boot_dir = None
                 try:
@@ -604,6 +697,224 @@ def make_live_images(opts, work_dir, disk_img):
 
     return work_dir
 
+def make_livecd_from_disk(opts, disk_img, work_dir, size=None):
+    """
+    Make a livecd from the root partition of a partitioned disk image
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param str disk_img: Path to the partitioned disk image, it is modified
+    :param str work_dir: Directory for storing results
+    :param int size: Size of disk image, in GiB
+    :returns: Path of directory with the iso tree or None if the root wasn't found
+    :rtype: str
+    """
+    with PartitionMount(disk_img) as img_mount:
+        if not img_mount or not img_mount.mount_dir:
+            return None
+        rc = make_runtime(opts, img_mount.mount_dir, work_dir, size)
+        if rc != 0:
+            log.error("make_runtime failed with rc = %d. See program.log", rc)
+            raise RuntimeError("make_runtime failed with rc = %d" % rc)
+        return make_livecd(opts, img_mount.mount_dir, work_dir)
+
+def keep_boot_iso(opts, result_dir):
+    """
+    Remove everything but the boot.iso from a livecd result directory
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param str result_dir: Directory returned by make_livecd
+    :returns: Path of a new directory with only the iso in it, named --iso-name
+    :rtype: str
+
+    If the boot.iso is missing the result_dir is returned unchanged.
+    """
+    boot_iso = joinpaths(result_dir, "images/boot.iso")
+    if not os.path.exists(boot_iso):
+        log.error("%s is missing, skipping --iso-only.", boot_iso)
+        return result_dir
+    iso_dir = tempfile.mkdtemp(prefix="lmc-result-")
+    dest_file = joinpaths(iso_dir, opts.iso_name or "boot.iso")
+    shutil.move(boot_iso, dest_file)
+    shutil.rmtree(result_dir)
+    return iso_dir
+
+def multi_output_name(opts, output):
+    """
+    Return the name of the file or directory an output is written to
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param str output: One of MULTI_OUTPUTS
+    :returns: Name relative to the result directory
+    :rtype: str
+
+    The iso and pxe-live outputs are directories of files, the rest are single files.
+    """
+    if output == "tar":
+        return default_image_name(opts.compression, "root.tar")
+    elif output == "oci" and opts.oci_layout:
+        return "oci-archive.tar"
+    elif output == "oci":
+        return default_image_name(opts.compression, "bundle.tar")
+    elif output == "qcow2":
+        return "disk.qcow2"
+    elif output == "vagrant":
+        return default_image_name(opts.compression, "vagrant.tar")
+    return output
+
+def make_multi_output(opts, output, disk_img, img_mount, disk_size, outfile):
+    """
+    Make one of the --make-multi outputs
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param str output: One of MULTI_OUTPUTS
+    :param str disk_img: Path to the partitioned disk image, it is only read from
+    :param img_mount: The read-only mount of the root partition of disk_img, or None
+                      when output is not one of MOUNTED_OUTPUTS
+    :type img_mount: imgutils.PartitionMount
+    :param int disk_size: Disk size in MiB
+    :param str outfile: Path of the file or directory to create
+
+    Raises RuntimeError if the output could not be created.
+    """
+    compress_args = []
+    for arg in opts.compress_args:
+        compress_args += arg.split(" ", 1)
+    qemu_args = []
+    for arg in opts.qemu_args:
+        qemu_args += arg.split(" ", 1)
+
+    if output == "iso":
+        # Building the iso writes to the root filesystem, so it gets its own copy of the disk.
+        # When the filesystem supports reflinks this is instant and only changed blocks use space.
+        snapshot = tempfile.mktemp(prefix="lmc-snapshot-", suffix=".img", dir=os.path.dirname(disk_img))
+        if clone_file(disk_img, snapshot):
+            log.info("iso: reflinked %s to %s", disk_img, snapshot)
+        else:
+            log.info("iso: copied %s to %s", disk_img, snapshot)
+        try:
+            work_dir = tempfile.mkdtemp(prefix="lmc-work-")
+            result_dir = make_livecd_from_disk(opts, snapshot, work_dir, disk_size/1024.0)
+            if result_dir is None:
+                raise RuntimeError("Unable to mount the root partition of %s" % snapshot)
+            if opts.iso_only:
+                result_dir = keep_boot_iso(opts, result_dir)
+        finally:
+            os.unlink(snapshot)
+    elif output == "pxe-live":
+        work_dir = tempfile.mkdtemp(prefix="lmc-work-")
+        result_dir = make_live_images(opts, work_dir, disk_img, img_mount=img_mount)
+        if result_dir is None:
+            raise RuntimeError("Creating PXE live image failed.")
+    elif output == "tar":
+        rc = mktar(img_mount.mount_dir, outfile, opts.compression, compress_args)
+        if rc:
+            raise RuntimeError("mktar failed: rc=%s" % rc)
+        return
+    elif output == "oci":
+        oci_opts = copy.copy(opts)
+        # OCI layers can only be gzip or zstd compressed
+        if opts.oci_layout and opts.compression not in ("gzip", "zstd"):
+            oci_opts.compression = "zstd"
+            compress_args = []
+        rc = make_oci(oci_opts, img_mount.mount_dir, outfile, compress_args)
+        if rc:
+            raise RuntimeError("make_oci failed: rc=%s" % rc)
+        return
+    elif output == "qcow2":
+        convert_image(disk_img, outfile, "qcow2", qemu_args)
+        return
+    elif output == "vagrant":
+        box_img = tempfile.mktemp(prefix="lmc-disk-", suffix=".img")
+        try:
+            convert_image(disk_img, box_img, "qcow2", qemu_args)
+            rc = make_vagrant(opts, box_img, outfile, disk_size, compress_args)
+            if rc:
+                raise RuntimeError("make_vagrant failed: rc=%s" % rc)
+        finally:
+            if os.path.exists(box_img):
+                os.unlink(box_img)
+        return
+    else:
+        raise RuntimeError("Unknown output type: %s" % output)
+
+    copytree(result_dir, outfile, preserve=False)
+    shutil.rmtree(result_dir)
+
+def _run_multi_output(opts, output, disk_img, img_mount, disk_size, cancel_func):
+    """Make an output, returning a DataHolder with its path, time, and error if it failed"""
+    outfile = joinpaths(opts.result_dir, multi_output_name(opts, output))
+    start = time.time()
+    error = None
+    try:
+        if cancel_func and cancel_func():
+            raise RuntimeError("canceled")
+        log.info("%s: creating %s", output, outfile)
+        make_multi_output(opts, output, disk_img, img_mount, disk_size, outfile)
+        log.info("%s: finished in %.1fs", output, time.time() - start)
+    except Exception as e:                                  # pylint: disable=broad-except
+        log.error("%s: failed: %s", output, e)
+        error = str(e)
+    return DataHolder(output=output, path=outfile, seconds=time.time() - start, error=error)
+
+def make_multi_images(opts, disk_img, disk_size=None, cancel_func=None):
+    """
+    Make several outputs from one partitioned disk image at the same time
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param str disk_img: Path to the partitioned disk image
+    :param int disk_size: Disk size in MiB, defaults to the size of disk_img
+    :param cancel_func: Function that returns True to cancel build
+    :type cancel_func: function
+    :returns: A DataHolder for each of opts.make_multi with output, path, seconds, and error
+    :rtype: list
+
+    The root partition is mounted read-only once and shared by the MOUNTED_OUTPUTS.
+    The iso output modifies the filesystem while it is built so it uses a copy of
+    the disk image. The copy has the same filesystem UUID, which XFS and btrfs
+    refuse to mount twice, so the iso is finished before the shared mount is made.
+    Up to opts.multi_jobs outputs are made in parallel, and a summary with the
+    time taken by each one is logged.
+    Raises RuntimeError if any of the outputs failed.
+    """
+    if not disk_size:
+        disk_size = os.path.getsize(disk_img) // 1024**2
+    jobs = opts.multi_jobs or len(opts.make_multi)
+    log.info("Creating %s from %s, %d at a time", ", ".join(opts.make_multi), disk_img, jobs)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = dict((output, executor.submit(_run_multi_output, opts, output, disk_img,
+                                                None, disk_size, cancel_func))
+                       for output in opts.make_multi if output not in MOUNTED_OUTPUTS)
+        mounted = [output for output in opts.make_multi if output in MOUNTED_OUTPUTS]
+        if "iso" in futures and mounted:
+            futures["iso"].result()
+        if mounted:
+            with PartitionMount(disk_img, read_only=True) as img_mount:
+                if not img_mount or not img_mount.mount_dir:
+                    raise RuntimeError("Unable to mount the root partition of %s" % disk_img)
+                for output in mounted:
+                    futures[output] = executor.submit(_run_multi_output, opts, output, disk_img,
+                                                      img_mount, disk_size, cancel_func)
+                for output in mounted:
+                    futures[output].result()
+        results = [futures[output].result() for output in opts.make_multi]
+
+    log.info("%-9s %-6s %8s  %s", "OUTPUT", "STATUS", "TIME", "PATH")
+    for r in results:
+        log.info("%-9s %-6s %7.1fs  %s", r.output, "FAILED" if r.error else "ok", r.seconds, r.path)
+    log.info("%d outputs in %.1fs", len(results), time.time() - start)
+
+    failed = [r.output for r in results if r.error]
+    if failed:
+        raise RuntimeError("Creating %s failed" % ", ".join(failed))
+    return results
+
 def check_kickstart(ks, opts):
     """Check the parsed kickstart object for errors
 
@@ -674,7 +985,7 @@ def run_creator(opts, cancel_func=None):
         ks.readKickstart(opts.ks[0])
 
     # live iso usually needs dracut-live so warn the user if it is missing
-    if opts.ks and opts.make_iso:
+    if opts.ks and (opts.make_iso or "iso" in (opts.make_multi or [])):
         if "dracut-live" not in ks.handler.packages.packageList:
             log.error("dracut-live package is missing from the kickstart.")
             raise RuntimeError("dracut-live package is missing from the kickstart.")
@@ -719,25 +1030,11 @@ def run_creator(opts, cancel_func=None):
         else:
             # Create iso from a partitioned disk image
             disk_img = opts.disk_image or disk_img
-            with PartitionMount(disk_img) as img_mount:
-                if img_mount and img_mount.mount_dir:
-                    rc = make_runtime(opts, img_mount.mount_dir, work_dir, calculate_disk_size(opts, ks)/1024.0)
-                    if rc != 0:
-                        log.error("make_runtime failed with rc = %d. See program.log", rc)
-                        raise RuntimeError("make_runtime failed with rc = %d" % rc)
-                    result_dir = make_livecd(opts, img_mount.mount_dir, work_dir)
+            result_dir = make_livecd_from_disk(opts, disk_img, work_dir, calculate_disk_size(opts, ks)/1024.0)
 
         # --iso-only removes the extra build artifacts, keeping only the boot.iso
         if opts.iso_only and result_dir:
-            boot_iso = joinpaths(result_dir, "images/boot.iso")
-            if not os.path.exists(boot_iso):
-                log.error("%s is missing, skipping --iso-only.", boot_iso)
-            else:
-                iso_dir = tempfile.mkdtemp(prefix="lmc-result-")
-                dest_file = joinpaths(iso_dir, opts.iso_name or "boot.iso")
-                shutil.move(boot_iso, dest_file)
-                shutil.rmtree(result_dir)
-                result_dir = iso_dir
+            result_dir = keep_boot_iso(opts, result_dir)
 
         # cleanup the mess
         # cleanup work_dir?
@@ -753,6 +1050,15 @@ def run_creator(opts, cancel_func=None):
         make_appliance(opts.disk_image or disk_img, opts.app_name,
                        opts.app_template, opts.app_file, networks, opts.ram,
                        opts.vcpus or 1, opts.arch, opts.title, opts.project, opts.releasever)
+    elif opts.make_multi:
+        disk_img = opts.disk_image or disk_img
+        make_multi_images(opts, disk_img, calculate_disk_size(opts, ks) if opts.ks else None,
+                          cancel_func=cancel_func)
+
+        if disk_img and not (opts.keep_image or opts.disk_image):
+            os.unlink(disk_img)
+            log.info("Disk image erased")
+            disk_img = None
     elif opts.make_pxe_live:
         work_dir = tempfile.mkdtemp(prefix="lmc-work-")
         log.info("working dir is %s", work_dir)
@@ -0,0 +1,349 @@
+#
+# elfutils.py - read ELF files and check their shared library dependencies
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.elfutils")
+
+import glob
+import mmap
+import multiprocessing
+import os
+import stat
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pylorax.base import DataHolder
+from pylorax.sysutils import joinpaths
+
+ELF_MAGIC = b"\x7fELF"
+
+# Program header types
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+# Dynamic section tags
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# Section header types
+SHT_NOBITS = 8
+
+
+def _header(data):
+    """Return the struct formats and header fields of an ELF file"""
+    if data[:4] != ELF_MAGIC:
+        raise RuntimeError("Not an ELF file")
+    endian = "<" if data[5] == 1 else ">"
+    if data[4] == 2:
+        e_type, e_machine = struct.unpack_from(endian+"HH", data, 16)
+        phoff, shoff = struct.unpack_from(endian+"QQ", data, 0x20)
+        phentsize, phnum, shentsize, shnum, shstrndx = struct.unpack_from(endian+"HHHHH", data, 0x36)
+        # (type, offset, vaddr, filesz) and (name, type, offset, size) fields
+        phdr, phfields = endian+"IIQQQQQQ", (0, 2, 3, 5)
+        shdr, shfields = endian+"IIQQQQIIQQ", (0, 1, 4, 5)
+        dyn = endian+"qQ"
+    else:
+        e_type, e_machine = struct.unpack_from(endian+"HH", data, 16)
+        phoff, shoff = struct.unpack_from(endian+"II", data, 0x1C)
+        phentsize, phnum, shentsize, shnum, shstrndx = struct.unpack_from(endian+"HHHHH", data, 0x2A)
+        phdr, phfields = endian+"IIIIIIII", (0, 1, 2, 4)
+        shdr, shfields = endian+"IIIIIIIIII", (0, 1, 4, 5)
+        dyn = endian+"iI"
+
+    def pick(entry, fields):
+        return tuple(entry[i] for i in fields)
+
+    phdrs = [pick(struct.unpack_from(phdr, data, phoff + i * phentsize), phfields) for i in range(phnum)]
+    shdrs = [pick(struct.unpack_from(shdr, data, shoff + i * shentsize), shfields) for i in range(shnum)]
+    return DataHolder(elfclass=data[4], machine=e_machine, type=e_type,
+                      phdrs=phdrs, shdrs=shdrs, shstrndx=shstrndx, dyn=dyn)
+
+def _cstring(data, offset):
+    """Return the NUL terminated string at offset"""
+    end = data.find(b"\0", offset)
+    return data[offset:end].decode("utf-8", "surrogateescape")
+
+def elf_section(data, name):
+    """Return the contents of an ELF section
+
+    :param bytes data: The ELF file
+    :param str name: Name of the section, eg. .modinfo
+    :returns: The section's data or None if it isn't found
+    :rtype: bytes
+    """
+    hdr = _header(data)
+    if not hdr.shdrs:
+        return None
+    _name, _type, stroff, strsize = hdr.shdrs[hdr.shstrndx]
+    names = data[stroff:stroff+strsize]
+    for sh_name, sh_type, offset, size in hdr.shdrs:
+        if _cstring(names, sh_name) == name:
+            if sh_type == SHT_NOBITS:
+                return b""
+            return data[offset:offset+size]
+    return None
+
+def read_elf(path):
+    """Return the dynamic linking details of an ELF file
+
+    :param str path: Path to the file
+    :returns: elfclass, machine, interp, needed, rpath, runpath, and soname or None if it isn't ELF
+    :rtype: DataHolder
+
+    The file is mapped, not read, so only the headers and the dynamic section are paged in.
+    """
+    with open(path, "rb") as f:
+        if f.read(4) != ELF_MAGIC:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                return _read_dynamic(data)
+            except (struct.error, IndexError, ValueError) as e:
+                logger.debug("Failed to read %s: %s", path, e)
+                return None
+
+def _read_dynamic(data):
+    hdr = _header(data)
+    info = DataHolder(elfclass=hdr.elfclass, machine=hdr.machine, interp=None,
+                      needed=[], rpath=[], runpath=[], soname=None)
+
+    loads = [(vaddr, offset, filesz) for p_type, offset, vaddr, filesz in hdr.phdrs if p_type == PT_LOAD]
+    def vaddr_offset(addr):
+        for vaddr, offset, filesz in loads:
+            if vaddr <= addr < vaddr + filesz:
+                return addr - vaddr + offset
+        raise ValueError("address 0x%x is not in a loaded segment" % addr)
+
+    entries = []
+    for p_type, offset, _vaddr, filesz in hdr.phdrs:
+        if p_type == PT_INTERP:
+            info.interp = _cstring(data, offset)
+        elif p_type == PT_DYNAMIC:
+            size = struct.calcsize(hdr.dyn)
+            for i in range(filesz // size):
+                tag, val = struct.unpack_from(hdr.dyn, data, offset + i * size)
+                if tag == DT_NULL:
+                    break
+                entries.append((tag, val))
+    # Without a string table there are no names to read, treat it as having no dependencies
+    strtab_addr = dict(entries).get(DT_STRTAB)
+    if strtab_addr is None:
+        return info
+
+    strtab = vaddr_offset(strtab_addr)
+    for tag, val in entries:
+        if tag == DT_NEEDED:
+            info.needed.append(_cstring(data, strtab + val))
+        elif tag == DT_RPATH:
+            info.rpath += _cstring(data, strtab + val).split(":")
+        elif tag == DT_RUNPATH:
+            info.runpath += _cstring(data, strtab + val).split(":")
+        elif tag == DT_SONAME:
+            info.soname = _cstring(data, strtab + val)
+    return info
+
+def read_ld_so_conf(root, conf="/etc/ld.so.conf"):
+    """Return the library directories listed in ld.so.conf and the files it includes
+
+    :param str root: The root directory of the system
+    :param str conf: The configuration file, relative to root
+    :returns: Directories, in the order they are listed
+    :rtype: list of str
+    """
+    dirs = []
+    try:
+        with open(joinpaths(root, conf), "r", encoding="utf-8", errors="replace") as f:
+            lines = f.readlines()
+    except OSError:
+        return dirs
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith("include "):
+            for pattern in line.split()[1:]:
+                if not pattern.startswith("/"):
+                    pattern = joinpaths(os.path.dirname(conf), pattern)
+                for inc in sorted(glob.glob(joinpaths(root, pattern))):
+                    dirs += read_ld_so_conf(root, inc[len(root):])
+        elif not line.startswith("hwcap "):
+            dirs += [d for d in line.replace(",", " ").replace(":", " ").split() if d]
+    return dirs
+
+def resolve_path(root, path):
+    """Resolve the symlinks in an absolute path without leaving root
+
+    :param str root: The root directory
+    :param str path: Absolute path inside root
+    :returns: The resolved path, relative to root, or None if it doesn't exist
+    :rtype: str
+    """
+    parts = [p for p in path.split("/") if p]
+    resolved = "/"
+    hops = 0
+    while parts:
+        part = parts.pop(0)
+        if part == ".":
+            continue
+        if part == "..":
+            resolved = os.path.dirname(resolved)
+            continue
+        candidate = os.path.join(resolved, part)
+        try:
+            st = os.lstat(joinpaths(root, candidate))
+        except OSError:
+            return None
+        if stat.S_ISLNK(st.st_mode):
+            hops += 1
+            if hops > 40:
+                return None
+            target = os.readlink(joinpaths(root, candidate))
+            if target.startswith("/"):
+                resolved = "/"
+            parts = [p for p in target.split("/") if p] + parts
+        else:
+            resolved = candidate
+    return resolved
+
+
+class ElfVerifier(object):
+    """Check that the shared libraries needed by the ELF files in a root can be found
+
+    This follows the dynamic linker's search order, DT_RPATH (when there is no
+    DT_RUNPATH), DT_RUNPATH, the ld.so.conf directories and then the default
+    directories, and only accepts libraries with the same class and machine.
+    Nothing in the root is executed.
+    """
+    def __init__(self, root):
+        """
+        :param str root: The root directory to check
+        """
+        self.root = root
+        self.ldconf = read_ld_so_conf(root)
+        self._elf = {}
+        self._lock = threading.Lock()
+
+    def elf(self, path):
+        """Return the ELF details of a path in the root, or None, caching the result"""
+        with self._lock:
+            if path in self._elf:
+                return self._elf[path]
+        try:
+            info = read_elf(joinpaths(self.root, path))
+        except (OSError, ValueError):
+            info = None
+        with self._lock:
+            self._elf[path] = info
+        return info
+
+    @staticmethod
+    def _expand(dirs, origin, info):
+        lib = "lib64" if info.elfclass == 2 else "lib"
+        for d in dirs:
+            d = d.replace("${ORIGIN}", origin).replace("$ORIGIN", origin)
+            d = d.replace("${LIB}", lib).replace("$LIB", lib)
+            if d:
+                yield d
+
+    def find_library(self, name, path, info, rpath=None):
+        """Return the path in the root of a library needed by an ELF file
+
+        :param str name: The DT_NEEDED name
+        :param str path: The ELF file needing the library, relative to root
+        :param info: The ELF file's details from read_elf
+        :param rpath: DT_RPATH directories inherited from the executable
+        :type rpath: list of str
+        :returns: The resolved path of the library or None if it isn't found
+        :rtype: str
+        """
+        origin = os.path.dirname(path)
+        if "/" in name:
+            dirs = [origin]
+        else:
+            dirs = []
+            if not info.runpath:
+                dirs += list(self._expand(info.rpath, origin, info)) + (rpath or [])
+            dirs += list(self._expand(info.runpath, origin, info))
+            dirs += self.ldconf
+            if info.elfclass == 2:
+                dirs += ["/lib64", "/usr/lib64"]
+            else:
+                dirs += ["/lib", "/usr/lib"]
+
+        for d in dirs:
+            lib = resolve_path(self.root, joinpaths(d, name))
+            if not lib:
+                continue
+            libinfo = self.elf(lib)
+            if libinfo and libinfo.elfclass == info.elfclass and libinfo.machine == info.machine:
+                return lib
+        return None
+
+    def missing(self, path):
+        """Return the libraries that can't be found for an ELF file and the libraries it needs
+
+        :param str path: Path to the ELF file, relative to root
+        :returns: A list of (missing name, needed by) tuples
+        :rtype: list of tuple
+
+        A missing program interpreter is returned as well.
+        """
+        info = self.elf(path)
+        if not info:
+            return []
+        problems = []
+        if info.interp and not resolve_path(self.root, info.interp):
+            problems.append((info.interp, path))
+
+        # DT_RPATH of the executable applies to all of the libraries it loads
+        rpath = [] if info.runpath else list(self._expand(info.rpath, os.path.dirname(path), info))
+        seen = set([path])
+        queue = [(path, info)]
+        while queue:
+            obj, objinfo = queue.pop(0)
+            for name in objinfo.needed:
+                lib = self.find_library(name, obj, objinfo, rpath)
+                if not lib:
+                    problems.append((name, obj))
+                elif lib not in seen:
+                    seen.add(lib)
+                    queue.append((lib, self.elf(lib)))
+        return problems
+
+    def check(self, paths):
+        """Check a list of files in parallel
+
+        :param paths: Paths to check, relative to root
+        :type paths: list of str
+        :returns: A list of (missing name, needed by) tuples
+        :rtype: list of tuple
+        """
+        with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+            results = executor.map(self.missing, paths)
+        problems = []
+        for result in results:
+            for problem in result:
+                if problem not in problems:
+                    problems.append(problem)
+        return problems
@@ -0,0 +1,454 @@
+#
+# fatimage.py - write FAT filesystem images without mounting them
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.fatimage")
+
+import os
+import string
+import struct
+import time
+
+from pylorax.base import DataHolder
+from pylorax.sysutils import copy_into
+
+SECTOR_SIZE = 512
+DIRENT_SIZE = 32
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+
+# The short name case flags used by Windows NT and Linux's shortname=winnt
+NTRES_LOWER_BASE = 0x08
+NTRES_LOWER_EXT = 0x10
+
+# The FAT type is set by the number of clusters
+FAT12_MAX_CLUSTERS = 4084
+FAT16_MAX_CLUSTERS = 65524
+FAT32_MAX_CLUSTERS = 0x0FFFFFF5 - 2
+MIN_CLUSTERS = {12: 1, 16: FAT12_MAX_CLUSTERS + 1, 32: FAT16_MAX_CLUSTERS + 1}
+MAX_CLUSTERS = {12: FAT12_MAX_CLUSTERS, 16: FAT16_MAX_CLUSTERS, 32: FAT32_MAX_CLUSTERS}
+END_OF_CHAIN = {12: 0xFFF, 16: 0xFFFF, 32: 0x0FFFFFFF}
+
+# FAT types and cluster sizes to try, in order, when they are not set
+GEOMETRIES = [(12, 512), (12, 1024), (12, 2048), (12, 4096),
+              (16, 2048), (16, 4096), (16, 8192), (16, 16384), (16, 32768),
+              (32, 4096), (32, 8192), (32, 16384), (32, 32768)]
+
+# Characters allowed in short names, in addition to letters and digits
+_SHORT_CHARS = set(string.ascii_uppercase + string.digits + "!#$%&'()-@^_`{}~")
+
+# The earliest time that can be stored, 1980-01-01
+_FAT_EPOCH = 315532800
+
+
+def _fat_time(t):
+    """Return the FAT (date, time) of seconds since the epoch, in UTC"""
+    tm = time.gmtime(min(max(int(t), _FAT_EPOCH), 4354819198))
+    return (((tm.tm_year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday,
+            (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2))
+
+def _short_name(name):
+    """Return the 8.3 name and case flags of a name, or None if it needs a long name"""
+    base, dot, ext = name.rpartition(".")
+    if not dot:
+        base, ext = name, ""
+    if not base or len(base) > 8 or len(ext) > 3:
+        return None
+    ntres = 0
+    for part, flag in ((base, NTRES_LOWER_BASE), (ext, NTRES_LOWER_EXT)):
+        if any(c not in _SHORT_CHARS for c in part.upper()):
+            return None
+        if part != part.upper():
+            if part != part.lower():
+                # Mixed case needs a long name
+                return None
+            ntres |= flag
+    return (base.upper().ljust(8) + ext.upper().ljust(3)).encode("ascii"), ntres
+
+def _basis_name(name):
+    """Return the base and extension used to generate a short name for a long name"""
+    def clean(s):
+        return "".join(c if c in _SHORT_CHARS else "_" for c in s.upper().replace(" ", ""))
+    name = name.lstrip(".")
+    base, dot, ext = name.rpartition(".")
+    if not dot:
+        base, ext = name, ""
+    return clean(base.replace(".", "")) or "_", clean(ext)[:3]
+
+def _lfn_checksum(short):
+    s = 0
+    for b in short:
+        s = (((s & 1) << 7) + (s >> 1) + b) & 0xFF
+    return s
+
+def _lfn_entries(name, checksum):
+    """Return the long name entries of a name, in the order they are stored"""
+    units = list(struct.unpack("<%dH" % (len(name.encode("utf-16-le")) // 2), name.encode("utf-16-le")))
+    if len(units) > 255:
+        raise RuntimeError("%s is too long for a FAT filesystem" % name)
+    if len(units) % 13:
+        units.append(0)
+        units.extend([0xFFFF] * (-len(units) % 13))
+    count = len(units) // 13
+    entries = []
+    for i in range(count):
+        part = struct.pack("<13H", *units[i*13:i*13+13])
+        order = (i + 1) | (0x40 if i == count - 1 else 0)
+        entries.append(struct.pack("<B10sBBB12sH4s", order, part[:10], ATTR_LONG_NAME, 0,
+                                   checksum, part[10:22], 0, part[22:]))
+    return list(reversed(entries))
+
+def _dirent(short, attr, ntres, cluster, size, mtime):
+    date, tm = _fat_time(mtime)
+    return struct.pack("<11sBBBHHHHHHHI", short, attr, ntres, 0, tm, date, date,
+                       cluster >> 16, tm, date, cluster & 0xFFFF, size)
+
+
+class FATImage(object):
+    """A FAT12, FAT16, or FAT32 filesystem image
+
+    Add files and directories to it, then write it to a file. The image is
+    written directly, no loop devices, mounts, or external programs are used.
+    The files are stored in contiguous clusters, and the image is only as
+    large as it needs to be unless a size is passed to write.
+
+    Names that fit in 8.3 and are all upper or lower case are stored as short
+    names with the same case flags as Linux's shortname=winnt, other names
+    use long names. Timestamps are stored in UTC.
+    """
+    def __init__(self, label="", volume_id=None, timestamp=None):
+        """
+        :param str label: Volume label, up to 11 characters
+        :param int volume_id: Volume serial number, defaults to the current time
+        :param int timestamp: Time to set on all of the files and directories,
+                              defaults to their modification times
+        """
+        if len(label) > 11:
+            raise RuntimeError("FAT label %s is longer than 11 characters" % label)
+        self.label = label
+        self.volume_id = (volume_id if volume_id is not None else int(time.time())) & 0xFFFFFFFF
+        self.timestamp = timestamp
+        self.root = self._node("", None, is_dir=True, mtime=time.time())
+        # The directories and files in the order they are written, set by write()
+        self._dirs = []
+        self._files = []
+
+    def _node(self, name, source, is_dir, mtime, size=0):
+        if self.timestamp is not None:
+            mtime = self.timestamp
+        return DataHolder(name=name, source=source, is_dir=is_dir, mtime=mtime, size=size,
+                          children={} if is_dir else None, cluster=0, clusters=0)
+
+    def _mkdir(self, imgpath):
+        """Return the directory node of a path in the image, creating it if needed"""
+        node = self.root
+        for part in [p for p in imgpath.split("/") if p]:
+            child = node.children.get(part.lower())
+            if child is None:
+                child = self._node(part, None, is_dir=True, mtime=time.time())
+                node.children[part.lower()] = child
+            elif not child.is_dir:
+                raise RuntimeError("%s is a file in the FAT image" % imgpath)
+            node = child
+        return node
+
+    def _add_file(self, parent, name, filename):
+        st = os.stat(filename)
+        if st.st_size > 0xFFFFFFFF:
+            raise RuntimeError("%s is too large for a FAT filesystem" % filename)
+        existing = parent.children.get(name.lower())
+        if existing is not None and existing.is_dir:
+            raise RuntimeError("%s is a directory in the FAT image" % name)
+        parent.children[name.lower()] = self._node(name, filename, is_dir=False,
+                                                   mtime=st.st_mtime, size=st.st_size)
+
+    def add_tree(self, rootdir, imgpath=""):
+        """Copy the contents of a directory into a directory in the image
+
+        :param str rootdir: Local directory to copy, symlinks are followed
+        :param str imgpath: Directory in the image to copy it to
+        """
+        top = self._mkdir(imgpath)
+        top.mtime = self.timestamp if self.timestamp is not None else os.stat(rootdir).st_mtime
+        for entry in sorted(os.scandir(rootdir), key=lambda e: e.name):
+            if entry.is_dir():
+                self.add_tree(entry.path, "/".join([imgpath, entry.name]))
+            else:
+                self._add_file(top, entry.name, entry.path)
+
+    def add(self, imgpath, filename):
+        """Add a file or directory to the image, the same way as a graft
+
+        :param str imgpath: Path in the image
+        :param str filename: Local file or directory
+
+        Directories are copied into imgpath, if imgpath ends with a / files
+        are copied into it, otherwise the file is copied to imgpath.
+        """
+        if os.path.isdir(filename):
+            self.add_tree(filename, imgpath)
+        elif imgpath.endswith("/"):
+            self._add_file(self._mkdir(imgpath), os.path.basename(filename), filename)
+        else:
+            parent, _, name = imgpath.strip("/").rpartition("/")
+            self._add_file(self._mkdir(parent), name, filename)
+
+    def _walk(self):
+        """Return the directories in the image, breadth first"""
+        dirs = [self.root]
+        for d in dirs:
+            dirs.extend(c for _, c in sorted(d.children.items()) if c.is_dir)
+        return dirs
+
+    def _assign_names(self, directory):
+        """Set the short name, case flags, and long name entries of a directory's children"""
+        used = set()
+        children = [c for _, c in sorted(directory.children.items())]
+        for child in children:
+            short = _short_name(child.name)
+            if short:
+                child.short, child.ntres = short
+                child.lfn = []
+                used.add(child.short)
+        for child in children:
+            if _short_name(child.name):
+                continue
+            base, ext = _basis_name(child.name)
+            n = 1
+            while True:
+                tail = "~%d" % n
+                short = (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+                short = short.encode("ascii")
+                if short not in used:
+                    break
+                n += 1
+            used.add(short)
+            child.short, child.ntres = short, 0
+            child.lfn = _lfn_entries(child.name, _lfn_checksum(short))
+        return children
+
+    def _dir_entries(self, directory):
+        """Return the number of directory entries used by a directory"""
+        count = sum(1 + len(c.lfn) for c in directory.sorted_children)
+        if directory is self.root:
+            return count + (1 if self.label else 0)
+        # . and ..
+        return count + 2
+
+    def _geometry(self, fat_type, cluster_size, size):
+        """Calculate the layout of the image for a FAT type and cluster size
+
+        :returns: The layout, or None if the files do not fit
+        :rtype: DataHolder
+        """
+        spc = cluster_size // SECTOR_SIZE
+        reserved = 32 if fat_type == 32 else 1
+        needed = 0
+        root_entries = 0
+        for d in self._dirs:
+            entries = self._dir_entries(d)
+            if d is self.root and fat_type != 32:
+                # The FAT12 and FAT16 root directory has a fixed size, outside of the clusters
+                root_entries = max(512, -(-entries // 16) * 16)
+                if root_entries > 0xFFFF:
+                    return None
+                continue
+            needed += max(1, -(-entries * DIRENT_SIZE // cluster_size))
+        needed += sum(-(-f.size // cluster_size) for f in self._files)
+        root_sectors = root_entries * DIRENT_SIZE // SECTOR_SIZE
+
+        def fat_sectors(clusters):
+            return -(-((clusters + 2) * fat_type // 8 + 1) // SECTOR_SIZE)
+
+        if size:
+            total = size // SECTOR_SIZE
+            clusters = (total - reserved - root_sectors) // spc
+            while clusters > 0 and reserved + 2 * fat_sectors(clusters) + root_sectors + clusters * spc > total:
+                clusters -= 1
+        else:
+            clusters = max(needed, MIN_CLUSTERS[fat_type])
+            total = reserved + 2 * fat_sectors(clusters) + root_sectors + clusters * spc
+        if clusters < max(needed, MIN_CLUSTERS[fat_type]) or clusters > MAX_CLUSTERS[fat_type]:
+            return None
+        return DataHolder(fat_type=fat_type, cluster_size=cluster_size, spc=spc,
+                          reserved=reserved, root_entries=root_entries, clusters=clusters,
+                          fat_sectors=fat_sectors(clusters), total=total, needed=needed,
+                          data_start=reserved + 2 * fat_sectors(clusters) + root_sectors)
+
+    def _boot_sector(self, g):
+        """Return the boot sector"""
+        label = (self.label or "NO NAME").upper().ljust(11).encode("ascii")
+        total16, total32 = (g.total, 0) if g.total < 0x10000 and g.fat_type != 32 else (0, g.total)
+        bpb = struct.pack("<8sHBHBHHBHHHII", b"mkfs.fat", SECTOR_SIZE, g.spc, g.reserved, 2,
+                          g.root_entries, total16, 0xF8, 0 if g.fat_type == 32 else g.fat_sectors,
+                          32, 64, 0, total32)
+        if g.fat_type == 32:
+            sector = b"\xeb\x58\x90" + bpb
+            sector += struct.pack("<IHHIHH12s", g.fat_sectors, 0, 0, 2, 1, 6, b"")
+            sector += struct.pack("<BBBI11s8s", 0x80, 0, 0x29, self.volume_id, label, b"FAT32   ")
+        else:
+            sector = b"\xeb\x3c\x90" + bpb
+            sector += struct.pack("<BBBI11s8s", 0x80, 0, 0x29, self.volume_id, label,
+                                  ("FAT%d   " % g.fat_type).encode("ascii"))
+        # int 0x18 to try the next boot device, the image is not bootable from BIOS
+        sector += b"\xcd\x18\xeb\xfe"
+        return sector.ljust(510, b"\0") + b"\x55\xaa"
+
+    def _fat(self, g):
+        """Return the file allocation table"""
+        entries = [0] * (g.clusters + 2)
+        entries[0] = END_OF_CHAIN[g.fat_type] & ~0xFF | 0xF8
+        entries[1] = END_OF_CHAIN[g.fat_type]
+        for node in self._dirs + self._files:
+            for c in range(node.cluster, node.cluster + node.clusters):
+                entries[c] = c + 1
+            if node.clusters:
+                entries[node.cluster + node.clusters - 1] = END_OF_CHAIN[g.fat_type]
+        if g.fat_type == 12:
+            if len(entries) % 2:
+                entries.append(0)
+            fat = bytearray()
+            for a, b in zip(entries[0::2], entries[1::2]):
+                fat += struct.pack("<I", a | b << 12)[:3]
+        elif g.fat_type == 16:
+            fat = struct.pack("<%dH" % len(entries), *entries)
+        else:
+            fat = struct.pack("<%dI" % len(entries), *entries)
+        return bytes(fat).ljust(g.fat_sectors * SECTOR_SIZE, b"\0")
+
+    def _dir_data(self, directory, parent):
+        """Return the contents of a directory"""
+        data = bytearray()
+        if directory is self.root:
+            if self.label:
+                data += struct.pack("<11sB20s", self.label.upper().ljust(11).encode("ascii"), ATTR_VOLUME_ID,
+                                    _dirent(b"", 0, 0, 0, 0, directory.mtime)[12:])
+        else:
+            data += _dirent(b".          ", ATTR_DIRECTORY, 0, directory.cluster, 0, directory.mtime)
+            parent_cluster = 0 if parent is self.root else parent.cluster
+            data += _dirent(b"..         ", ATTR_DIRECTORY, 0, parent_cluster, 0, directory.mtime)
+        for child in directory.sorted_children:
+            for entry in child.lfn:
+                data += entry
+            attr = ATTR_DIRECTORY if child.is_dir else ATTR_ARCHIVE
+            size = 0 if child.is_dir else child.size
+            data += _dirent(child.short, attr, child.ntres, child.cluster, size, child.mtime)
+        return bytes(data)
+
+    def write(self, outfile, size=None, fat_type=None, cluster_size=None):
+        """Write the image
+
+        :param str outfile: Path to write the image to
+        :param int size: Size of the image in bytes, defaults to the smallest size that fits
+        :param int fat_type: 12, 16, or 32, defaults to the smallest type that fits
+        :param int cluster_size: Cluster size in bytes, defaults to one that fits the FAT type
+        :returns: The layout of the image, with fat_type, cluster_size, clusters, and total sectors
+        :rtype: DataHolder
+
+        Raises RuntimeError if the files do not fit
+        """
+        start = time.time()
+        self._dirs = self._walk()
+        for d in self._dirs:
+            d.sorted_children = self._assign_names(d)
+        self._files = [c for d in self._dirs for c in d.sorted_children if not c.is_dir]
+
+        for t, cs in GEOMETRIES:
+            if (fat_type and t != fat_type) or (cluster_size and cs != cluster_size):
+                continue
+            g = self._geometry(t, cs, size)
+            if g:
+                break
+        else:
+            raise RuntimeError("The files do not fit in a FAT%s image of %s bytes" %
+                               (fat_type or "", size or "any number of"))
+
+        # Allocate the directories, then the files, in contiguous clusters
+        cluster = 2
+        for node in self._dirs + self._files:
+            if node is self.root and g.fat_type != 32:
+                continue
+            if node.is_dir:
+                node.clusters = max(1, -(-self._dir_entries(node) * DIRENT_SIZE // g.cluster_size))
+            else:
+                node.clusters = -(-node.size // g.cluster_size)
+            node.cluster = cluster if node.clusters else 0
+            cluster += node.clusters
+
+        fd = os.open(outfile, os.O_RDWR|os.O_CREAT|os.O_TRUNC|os.O_CLOEXEC, 0o644)
+        try:
+            os.ftruncate(fd, g.total * SECTOR_SIZE)
+            boot = self._boot_sector(g)
+            os.pwrite(fd, boot, 0)
+            if g.fat_type == 32:
+                fsinfo = struct.pack("<I480sIII12sI", 0x41615252, b"", 0x61417272,
+                                     g.clusters - g.needed, cluster, b"", 0xAA550000)
+                os.pwrite(fd, fsinfo, SECTOR_SIZE)
+                os.pwrite(fd, boot, 6 * SECTOR_SIZE)
+                os.pwrite(fd, fsinfo, 7 * SECTOR_SIZE)
+            fat = self._fat(g)
+            for i in range(2):
+                os.pwrite(fd, fat, (g.reserved + i * g.fat_sectors) * SECTOR_SIZE)
+
+            def cluster_offset(c):
+                return (g.data_start + (c - 2) * g.spc) * SECTOR_SIZE
+
+            parents = {id(c): d for d in self._dirs for c in d.sorted_children}
+            for d in self._dirs:
+                data = self._dir_data(d, parents.get(id(d)))
+                if d is self.root and g.fat_type != 32:
+                    os.pwrite(fd, data, (g.reserved + 2 * g.fat_sectors) * SECTOR_SIZE)
+                else:
+                    os.pwrite(fd, data, cluster_offset(d.cluster))
+            for f in self._files:
+                if f.clusters:
+                    copy_into(f.source, fd, cluster_offset(f.cluster), f.size)
+        finally:
+            os.close(fd)
+
+        logger.debug("wrote FAT%d image %s, %d bytes, %d of %d clusters used, in %.2fs", g.fat_type,
+                     outfile, g.total * SECTOR_SIZE, g.needed, g.clusters, time.time() - start)
+        return g
+
+
+def mkfatimg(outfile, rootdir=None, graft=None, label="", size=None, fat_type=None):
+    """Write a FAT filesystem image of a directory and grafts without mounting it
+
+    :param str outfile: Path to write the image to
+    :param str rootdir: Directory to copy to the root of the image, or None
+    :param dict graft: Paths in the image and the local files or directories copied to them
+    :param str label: Volume label
+    :param int size: Size of the image in bytes, defaults to the smallest size that fits
+    :param int fat_type: 12, 16, or 32, defaults to the smallest type that fits
+    :returns: The layout of the image
+    :rtype: DataHolder
+
+    When SOURCE_DATE_EPOCH is set it is used for the timestamps and the volume
+    serial number, so that the image is reproducible.
+    """
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    epoch = int(epoch) if epoch else None
+    img = FATImage(label=label, volume_id=epoch, timestamp=epoch)
+    if rootdir:
+        img.add_tree(rootdir)
+    for imgpath, filename in (graft or {}).items():
+        img.add(imgpath, filename)
+    return img.write(outfile, size=size, fat_type=fat_type)
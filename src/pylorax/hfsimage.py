@@ -0,0 +1,510 @@
+#
+# hfsimage.py - write HFS+ filesystem images without mounting them
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.hfsimage")
+
+import fnmatch
+import hashlib
+import os
+import struct
+import time
+import unicodedata
+from collections import deque
+
+from pylorax.base import DataHolder
+from pylorax.sysutils import copy_into
+
+# For details of the format see Technical Note TN1150: HFS Plus Volume Format
+BLOCK_SIZE = 4096
+NODE_SIZE = 4096
+VOLUME_HEADER_OFFSET = 1024
+
+# Seconds between 1904-01-01, the HFS epoch, and 1970-01-01
+HFS_EPOCH_OFFSET = 2082844800
+
+# Catalog node IDs
+ROOT_PARENT_ID = 1
+ROOT_FOLDER_ID = 2
+FIRST_USER_ID = 16
+
+FOLDER_RECORD = 1
+FILE_RECORD = 2
+FOLDER_THREAD_RECORD = 3
+FILE_THREAD_RECORD = 4
+
+# B-tree node kinds
+LEAF_NODE = -1
+INDEX_NODE = 0
+HEADER_NODE = 1
+
+BT_BIG_KEYS = 0x02
+BT_VARIABLE_INDEX_KEYS = 0x04
+CATALOG_MAX_KEY_LENGTH = 516
+EXTENTS_MAX_KEY_LENGTH = 10
+
+VOLUME_UNMOUNTED = 0x0100
+FILE_THREAD_EXISTS = 0x0002
+
+# Unicode characters that are ignored when comparing names
+_IGNORABLE = set(range(0x200C, 0x2010)) | set(range(0x202A, 0x202F)) | set(range(0x206A, 0x2070)) | {0xFEFF}
+
+
+def _hfs_time(t):
+    """Return the HFS+ time of seconds since the epoch"""
+    return min(max(int(t) + HFS_EPOCH_OFFSET, 0), 0xFFFFFFFF)
+
+def _hfs_name(name):
+    """Return a name as it is stored, decomposed with : as /"""
+    name = unicodedata.normalize("NFD", name.replace(":", "/"))
+    if len(name.encode("utf-16-be")) > 255 * 2:
+        raise RuntimeError("%s is too long for an HFS+ filesystem" % name)
+    return name
+
+def _fold(name):
+    """Return the sort key of a name, like the case-insensitive order of the HFS+ catalog
+
+    This folds the case of each character and skips the ignorable ones, which
+    is the same as Apple's FastUnicodeCompare for the names used in boot images.
+    """
+    units = struct.unpack(">%dH" % (len(name.encode("utf-16-be")) // 2), name.encode("utf-16-be"))
+    key = []
+    for u in units:
+        if u in _IGNORABLE:
+            continue
+        lower = chr(u).lower() if u < 0xD800 or u > 0xDFFF else chr(u)
+        key.append(ord(lower) if len(lower) == 1 else u)
+    return tuple(key)
+
+def _uni_str(name):
+    data = name.encode("utf-16-be")
+    return struct.pack(">H", len(data) // 2) + data
+
+def _catalog_key(parent_id, name):
+    ustr = _uni_str(name)
+    return struct.pack(">HI", 4 + len(ustr), parent_id) + ustr
+
+def _fork_data(size, start, blocks):
+    extents = struct.pack(">II", start, blocks) if blocks else b""
+    return struct.pack(">QII", size, 0, blocks) + extents.ljust(64, b"\0")
+
+def _bsd_info(mode):
+    return struct.pack(">IIBBHI", 0, 0, 0, 0, mode, 0)
+
+def _btree_node(kind, height, records, flink=0, blink=0):
+    """Return a B-tree node with its records and the offsets at the end"""
+    data = bytearray(struct.pack(">IIbBHH", flink, blink, kind, height, len(records), 0))
+    offsets = []
+    for record in records:
+        offsets.append(len(data))
+        data += record
+    offsets.append(len(data))
+    tail = struct.pack(">%dH" % len(offsets), *reversed(offsets))
+    if len(data) + len(tail) > NODE_SIZE:
+        raise RuntimeError("B-tree records do not fit in a node")
+    return bytes(data.ljust(NODE_SIZE - len(tail), b"\0")) + tail
+
+def _pack_nodes(records):
+    """Split records into groups that each fit in a node"""
+    groups = [[]]
+    used = 14 + 2
+    for record in records:
+        if used + len(record) + 2 > NODE_SIZE and groups[-1]:
+            groups.append([])
+            used = 14 + 2
+        groups[-1].append(record)
+        used += len(record) + 2
+    return groups if records else []
+
+def _btree(records, max_key_length, attributes):
+    """Return the nodes of a B-tree
+
+    :param list records: (key, data) of the leaf records, in key order
+    :returns: List of the nodes, the header node is first
+    :rtype: list of bytes
+
+    The leaf nodes are followed by the index nodes of each level, the root is last.
+    """
+    nodes = [None]
+    level = []
+    height = 0
+    groups = _pack_nodes([key + data for key, data in records])
+    kind = LEAF_NODE
+    while groups:
+        height += 1
+        first = len(nodes)
+        keys = []
+        for i, group in enumerate(groups):
+            flink = first + i + 1 if i < len(groups) - 1 else 0
+            blink = first + i - 1 if i > 0 else 0
+            nodes.append(_btree_node(kind, height, group, flink, blink))
+            # The key of a record starts with its length
+            keys.append(group[0][:2 + struct.unpack_from(">H", group[0])[0]])
+        level = list(zip(keys, range(first, len(nodes))))
+        if len(level) == 1:
+            break
+        kind = INDEX_NODE
+        groups = _pack_nodes([key + struct.pack(">I", node) for key, node in level])
+
+    leaves = [n for n in range(1, len(nodes)) if struct.unpack_from(">b", nodes[n], 8)[0] == LEAF_NODE]
+    if len(nodes) > (NODE_SIZE - 256) * 8:
+        raise RuntimeError("B-tree is too large for its header node map")
+    header = struct.pack(">HIIIIHHIIHIBBI64s", height, level[0][1] if level else 0, len(records),
+                         leaves[0] if leaves else 0, leaves[-1] if leaves else 0, NODE_SIZE,
+                         max_key_length, len(nodes), 0, 0, len(nodes) * NODE_SIZE, 0, 0,
+                         attributes, b"")
+    node_map = bytearray((NODE_SIZE - 256))
+    for n in range(len(nodes)):
+        node_map[n // 8] |= 0x80 >> (n % 8)
+    nodes[0] = _btree_node(HEADER_NODE, 0, [header, bytes(128), bytes(node_map)])
+    return nodes
+
+
+class HFSPlusImage(object):
+    """An HFS+ filesystem image
+
+    Add files and directories to it, then write it to a file. The catalog is
+    laid out directly, no loop devices, mounts, or external programs are used.
+    The catalog node IDs are assigned when the image is written, in catalog
+    order, and the files are stored in a single contiguous extent each.
+
+    A folder and a file can be blessed, which writes their catalog node IDs to
+    the volume header's finderInfo so that Apple's EFI can boot from it.
+    """
+    def __init__(self, label="untitled", timestamp=None, volume_id=None):
+        """
+        :param str label: Volume name
+        :param int timestamp: Time to set on all of the files and directories,
+                              defaults to their modification times
+        :param int volume_id: 64 bit volume identifier, defaults to a random one
+        """
+        self.label = _hfs_name(label or "untitled")
+        self.timestamp = timestamp
+        if volume_id is None:
+            volume_id = struct.unpack(">Q", os.urandom(8))[0]
+        self.volume_id = volume_id & 0xFFFFFFFFFFFFFFFF
+        self.root = self._node(self.label, None, is_dir=True, mtime=time.time())
+        self.blessed = None
+
+    def _node(self, name, source, is_dir, mtime, size=0, data=None):
+        if self.timestamp is not None:
+            mtime = self.timestamp
+        return DataHolder(name=name, source=source, data=data, is_dir=is_dir, mtime=mtime,
+                          size=size, children={} if is_dir else None, cnid=0, start=0, blocks=0)
+
+    def _lookup(self, imgpath):
+        node = self.root
+        for part in [p for p in imgpath.split("/") if p]:
+            if not node.is_dir:
+                return None
+            node = node.children.get(_fold(_hfs_name(part)))
+            if node is None:
+                return None
+        return node
+
+    def _mkdir(self, imgpath):
+        """Return the directory node of a path in the image, creating it if needed"""
+        node = self.root
+        for part in [p for p in imgpath.split("/") if p]:
+            name = _hfs_name(part)
+            child = node.children.get(_fold(name))
+            if child is None:
+                child = self._node(name, None, is_dir=True, mtime=time.time())
+                node.children[_fold(name)] = child
+            elif not child.is_dir:
+                raise RuntimeError("%s is a file in the HFS+ image" % imgpath)
+            node = child
+        return node
+
+    def _add_node(self, imgpath, node):
+        parent, _, name = imgpath.strip("/").rpartition("/")
+        parent = self._mkdir(parent)
+        node.name = _hfs_name(name)
+        existing = parent.children.get(_fold(node.name))
+        if existing is not None and existing.is_dir:
+            raise RuntimeError("%s is a directory in the HFS+ image" % imgpath)
+        parent.children[_fold(node.name)] = node
+
+    def _add_file(self, imgpath, filename):
+        st = os.stat(filename)
+        self._add_node(imgpath, self._node("", filename, is_dir=False, mtime=st.st_mtime, size=st.st_size))
+
+    def add_tree(self, rootdir, imgpath=""):
+        """Copy the contents of a directory into a directory in the image
+
+        :param str rootdir: Local directory to copy, symlinks are followed
+        :param str imgpath: Directory in the image to copy it to
+        """
+        top = self._mkdir(imgpath)
+        top.mtime = self.timestamp if self.timestamp is not None else os.stat(rootdir).st_mtime
+        for entry in sorted(os.scandir(rootdir), key=lambda e: e.name):
+            if entry.is_dir():
+                self.add_tree(entry.path, "/".join([imgpath, entry.name]))
+            else:
+                self._add_file("/".join([imgpath, entry.name]), entry.path)
+
+    def add(self, imgpath, filename):
+        """Add a file or directory to the image, the same way as a graft
+
+        :param str imgpath: Path in the image
+        :param str filename: Local file or directory
+
+        Directories are copied into imgpath, if imgpath ends with a / files
+        are copied into it, otherwise the file is copied to imgpath.
+        """
+        if os.path.isdir(filename):
+            self.add_tree(filename, imgpath)
+        elif imgpath.endswith("/"):
+            self._add_file(imgpath + os.path.basename(filename), filename)
+        else:
+            self._add_file(imgpath, filename)
+
+    def add_data(self, imgpath, data):
+        """Add a file with the contents of data to the image
+
+        :param str imgpath: Path in the image
+        :param bytes data: Contents of the file
+        """
+        self._add_node(imgpath, self._node("", None, is_dir=False, mtime=time.time(),
+                                           size=len(data), data=data))
+
+    def copy(self, imgpath, newpath):
+        """Copy a file that is already in the image to another path
+
+        :param str imgpath: Path of the file in the image
+        :param str newpath: Path of the copy, if it ends with a / the file is copied into it
+        """
+        node = self._lookup(imgpath)
+        if node is None or node.is_dir:
+            raise RuntimeError("%s is not a file in the HFS+ image" % imgpath)
+        if newpath.endswith("/"):
+            newpath += imgpath.rstrip("/").rpartition("/")[2]
+        self._add_node(newpath, self._node("", node.source, is_dir=False, mtime=node.mtime,
+                                           size=node.size, data=node.data))
+
+    def glob(self, pattern):
+        """Return the paths in the image that match a pattern, like glob.glob
+
+        :param str pattern: Pattern with a shell wildcard in each part of the path
+        :returns: Sorted list of the matching paths
+        :rtype: list of str
+        """
+        matches = [("", self.root)]
+        for part in [p for p in pattern.split("/") if p]:
+            matches = [(path + "/" + c.name if path else c.name, c)
+                       for path, node in matches if node.is_dir
+                       for c in node.children.values() if fnmatch.fnmatchcase(c.name, part)]
+        return sorted(path for path, _ in matches)
+
+    def bless(self, folder, filename):
+        """Bless a folder and a file in it, so Apple's EFI boots the file
+
+        :param str folder: Path of the folder in the image
+        :param str filename: Path of the file in the image
+
+        The catalog node IDs are written to the finderInfo of the volume
+        header when the image is written.
+        """
+        if not getattr(self._lookup(folder), "is_dir", False):
+            raise RuntimeError("%s is not a folder in the HFS+ image" % folder)
+        if getattr(self._lookup(filename), "is_dir", True):
+            raise RuntimeError("%s is not a file in the HFS+ image" % filename)
+        self.blessed = (folder, filename)
+
+    def cnid(self, imgpath):
+        """Return the catalog node ID of a path in the image, after it has been written"""
+        node = self._lookup(imgpath)
+        if node is None or not node.cnid:
+            raise RuntimeError("%s has no catalog node ID in the HFS+ image" % imgpath)
+        return node.cnid
+
+    def _catalog(self):
+        """Assign the catalog node IDs and return the catalog records in key order"""
+        self.root.cnid = ROOT_FOLDER_ID
+        next_id = FIRST_USER_ID
+        queue = deque([(ROOT_PARENT_ID, self.root)])
+        dirs = []
+        records = []
+        files = []
+        while queue:
+            parent_id, d = queue.popleft()
+            dirs.append(d)
+            children = [c for _, c in sorted(d.children.items())]
+            for c in children:
+                c.cnid = next_id
+                next_id += 1
+                if c.is_dir:
+                    queue.append((d.cnid, c))
+                else:
+                    files.append(c)
+            records.append(((parent_id, _fold(d.name)), _catalog_key(parent_id, d.name),
+                            self._folder_record(d, len(children))))
+            records.append(((d.cnid, ()), _catalog_key(d.cnid, ""),
+                            struct.pack(">hhI", FOLDER_THREAD_RECORD, 0, parent_id) + _uni_str(d.name)))
+            for c in children:
+                if c.is_dir:
+                    continue
+                # The file record is filled in once its data is allocated
+                records.append(((d.cnid, _fold(c.name)), _catalog_key(d.cnid, c.name), c))
+                records.append(((c.cnid, ()), _catalog_key(c.cnid, ""),
+                                struct.pack(">hhI", FILE_THREAD_RECORD, 0, d.cnid) + _uni_str(c.name)))
+        records.sort(key=lambda r: r[0])
+        return records, dirs, files, next_id
+
+    def _folder_record(self, node, valence):
+        date = _hfs_time(node.mtime)
+        return struct.pack(">hHIIIIIII", FOLDER_RECORD, 0, valence, node.cnid, date, date, date, date, 0) \
+               + _bsd_info(0o40755) + bytes(32) + struct.pack(">II", 0, 0)
+
+    def _file_record(self, node):
+        date = _hfs_time(node.mtime)
+        return struct.pack(">hHIIIIIII", FILE_RECORD, FILE_THREAD_EXISTS, 0, node.cnid, date, date, date, date, 0) \
+               + _bsd_info(0o100644) + bytes(32) + struct.pack(">II", 0, 0) \
+               + _fork_data(node.size, node.start, node.blocks) + _fork_data(0, 0, 0)
+
+    def write(self, outfile, size=None):
+        """Write the image
+
+        :param str outfile: Path to write the image to
+        :param int size: Size of the image in bytes, defaults to the smallest size that fits
+        :returns: The layout of the image, with total_blocks, free_blocks, and the next_cnid
+        :rtype: DataHolder
+
+        Raises RuntimeError if the files do not fit
+        """
+        start = time.time()
+        records, dirs, files, next_id = self._catalog()
+        for f in files:
+            f.blocks = -(-f.size // BLOCK_SIZE)
+        data_blocks = sum(f.blocks for f in files)
+
+        # The catalog only depends on the names, the file records are the same size
+        # before the data is allocated
+        catalog_nodes = len(_btree([(key, self._file_record(r) if isinstance(r, DataHolder) else r)
+                                    for _, key, r in records], CATALOG_MAX_KEY_LENGTH,
+                                   BT_BIG_KEYS|BT_VARIABLE_INDEX_KEYS))
+        catalog_blocks = catalog_nodes * NODE_SIZE // BLOCK_SIZE
+        extents_blocks = NODE_SIZE // BLOCK_SIZE
+
+        # The first block has the volume header, the last has the alternate header
+        used = 2 + extents_blocks + catalog_blocks + data_blocks
+        if size:
+            total_blocks = size // BLOCK_SIZE
+        else:
+            total_blocks = used
+            while total_blocks < used + -(-total_blocks // (8 * BLOCK_SIZE)):
+                total_blocks += 1
+        allocation_blocks = -(-total_blocks // (8 * BLOCK_SIZE))
+        used += allocation_blocks
+        if used > total_blocks or total_blocks > 0xFFFFFFFF:
+            raise RuntimeError("The files do not fit in an HFS+ image of %s bytes" % size)
+
+        # Allocate the special files, then the file data, in contiguous blocks
+        allocation_start = 1
+        extents_start = allocation_start + allocation_blocks
+        catalog_start = extents_start + extents_blocks
+        block = catalog_start + catalog_blocks
+        for f in files:
+            f.start = block if f.blocks else 0
+            block += f.blocks
+
+        catalog = _btree([(key, self._file_record(r) if isinstance(r, DataHolder) else r)
+                          for _, key, r in records], CATALOG_MAX_KEY_LENGTH,
+                         BT_BIG_KEYS|BT_VARIABLE_INDEX_KEYS)
+        extents = _btree([], EXTENTS_MAX_KEY_LENGTH, BT_BIG_KEYS)
+
+        bitmap = bytearray(allocation_blocks * BLOCK_SIZE)
+        for b in list(range(block)) + [total_blocks - 1]:
+            bitmap[b // 8] |= 0x80 >> (b % 8)
+
+        finder_info = [0] * 8
+        if self.blessed:
+            folder, filename = self.blessed
+            finder_info[0] = finder_info[5] = self._lookup(folder).cnid
+            finder_info[1] = self._lookup(filename).cnid
+        finder_info[6], finder_info[7] = self.volume_id >> 32, self.volume_id & 0xFFFFFFFF
+
+        date = _hfs_time(self.timestamp if self.timestamp is not None else time.time())
+        header = struct.pack(">2sHI4s15IQ8I", b"H+", 4, VOLUME_UNMOUNTED, b"10.0", 0,
+                             date, date, 0, date, len(files), len(dirs) - 1, BLOCK_SIZE,
+                             total_blocks, total_blocks - used, block, 65536, 65536, next_id,
+                             1, 1, *finder_info)
+        header += _fork_data(allocation_blocks * BLOCK_SIZE, allocation_start, allocation_blocks)
+        header += _fork_data(extents_blocks * BLOCK_SIZE, extents_start, extents_blocks)
+        header += _fork_data(catalog_blocks * BLOCK_SIZE, catalog_start, catalog_blocks)
+        header += _fork_data(0, 0, 0) + _fork_data(0, 0, 0)
+
+        fd = os.open(outfile, os.O_RDWR|os.O_CREAT|os.O_TRUNC|os.O_CLOEXEC, 0o644)
+        try:
+            os.ftruncate(fd, total_blocks * BLOCK_SIZE)
+            os.pwrite(fd, header, VOLUME_HEADER_OFFSET)
+            os.pwrite(fd, header, total_blocks * BLOCK_SIZE - VOLUME_HEADER_OFFSET)
+            os.pwrite(fd, bytes(bitmap), allocation_start * BLOCK_SIZE)
+            os.pwrite(fd, b"".join(extents), extents_start * BLOCK_SIZE)
+            os.pwrite(fd, b"".join(catalog), catalog_start * BLOCK_SIZE)
+            for f in files:
+                if f.data is not None:
+                    os.pwrite(fd, f.data, f.start * BLOCK_SIZE)
+                elif f.blocks:
+                    copy_into(f.source, fd, f.start * BLOCK_SIZE, f.size)
+        finally:
+            os.close(fd)
+
+        logger.debug("wrote HFS+ image %s, %d bytes, %d of %d blocks used, in %.2fs", outfile,
+                     total_blocks * BLOCK_SIZE, used, total_blocks, time.time() - start)
+        return DataHolder(total_blocks=total_blocks, free_blocks=total_blocks - used,
+                          catalog_nodes=len(catalog), next_cnid=next_id)
+
+
+def source_date_epoch_id(label):
+    """Return a volume identifier made from SOURCE_DATE_EPOCH and the label, or None"""
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if not epoch:
+        return None
+    return struct.unpack(">Q", hashlib.sha256(("%s %s" % (epoch, label)).encode("utf-8")).digest()[:8])[0]
+
+def mkhfsplusimg(outfile, rootdir=None, graft=None, label="", size=None):
+    """Write an HFS+ filesystem image of a directory and grafts without mounting it
+
+    :param str outfile: Path to write the image to
+    :param str rootdir: Directory to copy to the root of the image, or None
+    :param dict graft: Paths in the image and the local files or directories copied to them
+    :param str label: Volume name
+    :param int size: Size of the image in bytes, defaults to the smallest size that fits
+    :returns: The layout of the image
+    :rtype: DataHolder
+
+    When SOURCE_DATE_EPOCH is set it is used for the timestamps and the volume
+    identifier, so that the image is reproducible.
+    """
+    img = new_hfsplus_image(label)
+    if rootdir:
+        img.add_tree(rootdir)
+    for imgpath, filename in (graft or {}).items():
+        img.add(imgpath, filename)
+    return img.write(outfile, size=size)
+
+def new_hfsplus_image(label=""):
+    """Return an empty HFSPlusImage, using SOURCE_DATE_EPOCH if it is set
+
+    :param str label: Volume name
+    :rtype: HFSPlusImage
+    """
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    return HFSPlusImage(label=label, timestamp=int(epoch) if epoch else None,
+                        volume_id=source_date_epoch_id(label))
@@ -0,0 +1,213 @@
+#
+# imgcache.py - cache of installed disk and filesystem images
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.imgcache")
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+from urllib.request import urlopen
+
+from pylorax.sysutils import joinpaths, clone_file
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of a file's contents
+
+    :param str path: File to hash
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024**2)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _fetch(url, timeout=60):
+    """Return the contents of a http, https, ftp, or file url"""
+    with urlopen(url, timeout=timeout) as f:
+        return f.read()
+
+
+def hash_url(url):
+    """Return the sha256 hex digest of the contents of a url
+
+    :param str url: The url to download
+    :rtype: str
+    """
+    return hashlib.sha256(_fetch(url)).hexdigest()
+
+
+def repo_state(baseurl=None, mirrorlist=None, metalink=None):
+    """Return a digest that changes when the metadata of a repository changes
+
+    :param str baseurl: Url of the repository
+    :param str mirrorlist: Url of a mirrorlist, used when there is no baseurl
+    :param str metalink: Url of a metalink, used when there is no baseurl
+    :returns: sha256 hex digest
+    :rtype: str
+
+    The repomd.xml of the repository lists the checksums of all of the other
+    metadata files, so it is the only file that needs to be downloaded. A metalink
+    already includes the checksum of the current repomd.xml, and the first mirror
+    in a mirrorlist is used as the baseurl.
+    Raises RuntimeError if the state cannot be found.
+    """
+    if not baseurl and metalink:
+        data = _fetch(metalink).decode("utf-8", "replace")
+        m = re.search(r'<hash type="sha256">([0-9a-fA-F]+)</hash>', data)
+        if not m:
+            raise RuntimeError("No repomd.xml checksum in metalink %s" % metalink)
+        return m.group(1).lower()
+    if not baseurl and mirrorlist:
+        data = _fetch(mirrorlist).decode("utf-8", "replace")
+        mirrors = [l.strip() for l in data.splitlines() if l.strip() and not l.startswith("#")]
+        if not mirrors:
+            raise RuntimeError("No mirrors in mirrorlist %s" % mirrorlist)
+        baseurl = mirrors[0]
+    if not baseurl:
+        raise RuntimeError("Repository has no baseurl, mirrorlist, or metalink")
+    return hash_url(baseurl.rstrip("/") + "/repodata/repomd.xml")
+
+
+class ImageCache(object):
+    """A store of installed images, keyed by the inputs of the installation
+
+    The key is calculated by the caller from everything that changes the
+    result of the installation, the kickstart, the state of the repositories,
+    the installer, and the image options. Images are copied in and out of the
+    cache with clone_file so they stay sparse, and when the filesystem supports
+    reflinks the copies are instant and share their blocks with the cache.
+
+    Images are added with an atomic rename, and the least recently used images
+    are removed when the store is larger than its size budget.
+    """
+    def __init__(self, cachedir, size=50*1024**3):
+        """
+        :param str cachedir: Directory to store the images in
+        :param int size: Maximum space used by the store, in bytes
+        """
+        self.cachedir = cachedir
+        self.size = size
+
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def _path(self, key):
+        """Return the path to an image in the store"""
+        return joinpaths(self.cachedir, key + ".img")
+
+    def get(self, key, dest):
+        """Copy a cached image to dest
+
+        :param str key: Cache key of the image
+        :param str dest: Path to write the image to
+        :returns: True if the image was in the cache
+        :rtype: bool
+        """
+        path = self._path(key)
+        try:
+            # The mtime is used to find the least recently used images
+            os.utime(path)
+            reflinked = clone_file(path, dest)
+        except FileNotFoundError:
+            logger.info("image cache: %s is not cached", key)
+            return False
+        logger.info("image cache: %s %s from %s", "reflinked" if reflinked else "copied", dest, path)
+        return True
+
+    def put(self, key, src, info=None):
+        """Add an image to the cache
+
+        :param str key: Cache key of the image
+        :param str src: Path of the image to store
+        :param dict info: Description of the image, written next to it as key.json
+
+        Images that use more space than the size budget are not stored.
+        Raises OSError if the image could not be stored, eg. when the disk is full.
+        """
+        used = os.stat(src).st_blocks * 512
+        if used > self.size:
+            logger.info("image cache: %s uses %d MiB, more than the cache size, not storing it",
+                        src, used // 1024**2)
+            return
+        path = self._path(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            clone_file(src, tmp)
+            with open(joinpaths(self.cachedir, key + ".json"), "w") as f:
+                json.dump(dict(info or {}, created=time.time()), f, indent=4, sort_keys=True, default=str)
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        logger.info("image cache: stored %s as %s", src, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used images until the store fits in its size budget
+
+        Sparse images are counted by the space they use, not by their size. Only one
+        process evicts images at a time, if another one is already doing it this
+        returns immediately.
+        """
+        lock_fd = os.open(joinpaths(self.cachedir, ".lock"), os.O_RDWR|os.O_CREAT|os.O_CLOEXEC, 0o644)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            entries = []
+            total = 0
+            for f in os.listdir(self.cachedir):
+                if not f.endswith(".img"):
+                    continue
+                path = joinpaths(self.cachedir, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_blocks * 512, path))
+                total += st.st_blocks * 512
+
+            if total <= self.size:
+                return
+            entries.sort()
+            removed = 0
+            for _mtime, size, path in entries:
+                if total <= self.size:
+                    break
+                for p in (path, path[:-4] + ".json"):
+                    try:
+                        os.unlink(p)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                removed += 1
+            logger.info("image cache: removed %d least recently used images", removed)
+        finally:
+            os.close(lock_fd)
@@ -20,7 +20,15 @@
 import logging
 logger = logging.getLogger("pylorax.imgutils")
 
+import ctypes
+import errno
+import hashlib
+import json
 import os, tempfile
+import re
+import stat
+import struct
+import tarfile
 from os.path import join, dirname
 from subprocess import Popen, PIPE, CalledProcessError
 import sys
@@ -29,21 +37,27 @@ import traceback
 import multiprocessing
 from time import sleep
 import shutil
-
-from pylorax.sysutils import cpfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+from pylorax.base import DataHolder
+from pylorax.sysutils import cpfile, copy_tree
+from pylorax.checksum import HashingWriter, record_checksum, tee_copy
+from pylorax.fatimage import mkfatimg
+from pylorax.hfsimage import mkhfsplusimg
 from pylorax.executils import execWithRedirect, execWithCapture
 from pylorax.executils import runcmd, runcmd_output
+from pylorax.executils import program_log, program_log_lock
 
 ######## Functions for making container images (cpio, tar, squashfs) ##########
 
-def compress(command, root, outfile, compression="xz", compressargs=None):
-    '''Make a compressed archive of the given rootdir or file.
-    command is a list of the archiver commands to run
-    compression should be "xz", "gzip", "lzma", "bzip2", or None.
+def compress_cmd(compression="xz", compressargs=None):
+    '''Return the commandline used to compress an archive.
+    compression should be "xz", "gzip", "lzma", "bzip2", "zstd", or None.
     compressargs will be used on the compression commandline.'''
-    if compression not in (None, "xz", "gzip", "lzma", "bzip2"):
+    if compression not in (None, "xz", "gzip", "lzma", "bzip2", "zstd"):
         raise ValueError("Unknown compression type %s" % compression)
-    compressargs = compressargs or ["-9"]
+    compressargs = list(compressargs or ["-9"])
     if compression == "xz":
         compressargs.insert(0, "--check=crc32")
     if compression is None:
@@ -59,58 +73,502 @@ def compress(command, root, outfile, compression="xz", compressargs=None):
     elif compression == "bzip2":
         compression = "pbzip2"
         compressargs.insert(0, "-p%d" % multiprocessing.cpu_count())
+    elif compression == "zstd":
+        compressargs[0:0] = ["-q", "-T%d" % multiprocessing.cpu_count()]
+    return [compression] + compressargs
 
-    find, archive, comp = None, None, None
+def _walk_sorted(root, name="."):
+    """Return the (name, path) of root and everything under it, in sorted pre-order
 
+    :param str root: Directory to walk
+    :param str name: Name of the root directory in the archive
+    """
+    entries = [(name, root)]
+    def _scan(path, name):
+        for e in sorted(os.scandir(path), key=lambda e: e.name):
+            ename = name + "/" + e.name
+            entries.append((ename, e.path))
+            if e.is_dir(follow_symlinks=False):
+                _scan(e.path, ename)
+    _scan(root, name)
+    return entries
+
+def _write_compressed(outfile, compression, compressargs, write_archive):
+    """Run write_archive with a file object that is compressed into outfile
+
+    :param str outfile: The file to write
+    :param str compression: Compression type passed to compress_cmd, or None
+    :param list compressargs: Arguments for the compression command
+    :param write_archive: Function that writes the archive to the file object passed to it
+    :returns: The return code of the compression command, 0 if it isn't compressed, or 1 on error
+    :rtype: int
+
+    The output is hashed while it is written and the checksum recorded for the
+    CHECKSUM manifest.
+    """
+    comp = None
     try:
+        with open(outfile, "wb") as fout:
+            if compression is not None:
+                sha256 = hashlib.sha256()
+                comp = Popen(compress_cmd(compression, compressargs or ["-9"]), stdin=PIPE, stdout=PIPE)
+                errors = []
+                def copy_output():
+                    try:
+                        tee_copy(comp.stdout, fout, sha256)
+                    except OSError as e:
+                        errors.append(e)
+                        comp.kill()
+                copier = threading.Thread(target=copy_output)
+                copier.start()
+                try:
+                    write_archive(comp.stdin)
+                    comp.stdin.close()
+                    rc = comp.wait()
+                except BaseException:
+                    # Stop the compressor, otherwise the copy thread waits for its output forever
+                    comp.kill()
+                    try:
+                        comp.stdin.close()
+                    except OSError:
+                        pass
+                    comp.wait()
+                    raise
+                finally:
+                    copier.join()
+                    comp.stdout.close()
+                if errors:
+                    raise errors[0]
+                hexdigest = sha256.hexdigest()
+            else:
+                writer = HashingWriter(fout)
+                write_archive(writer)
+                rc = 0
+                hexdigest = writer.hexdigest()
+        if rc == 0:
+            record_checksum(outfile, hexdigest)
+        return rc
+    except OSError as e:
+        logger.error(e)
+        if comp:
+            comp.kill()
+            comp.wait()
+        return 1
+
+class CpioWriter(object):
+    """Write a cpio archive in the newc format, the format used by the kernel's initramfs
+
+    Entries are written in sorted order, with the same names as ``find . | cpio``,
+    and the inode numbers are assigned in that order. When SOURCE_DATE_EPOCH is
+    set it is used as the latest mtime of the entries. The data of hard linked
+    files is stored with the last link, like GNU cpio does.
+    """
+    def __init__(self, fobj):
+        """
+        :param fobj: File object to write the archive to
+        """
+        self.fobj = fobj
+        self.offset = 0
+        self.max_mtime = None
+        if "SOURCE_DATE_EPOCH" in os.environ:
+            self.max_mtime = int(os.environ["SOURCE_DATE_EPOCH"])
+
+    def _write(self, data):
+        self.fobj.write(data)
+        self.offset += len(data)
+
+    def _pad(self):
+        if self.offset % 4:
+            self._write(b"\0" * (4 - self.offset % 4))
+
+    def _header(self, name, ino, mode, uid, gid, nlink, mtime, size, rdev=0):
+        # newc cannot store times before the epoch, use the epoch like GNU cpio
+        mtime = max(mtime, 0)
+        fields = [ino, mode, uid, gid, nlink, mtime, size,
+                  0, 0, os.major(rdev), os.minor(rdev), len(name) + 1, 0]
+        if any(f > 0xFFFFFFFF for f in fields):
+            raise RuntimeError("%s is too large for a newc cpio archive" % os.fsdecode(name))
+        name = name + b"\0"
+        self._write(b"070701" + b"".join(b"%08X" % f for f in fields) + name)
+        self._pad()
+
+    def write_tree(self, root):
+        """Add a directory, or a single file, to the archive
+
+        :param str root: Directory or file to add
+
+        The names of a directory's entries are relative to the directory, a single
+        file is stored using its basename.
+        """
         if os.path.isdir(root):
-            logger.debug("find %s -print0 |%s | %s %s > %s", root, " ".join(command),
-                    compression, " ".join(compressargs), outfile)
+            entries = [(os.fsencode(name), path) for name, path in _walk_sorted(root)]
+        else:
+            entries = [(os.fsencode(os.path.basename(root)), root)]
+
+        stats = [os.lstat(path) for _name, path in entries]
+
+        # Number the inodes and find the last link of each hard linked file
+        inodes = {}
+        last_link = {}
+        for idx, st in enumerate(stats):
+            key = (st.st_dev, st.st_ino)
+            if key not in inodes:
+                inodes[key] = [len(inodes) + 1, 0]
+            inodes[key][1] += 1
+            last_link[key] = idx
+
+        for idx, ((name, path), st) in enumerate(zip(entries, stats)):
+            key = (st.st_dev, st.st_ino)
+            ino, links = inodes[key]
+            mtime = int(st.st_mtime)
+            if self.max_mtime is not None:
+                mtime = min(mtime, self.max_mtime)
+
+            if stat.S_ISREG(st.st_mode):
+                size = st.st_size if last_link[key] == idx else 0
+                self._header(name, ino, st.st_mode, st.st_uid, st.st_gid, links, mtime, size)
+                if size:
+                    self._write_file(path, size)
+            elif stat.S_ISLNK(st.st_mode):
+                target = os.readlink(os.fsencode(path))
+                self._header(name, ino, st.st_mode, st.st_uid, st.st_gid, st.st_nlink, mtime, len(target))
+                self._write(target)
+                self._pad()
+            else:
+                self._header(name, ino, st.st_mode, st.st_uid, st.st_gid, st.st_nlink, mtime, 0, st.st_rdev)
+
+    def _write_file(self, path, size):
+        """Write size bytes of the file's data, padding it if it has been truncated"""
+        remaining = size
+        with open(path, "rb") as f:
+            while remaining:
+                data = f.read(min(remaining, 1024**2))
+                if not data:
+                    logger.warning("%s changed size while adding it to the archive", path)
+                    data = b"\0" * remaining
+                self._write(data)
+                remaining -= len(data)
+        self._pad()
+
+    def close(self):
+        """Write the trailer that ends the archive, padded to a 512 byte block like cpio does"""
+        self._header(b"TRAILER!!!", 0, 0, 0, 0, 1, 0, 0)
+        if self.offset % 512:
+            self._write(b"\0" * (512 - self.offset % 512))
+
+def mkcpio(root, outfile, compression="xz", compressargs=None):
+    '''Make a compressed newc cpio archive of the given rootdir or file.
+    compression should be "xz", "gzip", "lzma", "bzip2", "zstd", or None.
+    compressargs will be used on the compression commandline.'''
+    logger.debug("cpio %s | %s > %s", root, compression, outfile)
+    def write_archive(fobj):
+        cpio = CpioWriter(fobj)
+        cpio.write_tree(root)
+        cpio.close()
+    return _write_compressed(outfile, compression, compressargs, write_archive)
 
-            find = Popen(["find", ".", "-print0"], stdout=PIPE, cwd=root)
-            archive = Popen(command, stdin=find.stdout, stdout=PIPE, cwd=root)
+def _acl_text(value):
+    """Convert a system.posix_acl_* xattr to the text used by tar's SCHILY.acl records
+
+    Numeric ids are used, the names on the host may not match the ones in the tree.
+    """
+    tags = {0x01: "user", 0x02: "user", 0x04: "group", 0x08: "group", 0x10: "mask", 0x20: "other"}
+    entries = []
+    for offset in range(4, len(value) - 7, 8):
+        tag, perm, qualifier = struct.unpack_from("<HHI", value, offset)
+        entries.append("%s:%s:%s%s%s" % (tags.get(tag, "other"),
+                                         qualifier if tag in (0x02, 0x08) else "",
+                                         "r" if perm & 4 else "-",
+                                         "w" if perm & 2 else "-",
+                                         "x" if perm & 1 else "-"))
+    return ",".join(entries)
+
+class TarWriter(object):
+    """Write a POSIX (pax) tar archive to a stream
+
+    Entries are written in sorted order, with the same names as ``find . | tar``.
+    When selinux is True the xattrs are stored as SCHILY.xattr records, the SELinux
+    label as RHT.security.selinux and the ACLs as SCHILY.acl records, which is what
+    ``tar --selinux --acls --xattrs`` writes. Owners are stored as numeric ids, and
+    when SOURCE_DATE_EPOCH is set it is used as the latest mtime of the entries.
+    """
+    def __init__(self, fobj, selinux=True):
+        """
+        :param fobj: File object to write the archive to, it only needs a write method
+        :param bool selinux: Store the xattrs, ACLs, and SELinux labels
+        """
+        self.selinux = selinux
+        self.max_mtime = None
+        if "SOURCE_DATE_EPOCH" in os.environ:
+            self.max_mtime = int(os.environ["SOURCE_DATE_EPOCH"])
+        self.tar = tarfile.open(fileobj=fobj, mode="w|", format=tarfile.PAX_FORMAT)
+
+    @staticmethod
+    def _xattrs(path):
+        """Return the pax records for the xattrs of path"""
+        records = {}
+        try:
+            names = os.listxattr(path, follow_symlinks=False)
+        except OSError:
+            return records
+        for name in sorted(names):
+            try:
+                value = os.getxattr(path, name, follow_symlinks=False)
+            except OSError:
+                continue
+            if name == "system.posix_acl_access":
+                records["SCHILY.acl.access"] = _acl_text(value)
+            elif name == "system.posix_acl_default":
+                records["SCHILY.acl.default"] = _acl_text(value)
+            else:
+                records["SCHILY.xattr." + name] = value.decode("utf-8", "surrogateescape")
+                if name == "security.selinux":
+                    records["RHT.security.selinux"] = value.rstrip(b"\0").decode("utf-8", "surrogateescape")
+        return records
+
+    def add(self, path, name):
+        """Add a single file, directory, or other entry to the archive
+
+        :param str path: Path to the entry
+        :param str name: Name of the entry in the archive
+        """
+        info = self.tar.gettarinfo(path, name)
+        if info is None:
+            logger.debug("Skipping %s, it is a socket", path)
+            return
+        info.uname = info.gname = ""
+        if self.max_mtime is not None:
+            info.mtime = min(info.mtime, self.max_mtime)
+        if self.selinux:
+            info.pax_headers.update(self._xattrs(path))
+        if info.isreg():
+            with open(path, "rb") as f:
+                self.tar.addfile(info, f)
         else:
-            logger.debug("echo %s |%s | %s %s > %s", root, " ".join(command),
-                         compression, " ".join(compressargs), outfile)
+            self.tar.addfile(info)
 
-            archive = Popen(command, stdin=PIPE, stdout=PIPE, cwd=os.path.dirname(root))
-            archive.stdin.write(os.path.basename(root).encode("utf-8") + b"\0")
-            archive.stdin.close()
+    def write_tree(self, root, name=None):
+        """Add a directory, or a single file, to the archive
 
-        with open(outfile, "wb") as fout:
-            comp = Popen([compression] + compressargs,
-                         stdin=archive.stdout, stdout=fout)
+        :param str root: Directory or file to add
+        :param str name: Directory to store the contents of root under, eg. ./rootfs
+
+        A single file is stored using its basename.
+        """
+        if os.path.isdir(root):
+            entries = _walk_sorted(root, name or ".")
+        else:
+            entries = [(name or os.path.basename(root), root)]
+        for ename, path in entries:
+            self.add(path, ename)
+
+    def close(self):
+        """Write the end of archive blocks"""
+        self.tar.close()
+
+def mktar(root, outfile, compression="xz", compressargs=None, selinux=True, prefix=None, extra_files=None):
+    '''Make a compressed tar archive of the given rootdir or file.
+    compression should be "xz", "gzip", "lzma", "bzip2", "zstd", or None.
+    compressargs will be used on the compression commandline.
+    selinux includes the xattrs, ACLs, and SELinux labels.
+    prefix is the directory to store the contents of rootdir under, eg. "rootfs"
+    extra_files are added to the top of the archive, after rootdir.'''
+    logger.debug("tar %s | %s > %s", root, compression, outfile)
+    def write_archive(fobj):
+        tar = TarWriter(fobj, selinux)
+        tar.write_tree(root, "./" + prefix if prefix else None)
+        for f in extra_files or []:
+            tar.add(f, "./" + os.path.basename(f))
+        tar.close()
+    return _write_compressed(outfile, compression, compressargs, write_archive)
+
+# Media types of the OCI image layer for each compression type
+OCI_LAYER_TYPES = {None: "application/vnd.oci.image.layer.v1.tar",
+                   "gzip": "application/vnd.oci.image.layer.v1.tar+gzip",
+                   "zstd": "application/vnd.oci.image.layer.v1.tar+zstd"}
+
+# OCI uses the GOARCH names for architectures
+OCI_ARCHES = {"x86_64": "amd64", "aarch64": "arm64", "i686": "386", "armv7l": "arm",
+              "ppc64le": "ppc64le", "s390x": "s390x", "riscv64": "riscv64"}
+
+class OciArchiveWriter(object):
+    """Write an OCI image layout as a tar archive, the oci-archive format used by podman and skopeo
+
+    The blobs are named by their digest, which isn't known until the layer has
+    been written, so the layer is written with a placeholder tar header that is
+    replaced once it is finished. The digests of the compressed and the
+    uncompressed layer are calculated while it is being written, so the tree is
+    only read once and nothing is written to a temporary file.
+    """
+    def __init__(self, fobj):
+        """
+        :param fobj: Seekable file object to write the archive to
+        """
+        self.fobj = fobj
+        self.mtime = int(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
+        self._member("oci-layout", json.dumps({"imageLayoutVersion": "1.0.0"}).encode("utf-8"))
+        self._write_header("blobs/", 0, tarfile.DIRTYPE)
+        self._write_header("blobs/sha256/", 0, tarfile.DIRTYPE)
+
+    def _header(self, name, size, type=tarfile.REGTYPE):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.type = type
+        info.mode = 0o755 if type == tarfile.DIRTYPE else 0o644
+        info.mtime = self.mtime
+        # GNU format stores large sizes in the single header block, so it can be replaced in place
+        return info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+
+    def _write_header(self, name, size, type=tarfile.REGTYPE):
+        self.fobj.write(self._header(name, size, type))
+
+    def _pad(self):
+        offset = self.fobj.tell()
+        if offset % tarfile.BLOCKSIZE:
+            self.fobj.write(b"\0" * (tarfile.BLOCKSIZE - offset % tarfile.BLOCKSIZE))
+
+    def _member(self, name, data):
+        self._write_header(name, len(data))
+        self.fobj.write(data)
+        self._pad()
+
+    def add_blob(self, data, media_type):
+        """Add a blob to the archive and return its descriptor
+
+        :param bytes data: The blob's contents
+        :param str media_type: The blob's media type
+        :returns: The OCI descriptor of the blob
+        :rtype: dict
+        """
+        digest = "sha256:" + hashlib.sha256(data).hexdigest()
+        self._member("blobs/sha256/" + digest[7:], data)
+        return {"mediaType": media_type, "digest": digest, "size": len(data)}
+
+    def add_layer(self, root, compression="zstd", compressargs=None, selinux=True):
+        """Add a layer with the contents of a directory
+
+        :param str root: The directory to add
+        :param str compression: "gzip", "zstd", or None
+        :param list compressargs: Arguments for the compression command
+        :param bool selinux: Store the xattrs, ACLs, and SELinux labels
+        :returns: The OCI descriptor of the layer and the digest of the uncompressed layer
+        :rtype: tuple of (dict, str)
+        """
+        if compression not in OCI_LAYER_TYPES:
+            raise ValueError("OCI layers cannot use %s compression" % compression)
+        start = self.fobj.tell()
+        self._write_header("blobs/sha256/" + "0" * 64, 0)
+        blob = HashingWriter(self.fobj)
+
+        comp, copier, errors = None, None, []
+        if compression:
+            comp = Popen(compress_cmd(compression, compressargs or ["-9"]), stdin=PIPE, stdout=PIPE)
+            def copy_output():
+                try:
+                    for data in iter(lambda: comp.stdout.read(1024**2), b""):
+                        blob.write(data)
+                except OSError as e:
+                    errors.append(e)
+                    # Stop the compressor, otherwise it blocks on its output and the tar writer on its input
+                    comp.kill()
+            copier = threading.Thread(target=copy_output)
+            copier.start()
+            layer = HashingWriter(comp.stdin)
+        else:
+            layer = HashingWriter(blob)
+
+        def stop_compressor():
+            try:
+                comp.stdin.close()
+            except OSError:
+                # The compressor has already exited, the reason is reported by the caller
+                pass
+            copier.join()
+            comp.stdout.close()
             comp.wait()
 
-        # Clean up the open fds and processes
-        if find:
-            find.wait()
-            find.stdout.close()
-        archive.wait()
-        if archive.stdin:
-            archive.stdin.close()
-        if archive.stdout:
-            archive.stdout.close()
-        return comp.returncode
-    except OSError as e:
-        logger.error(e)
-        # Kill off any hanging processes
-        list(p.kill() for p in (find, archive, comp) if p)
+        try:
+            tar = TarWriter(layer, selinux)
+            tar.write_tree(root)
+            tar.close()
+        except BaseException as e:
+            if comp:
+                comp.kill()
+                stop_compressor()
+                # A broken pipe to the compressor is caused by the error writing its output
+                if errors and isinstance(e, OSError):
+                    raise errors[0] from e
+            raise
+        if comp:
+            stop_compressor()
+            if errors:
+                raise errors[0]
+            if comp.returncode:
+                raise RuntimeError("%s failed with rc=%d" % (compression, comp.returncode))
+
+        end = self.fobj.tell()
+        self.fobj.seek(start)
+        self._write_header("blobs/sha256/" + blob.hexdigest(), blob.size)
+        self.fobj.seek(end)
+        self._pad()
+        logger.info("OCI layer %s: %d MiB, %d MiB uncompressed", blob.digest,
+                    blob.size // 1024**2, layer.size // 1024**2)
+        return ({"mediaType": OCI_LAYER_TYPES[compression], "digest": blob.digest, "size": blob.size},
+                layer.digest)
+
+    def close(self, manifests):
+        """Write index.json and the end of the archive
+
+        :param list manifests: Descriptors of the image manifests
+        """
+        index = {"schemaVersion": 2,
+                 "mediaType": "application/vnd.oci.image.index.v1+json",
+                 "manifests": manifests}
+        self._member("index.json", json.dumps(index).encode("utf-8"))
+        self.fobj.write(b"\0" * tarfile.BLOCKSIZE * 2)
+        offset = self.fobj.tell()
+        if offset % tarfile.RECORDSIZE:
+            self.fobj.write(b"\0" * (tarfile.RECORDSIZE - offset % tarfile.RECORDSIZE))
+
+def mkoci(root, outfile, compression="zstd", compressargs=None, selinux=True, arch=None,
+          config=None, ref="latest"):
+    '''Make an OCI image layout archive with a single layer containing the given rootdir.
+    compression should be "gzip", "zstd", or None.
+    compressargs will be used on the compression commandline.
+    arch is the architecture of the image, it defaults to the host's architecture.
+    config is a dict of the image's execution parameters, eg. Cmd, Env, and WorkingDir.
+    ref is the image's reference name.
+    Returns 0 on success or 1 on failure.'''
+    arch = arch or os.uname().machine
+    arch = OCI_ARCHES.get(arch, arch)
+    try:
+        with open(outfile, "wb") as f:
+            oci = OciArchiveWriter(f)
+            layer, diff_id = oci.add_layer(root, compression, compressargs, selinux)
+
+            created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(oci.mtime))
+            image_config = {"created": created,
+                            "architecture": arch,
+                            "os": "linux",
+                            "config": config or {},
+                            "rootfs": {"type": "layers", "diff_ids": [diff_id]},
+                            "history": [{"created": created, "created_by": "livemedia-creator"}]}
+            config_desc = oci.add_blob(json.dumps(image_config).encode("utf-8"),
+                                       "application/vnd.oci.image.config.v1+json")
+            manifest = {"schemaVersion": 2,
+                        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                        "config": config_desc,
+                        "layers": [layer]}
+            manifest_desc = oci.add_blob(json.dumps(manifest).encode("utf-8"),
+                                         "application/vnd.oci.image.manifest.v1+json")
+            manifest_desc["platform"] = {"architecture": arch, "os": "linux"}
+            manifest_desc["annotations"] = {"org.opencontainers.image.ref.name": ref}
+            oci.close([manifest_desc])
+        return 0
+    except (OSError, RuntimeError, ValueError) as e:
+        logger.error("Failed to create OCI image %s: %s", outfile, e)
         return 1
 
-def mkcpio(root, outfile, compression="xz", compressargs=None):
-    compressargs = compressargs or ["-9"]
-    return compress(["cpio", "--null", "--quiet", "-H", "newc", "-o"],
-                    root, outfile, compression, compressargs)
-
-def mktar(root, outfile, compression="xz", compressargs=None, selinux=True):
-    compressargs = compressargs or ["-9"]
-    tar_cmd = ["tar", "--no-recursion"]
-    if selinux:
-        tar_cmd += ["--selinux", "--acls", "--xattrs"]
-    tar_cmd += ["-cf-", "--null", "-T-"]
-    return compress(tar_cmd, root, outfile, compression, compressargs)
-
 def mksquashfs(rootdir, outfile, compression="default", compressargs=None):
     '''Make a squashfs image containing the given rootdir.'''
     compressargs = compressargs or []
@@ -170,6 +628,145 @@ def mkqemu_img(outfile, size, options=None):
         options.extend(["-f", "qcow2"])
     runcmd(["qemu-img", "create"] + options + [outfile, str(size)])
 
+def image_size(path):
+    """Return the apparent size and the allocated size of a file
+
+    :param str path: Path to the file
+    :returns: (apparent size, allocated size) in bytes
+    :rtype: tuple of int
+    """
+    st = os.stat(path)
+    return (st.st_size, st.st_blocks * 512)
+
+def log_image_size(path):
+    """Log the apparent and allocated size of an image, like du -B 1 --apparent-size and du -B 1"""
+    apparent, allocated = image_size(path)
+    logger.info("%s: %d MiB apparent size, %d MiB allocated", path, apparent // 1024**2, allocated // 1024**2)
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+_libc = None
+
+def punch_hole(fd, offset, length):
+    """Deallocate part of a file, keeping its size. Reading it returns zeros.
+
+    :param int fd: File descriptor opened for writing
+    :param int offset: Start of the hole, a multiple of the filesystem block size
+    :param int length: Length of the hole
+    Raises OSError if the filesystem doesn't support it
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if _libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE|FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+def dig_holes(path, block_size=4096, chunk_size=4*1024**2):
+    """Make the zeroed blocks of an image sparse, like fallocate --dig-holes
+
+    :param str path: Path to the image
+    :param int block_size: Size of the blocks that are checked for zeros
+    :param int chunk_size: Size of the reads, a multiple of block_size
+    :returns: apparent size, allocated size before and after, bytes read, and seconds
+    :rtype: DataHolder
+
+    Only the data regions of the file are read, found with SEEK_DATA and SEEK_HOLE,
+    so an image that is already mostly sparse is scanned quickly. Runs of zeroed
+    blocks are punched out as they are found, in the same pass.
+    """
+    start = time.time()
+    apparent, allocated_before = image_size(path)
+    # bytearray.startswith compares with memcmp, comparing memoryviews is much slower
+    zeros = bytes(chunk_size)
+    zero_block = bytes(block_size)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    read = 0
+
+    fd = os.open(path, os.O_RDWR|os.O_CLOEXEC)
+    try:
+        # The run of zero blocks that hasn't been punched yet
+        run_start = run_end = 0
+        def punch():
+            if run_end > run_start:
+                punch_hole(fd, run_start, run_end - run_start)
+
+        offset = 0
+        while offset < apparent:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+                hole = os.lseek(fd, data, os.SEEK_HOLE)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                data, hole = offset, apparent
+
+            pos = data
+            while pos < hole:
+                n = os.preadv(fd, [view[:min(chunk_size, hole - pos)]], pos)
+                if n == 0:
+                    break
+                read += n
+                if buf.startswith(zeros if n == chunk_size else zeros[:n]):
+                    blocks = [(pos, n)]
+                else:
+                    blocks = [(pos + i, min(block_size, n - i)) for i in range(0, n, block_size)
+                              if buf.startswith(zero_block[:n - i], i, i + block_size)]
+                for bstart, blen in blocks:
+                    if blen < block_size and bstart + blen < apparent:
+                        continue
+                    if bstart != run_end:
+                        punch()
+                        run_start = bstart
+                    run_end = bstart + blen
+                pos += n
+            offset = hole
+        punch()
+    finally:
+        os.close(fd)
+
+    _, allocated = image_size(path)
+    seconds = time.time() - start
+    logger.info("dig_holes %s: %d MiB apparent size, %d MiB allocated before and %d MiB after, "
+                "read %d MiB in %.1fs (%.0f MiB/s)", path, apparent // 1024**2,
+                allocated_before // 1024**2, allocated // 1024**2, read // 1024**2,
+                seconds, read / 1024**2 / max(seconds, 0.001))
+    return DataHolder(apparent=apparent, allocated_before=allocated_before,
+                      allocated=allocated, read=read, seconds=seconds)
+
+def convert_image(disk_img, outfile, image_type, qemu_args=None):
+    """Convert a raw disk image with qemu-img
+
+    :param str disk_img: The raw disk image
+    :param str outfile: The image to write, it may be the same as disk_img
+    :param str image_type: qemu-img output format, eg. qcow2 or vmdk
+    :param list qemu_args: Extra arguments for qemu-img convert
+    :returns: The time taken in seconds
+    :rtype: float
+
+    qemu-img skips the zeroed and unallocated parts of the raw image while it
+    converts it, so it doesn't need to be made sparse first. The output is written
+    next to outfile and renamed over it, so replacing disk_img doesn't copy it
+    between filesystems. Raises CalledProcessError if qemu-img fails.
+    """
+    start = time.time()
+    qemu_args = list(qemu_args or [])
+    if "-O" not in qemu_args:
+        qemu_args.extend(["-O", image_type])
+    tmp_img = tempfile.mktemp(prefix="lmc-disk-", suffix=".img", dir=os.path.dirname(outfile))
+    try:
+        execWithRedirect("qemu-img", ["convert"] + qemu_args + [disk_img, tmp_img], raise_err=True)
+        os.rename(tmp_img, outfile)
+    finally:
+        if os.path.exists(tmp_img):
+            os.unlink(tmp_img)
+    seconds = time.time() - start
+    logger.info("converted %s to %s %s in %.1fs, %d MiB allocated", disk_img, image_type,
+                outfile, seconds, image_size(outfile)[1] // 1024**2)
+    return seconds
+
 def loop_waitfor(loop_dev, outfile):
     """Make sure the loop device is attached to the outfile.
 
@@ -293,12 +890,21 @@ def umount(mnt,  lazy=False, maxretry=3, retrysleep=1.0, delete=True):
         logger.debug("remove tmp mountdir %s", mnt)
     return (rv == 0)
 
-def copytree(src, dest, preserve=True):
-    '''Copy a tree of files using cp -a, thus preserving modes, timestamps,
-    links, acls, sparse files, xattrs, selinux contexts, etc.
-    If preserve is False, uses cp -R (useful for modeless filesystems)
+def copytree(src, dest, preserve=True, engine="python"):
+    '''Copy a tree of files preserving modes, timestamps, links, acls, sparse
+    files, xattrs, selinux contexts, etc.
+    If preserve is False, symlinks are followed and only the timestamps are kept
+    (useful for modeless filesystems)
+    engine "python" uses sysutils.copy_tree, which uses reflinks or copy_file_range,
+    and falls back to cp if it fails. engine "cp" uses cp -a or cp -R.
     raises CalledProcessError if copy fails.'''
     logger.debug("copytree %s %s", src, dest)
+    if engine == "python":
+        try:
+            copy_tree(src, dest, preserve)
+            return
+        except OSError as e:
+            logger.warning("copying %s to %s failed, using cp: %s", src, dest, e)
     cp = ["cp", "-a"] if preserve else ["cp", "-R", "-L", "--preserve=timestamps"]
     cp += [join(src, "."), os.path.abspath(dest)]
     runcmd(cp)
@@ -327,27 +933,253 @@ def round_to_blocks(size, blocksize):
         size += blocksize - diff
     return size
 
-# TODO: move filesystem data outside this function
+class TreeUsage(object):
+    '''The sizes of the files and directories in a set of trees, gathered in one pass.
+
+    Hard links are only counted once unless follow_symlinks is True, which is
+    used for filesystems that store every link as a copy.'''
+    def __init__(self, follow_symlinks=False):
+        self.follow_symlinks = follow_symlinks
+        self.files = []         # data size of each regular file, without holes
+        self.symlinks = []      # length of each symlink's target
+        self.dirs = []          # names of the entries in each directory
+        self.xattrs = []        # size of the extended attributes of each inode that has them
+        self.inodes = 0
+        self._seen = set()
+
+    def _xattr_size(self, path):
+        size = 0
+        try:
+            for name in os.listxattr(path, follow_symlinks=self.follow_symlinks):
+                size += len(name) + len(os.getxattr(path, name, follow_symlinks=self.follow_symlinks))
+        except OSError:
+            pass
+        return size
+
+    @staticmethod
+    def _data_size(path, st):
+        '''Return the size of the data in a file, not counting the holes in sparse files'''
+        if st.st_blocks * 512 >= st.st_size:
+            return st.st_size
+        size = 0
+        try:
+            with open(path, "rb") as f:
+                fd = f.fileno()
+                offset = 0
+                while offset < st.st_size:
+                    try:
+                        data = os.lseek(fd, offset, os.SEEK_DATA)
+                    except OSError:
+                        break       # ENXIO, no more data
+                    hole = os.lseek(fd, data, os.SEEK_HOLE)
+                    size += hole - data
+                    offset = hole
+        except OSError:
+            return st.st_size
+        return size
+
+    def _add(self, path, st):
+        '''Count an inode, returns False if it has already been counted'''
+        if not self.follow_symlinks and st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            if (st.st_dev, st.st_ino) in self._seen:
+                return False
+            self._seen.add((st.st_dev, st.st_ino))
+        self.inodes += 1
+        xattr = self._xattr_size(path)
+        if xattr:
+            self.xattrs.append(xattr)
+        if stat.S_ISREG(st.st_mode):
+            self.files.append(self._data_size(path, st) if not self.follow_symlinks else st.st_size)
+        elif stat.S_ISLNK(st.st_mode):
+            self.symlinks.append(st.st_size)
+        return True
+
+    def add(self, path):
+        '''Add a file or a directory tree
+
+        :param str path: File or directory to add
+        '''
+        st = os.stat(path) if self.follow_symlinks else os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            self._add(path, st)
+            return
+        self._add(path, st)
+        stack = [path]
+        while stack:
+            top = stack.pop()
+            names = []
+            with os.scandir(top) as it:
+                for entry in it:
+                    names.append(entry.name)
+                    try:
+                        st = entry.stat(follow_symlinks=self.follow_symlinks)
+                    except FileNotFoundError:
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        self._add(entry.path, st)
+                        stack.append(entry.path)
+                    else:
+                        self._add(entry.path, st)
+            self.dirs.append(names)
+
+    def add_dir(self, names):
+        '''Add a directory that doesn't exist yet, eg. the parents of a graft'''
+        self.inodes += 1
+        self.dirs.append(names)
+
+def _blocks(size, blocksize):
+    '''Return the number of blocks needed for size bytes'''
+    return (size + blocksize - 1) // blocksize
+
+def _ext4_journal_blocks(blocks):
+    '''The journal size mke2fs picks for a filesystem, in blocks'''
+    for limit, journal in ((2048, 0), (32768, 1024), (256*1024, 4096), (512*1024, 8192),
+                           (4096*1024, 16384), (8192*1024, 32768), (16384*1024, 65536),
+                           (32768*1024, 131072)):
+        if blocks < limit:
+            return journal
+    return 262144
+
+def _ext4_inode_ratio(size):
+    '''The bytes per inode and inode size mke2fs.conf uses for a filesystem size'''
+    if size < 3*1024**2:
+        return (8192, 128)      # floppy
+    elif size < 512*1024**2:
+        return (4096, 256)      # small
+    elif size < 4*1024**4:
+        return (16384, 256)     # default
+    elif size < 16*1024**4:
+        return (32768, 256)     # big
+    return (65536, 256)         # huge
+
+def _ext4_size(usage, blocksize):
+    '''Size of an ext4 filesystem made with the mke2fs defaults: the inode ratio
+    from mke2fs.conf for the size, 32768 blocks per group and a journal.'''
+    data = sum(_blocks(s, blocksize) for s in usage.files)
+    # Files with more than 4 extents of 128MiB need an extent block
+    data += sum(1 for s in usage.files if s > 512*1024**2)
+    # Short symlinks are stored in the inode
+    data += sum(1 for s in usage.symlinks if s >= 60)
+    for names in usage.dirs:
+        dirbytes = 24 + sum((8 + len(n.encode("utf-8", "surrogateescape")) + 3) & ~3 for n in names)
+        dirblocks = _blocks(dirbytes, blocksize)
+        # Large directories get an htree index block
+        data += dirblocks + (1 if dirblocks > 1 else 0)
+    # There is about 100 bytes of space for xattrs in a 256 byte inode
+    data += sum(1 for x in usage.xattrs if x > 96)
+    # lost+found
+    data += 4
+
+    total = data
+    for _ in range(10):
+        groups = _blocks(total, 32768)
+        ratio, inode_size = _ext4_inode_ratio(total * blocksize)
+        inodes = max(total * blocksize // ratio, usage.inodes + 16)
+        inode_table = _blocks(inodes * inode_size, blocksize)
+        # bitmaps, group descriptors and the reserved GDT blocks in the backup groups
+        backups = 1 + sum(1 for g in range(1, groups) if g == 1 or any(_is_power(g, p) for p in (3, 5, 7)))
+        gdt = _blocks(groups * 64, blocksize) + min(1024, _blocks(total * 1024 // 32768 * 64, blocksize))
+        meta = inode_table + 2 * groups + backups * gdt + _ext4_journal_blocks(total)
+        new_total = data + meta
+        if new_total <= total:
+            break
+        total = new_total
+
+    # Make sure there are enough inodes
+    ratio, _inode_size = _ext4_inode_ratio(total * blocksize)
+    total = max(total, _blocks((usage.inodes + 16) * ratio, blocksize))
+    return total * blocksize
+
+def _is_power(n, base):
+    while n > 1 and n % base == 0:
+        n //= base
+    return n == 1
+
+def _btrfs_size(usage, blocksize):
+    '''Size of a btrfs filesystem, files smaller than 2KiB are stored inline in the
+    metadata, which is duplicated.'''
+    data = sum(_blocks(s, blocksize) * blocksize for s in usage.files if s > 2048)
+    metadata = sum(21 + s for s in usage.files if s <= 2048)
+    metadata += sum(21 + s for s in usage.symlinks)
+    # inode item, extent items, and the inode ref, dir item and dir index for each name
+    metadata += usage.inodes * 160
+    metadata += sum(53 * (1 + s // (128*1024**2)) for s in usage.files if s > 2048)
+    metadata += sum(3 * (25 + 2 * len(n.encode("utf-8", "surrogateescape"))) for names in usage.dirs for n in names)
+    metadata += sum(30 + x for x in usage.xattrs)
+    # Leaves are not full, and the metadata is DUP
+    metadata = metadata * 3 // 2 * 2
+    return max(256*1024**2, (data + metadata) * 11 // 10 + 32*1024**2)
+
+_FAT_83 = re.compile(r"^[A-Za-z0-9_\-~!#$%&'(){}^@`]{1,8}(\.[A-Za-z0-9_\-~!#$%&'(){}^@`]{1,3})?$")
+
+def _vfat_size(usage, blocksize):
+    '''Size of a FAT filesystem with blocksize clusters. Symlinks are followed and
+    hard links are copies, names that aren't 8.3 need long filename entries.'''
+    clusters = sum(_blocks(s, blocksize) for s in usage.files)
+    for names in usage.dirs[1:]:
+        entries = 2 + sum(1 + (0 if _FAT_83.match(n) else _blocks(len(n), 13)) for n in names)
+        clusters += _blocks(entries * 32, blocksize)
+    root_entries = sum(1 + (0 if _FAT_83.match(n) else _blocks(len(n), 13)) for n in (usage.dirs[:1] or [[]])[0])
+    # FAT12/16 have a fixed root directory of 512 entries, FAT32 uses clusters
+    root = max(512 * 32, _blocks(root_entries * 32, blocksize) * blocksize)
+    # two FATs with 4 bytes per cluster and the reserved sectors
+    fats = 2 * _blocks(clusters * 4 + 8, 512) * 512
+    return clusters * blocksize + root + fats + 32 * 512
+
+def _hfsplus_size(usage, blocksize):
+    '''Size of an HFS+ filesystem, each name has a catalog record and a thread record.'''
+    data = sum(_blocks(s, blocksize) for s in usage.files) + len(usage.symlinks)
+    names = [n for entries in usage.dirs for n in entries]
+    catalog = sum(2 * (8 + 2 * len(n)) + 248 + 14 for n in names) + 2 * 248
+    # 8KiB catalog nodes that are 2/3 full, plus the header nodes and the extents overflow file
+    catalog = (_blocks(catalog * 3 // 2, 8192) + 2) * 8192 + 2 * 4096
+    allocation = _blocks(_blocks(data * blocksize + catalog, blocksize), 8 * blocksize) * blocksize
+    # volume header and alternate header
+    return data * blocksize + catalog + allocation + 2 * blocksize
+
 def estimate_size(rootdir, graft=None, fstype=None, blocksize=4096, overhead=256):
+    '''Estimate the size of a filesystem needed to hold a directory and the grafts.
+
+    :param str rootdir: Directory to copy into the filesystem, or None
+    :param dict graft: Paths in the image and the local files or directories copied to them
+    :param str fstype: ext4, btrfs, vfat, msdos, or hfsplus. Other types use a simple block count.
+    :param int blocksize: Block size, FAT filesystems use 2048 byte clusters
+    :param int overhead: Extra blocks to add to the estimate
+    :returns: The size in bytes
+    :rtype: int
+
+    The trees are walked once, counting hard links and holes in sparse files once,
+    along with the directory entries and extended attributes. The filesystem's
+    metadata is added using a model of its layout.
+    '''
     graft = graft or {}
-    getsize = lambda f: os.lstat(f).st_size
-    if fstype == "btrfs":
-        overhead = 64*1024 # don't worry, it's all sparse
-    if fstype == "hfsplus":
-        overhead = 200 # hack to deal with two bootloader copies
     if fstype in ("vfat", "msdos"):
         blocksize = 2048
-        getsize = lambda f: os.stat(f).st_size # no symlinks, count as copies
-    total = overhead*blocksize
-    dirlist = list(graft.values())
+    usage = TreeUsage(follow_symlinks=fstype in ("vfat", "msdos"))
     if rootdir:
-        dirlist.append(rootdir)
-    for root in dirlist:
-        for top, dirs, files in os.walk(root):
-            for f in files + dirs:
-                total += round_to_blocks(getsize(join(top,f)), blocksize)
-    if fstype == "btrfs":
-        total = max(256*1024*1024, total) # btrfs minimum size: 256MB
+        usage.add(rootdir)
+    else:
+        usage.add_dir(sorted(set(p.strip("/").split("/")[0] for p in graft)))
+    for imgpath, filename in graft.items():
+        # Count the directories in the image that the graft is copied into
+        parts = [p for p in imgpath.split("/") if p]
+        for child in parts[1:]:
+            usage.add_dir([child])
+        usage.add(filename)
+
+    if fstype == "ext4":
+        total = _ext4_size(usage, blocksize)
+    elif fstype == "btrfs":
+        total = _btrfs_size(usage, blocksize)
+    elif fstype in ("vfat", "msdos"):
+        total = _vfat_size(usage, blocksize)
+    elif fstype == "hfsplus":
+        total = _hfsplus_size(usage, blocksize)
+    else:
+        total = sum(round_to_blocks(s, blocksize) for s in usage.files)
+        total += (len(usage.dirs) + len(usage.symlinks)) * blocksize
+    # A little extra for anything the model missed
+    total = round_to_blocks(total * 102 // 100 + overhead * blocksize, blocksize)
     logger.info("Size of %s block %s fs at %s estimated to be %s", blocksize, fstype, rootdir, total)
     return total
 
@@ -384,11 +1216,12 @@ class Mount(object):
     def __exit__(self, exc_type, exc_value, tracebk):
         umount(self.mnt)
 
-def kpartx_disk_img(disk_img):
+def kpartx_disk_img(disk_img, read_only=False):
     """Attach a disk image's partitions to /dev/loopX using kpartx
 
     :param disk_img: The full path to a partitioned disk image
     :type disk_img: str
+    :param bool read_only: Attach the partitions read-only
     :returns: list of (loopXpN, size)
     :rtype: list of tuples
     """
@@ -396,7 +1229,10 @@ def kpartx_disk_img(disk_img):
     # kpartx -p p -v -a /tmp/diskV2DiCW.im
     # add map loop2p1 (253:2): 0 3481600 linear /dev/loop2 2048
     # add map loop2p2 (253:3): 0 614400 linear /dev/loop2 3483648
-    kpartx_output = runcmd_output(["kpartx", "-v", "-a", "-s", disk_img])
+    cmd = ["kpartx", "-v", "-a", "-s"]
+    if read_only:
+        cmd.append("-r")
+    kpartx_output = runcmd_output(cmd + [disk_img])
     logger.debug(kpartx_output)
 
     # list of (deviceName, sizeInBytes)
@@ -411,12 +1247,13 @@ def kpartx_disk_img(disk_img):
 
 class PartitionMount(object):
     """ Mount a partitioned image file using kpartx """
-    def __init__(self, disk_img, mount_ok=None, submount=None):
+    def __init__(self, disk_img, mount_ok=None, submount=None, read_only=False):
         """
         :param str disk_img: The full path to a partitioned disk image
         :param mount_ok: A function that is passed the mount point and
                          returns True if it should be mounted.
         :param str submount: Directory inside mount_dir to mount at
+        :param bool read_only: Attach and mount the partitions read-only
 
         If mount_ok is not set it will look for /etc/passwd
 
@@ -434,6 +1271,7 @@ class PartitionMount(object):
         self.disk_img = disk_img
         self.mount_ok = mount_ok
         self.submount = submount
+        self.read_only = read_only
         self.temp_dir = None
 
         # Default is to mount partition with /etc/passwd
@@ -441,7 +1279,7 @@ class PartitionMount(object):
             self.mount_ok = lambda mount_dir: os.path.isfile(mount_dir+"/etc/passwd")
 
         # list of (deviceName, sizeInBytes)
-        self.loop_devices = kpartx_disk_img(self.disk_img)
+        self.loop_devices = kpartx_disk_img(self.disk_img, read_only)
 
     def __enter__(self):
         # Mount the device selected by mount_ok, if possible
@@ -453,7 +1291,7 @@ class PartitionMount(object):
             mount_dir = self.temp_dir
         for dev, size in self.loop_devices:
             try:
-                mount( "/dev/mapper/"+dev, mnt=mount_dir )
+                mount( "/dev/mapper/"+dev, opts="ro" if self.read_only else "", mnt=mount_dir )
                 if self.mount_ok(mount_dir):
                     self.mount_dir = mount_dir
                     self.mount_dev = dev
@@ -544,20 +1382,149 @@ class DracutChroot(ProcMount):
         args = self._copy_conf(args)
         runcmd(["dracut"] + args, root=self.root)
 
+    def RunJobs(self, jobs, max_jobs=1):
+        """Run several dracut commands at the same time
+
+        :param jobs: The arguments for each dracut command
+        :type jobs: list of lists
+        :param int max_jobs: Maximum number of dracut processes to run at once, 0 for one per cpu
+        :raises: CalledProcessError from the first job that failed
+
+        The output of each job is logged as a single block when it finishes.
+        When a job fails the other jobs are stopped.
+        """
+        max_jobs = min(max_jobs or multiprocessing.cpu_count(), multiprocessing.cpu_count(), len(jobs))
+        if max_jobs < 2:
+            for args in jobs:
+                self.Run(args)
+            return
+
+        # --conf is copied into the chroot before starting the jobs
+        jobs = [self._copy_conf(list(args)) for args in jobs]
+        cancel = threading.Event()
+
+        def cancel_check(proc):
+            if cancel.is_set():
+                proc.terminate()
+                proc.wait()
+                return False
+            return True
+
+        def run_job(args):
+            output = ""
+            try:
+                output = execWithCapture("dracut", args, root=self.root, log_output=False,
+                                         raise_err=True, callback=cancel_check)
+            except CalledProcessError as e:
+                output = e.output
+                raise
+            finally:
+                with program_log_lock:
+                    program_log.info("dracut output for %s:", args[-1])
+                    for line in (output or "").splitlines():
+                        program_log.info(line)
+
+        logger.info("running %d dracut jobs, %d at a time", len(jobs), max_jobs)
+        with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+            futures = [executor.submit(run_job, args) for args in jobs]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            errors = [f.exception() for f in futures if f in done and f.exception()]
+            if errors:
+                cancel.set()
+                for f in futures:
+                    f.cancel()
+        if errors:
+            logger.error("dracut failed, see program.log for details")
+            raise errors[0]
+
 
 ######## Functions for making filesystem images ##########################
 
+def fsync_file(path):
+    '''Flush the data of a single file to disk'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _mcopy_grafts(outfile, rootdir, graft):
+    '''Copy rootdir and the grafts into a FAT filesystem image using mtools.'''
+    env = {"MTOOLS_SKIP_CHECK": "1"}
+
+    def mmd(imgdir):
+        parts = [p for p in imgdir.split("/") if p]
+        dirs = ["::/" + "/".join(parts[:i+1]) for i in range(len(parts))]
+        if dirs:
+            runcmd(["mmd", "-D", "s", "-i", outfile] + dirs, env_add=env)
+
+    def mcopy(sources, dest):
+        if sources:
+            runcmd(["mcopy", "-s", "-p", "-m", "-Q", "-D", "o", "-i", outfile] + sources + [dest],
+                   env_add=env)
+
+    if rootdir:
+        mcopy([join(rootdir, f) for f in sorted(os.listdir(rootdir))], "::/")
+    for imgpath, filename in graft.items():
+        if os.path.isdir(filename):
+            mmd(imgpath)
+            mcopy([join(filename, f) for f in sorted(os.listdir(filename))], "::/%s/" % imgpath.strip("/"))
+        elif imgpath[-1] == '/':
+            # Copy the file into the directory
+            mmd(imgpath)
+            mcopy([filename], "::/%s/" % imgpath.strip("/"))
+        else:
+            mmd(dirname(imgpath))
+            mcopy([filename], "::/%s" % imgpath.strip("/"))
+
+def mkfs_populate(fstype, rootdir, outfile, size, mkfsargs=None, graft=None):
+    '''Make a filesystem image and copy rootdir into it without mounting it.
+    ext4 uses mkfs.ext4 -d, btrfs uses mkfs.btrfs --rootdir, and FAT uses mtools.
+    Grafts are only supported with FAT.
+    Returns True if the image was made, False if it isn't supported or it failed.'''
+    mkfsargs = mkfsargs or []
+    graft = graft or {}
+    if fstype == "ext4" and not graft:
+        cmd = ["mkfs.ext4"] + mkfsargs + (["-d", rootdir] if rootdir else []) + [outfile]
+    elif fstype == "btrfs" and not graft:
+        cmd = ["mkfs.btrfs"] + mkfsargs + (["--rootdir", rootdir] if rootdir else []) + [outfile]
+    elif fstype in ("msdos", "vfat") and shutil.which("mcopy") and shutil.which("mmd"):
+        cmd = ["mkfs.%s" % fstype] + mkfsargs + [outfile]
+    else:
+        return False
+    if not shutil.which(cmd[0]):
+        return False
+
+    logger.debug("making %s filesystem in %s without mounting it", fstype, outfile)
+    try:
+        mksparse(outfile, size)
+        runcmd(cmd)
+        if fstype in ("msdos", "vfat"):
+            _mcopy_grafts(outfile, rootdir, graft)
+    except (CalledProcessError, OSError) as e:
+        logger.warning("Creating %s without mounting it failed, using a loop device: %s", outfile, e)
+        if getattr(e, "output", None):
+            logger.debug(e.output)
+        return False
+    return True
+
 def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="", graft=None):
     '''Generic filesystem image creation function.
     fstype should be a filesystem type - "mkfs.${fstype}" must exist.
     graft should be a dict: {"some/path/in/image": "local/file/or/dir"};
     if the path ends with a '/' it's assumed to be a directory.
+    The filesystem is populated by its mkfs, or mtools for FAT, when possible.
+    Otherwise it is mounted using a loop device and the files are copied into it.
     Will raise CalledProcessError if something goes wrong.'''
     mkfsargs = mkfsargs or []
     graft = graft or {}
     preserve = (fstype not in ("msdos", "vfat"))
     if not size:
         size = estimate_size(rootdir, graft, fstype)
+    if mkfs_populate(fstype, rootdir, outfile, size, mkfsargs, graft):
+        fsync_file(outfile)
+        return
+
     with LoopDev(outfile, size) as loopdev:
         try:
             runcmd(["mkfs.%s" % fstype] + mkfsargs + [loopdev])
@@ -575,11 +1542,18 @@ def mkfsimage(fstype, rootdir, outfile, size=None, mkfsargs=None, mountargs="",
             execWithRedirect("df", [mnt])
 
     # Make absolutely sure that the data has been written
-    runcmd(["sync"])
+    fsync_file(outfile)
 
 # convenience functions with useful defaults
 def mkdosimg(rootdir, outfile, size=None, label="", mountargs="shortname=winnt,umask=0077", graft=None):
     graft = graft or {}
+    # Write the image directly, without mounting it, unless that fails
+    try:
+        mkfatimg(outfile, rootdir, graft, label=label, size=size)
+        fsync_file(outfile)
+        return
+    except (OSError, RuntimeError) as e:
+        logger.warning("Writing FAT image %s failed, using mkfs.msdos: %s", outfile, e)
     mkfsargs = ["-n", label]
     if 'SOURCE_DATE_EPOCH' in os.environ:
         mkfsargs.extend(["-i",
@@ -599,6 +1573,13 @@ def mkbtrfsimg(rootdir, outfile, size=None, label="", mountargs="", graft=None):
 
 def mkhfsimg(rootdir, outfile, size=None, label="", mountargs="", graft=None):
     graft = graft or {}
+    # Write the image directly, without mounting it, unless that fails
+    try:
+        mkhfsplusimg(outfile, rootdir, graft, label=label, size=size)
+        fsync_file(outfile)
+        return
+    except (OSError, RuntimeError) as e:
+        logger.warning("Writing HFS+ image %s failed, using mkfs.hfsplus: %s", outfile, e)
     mkfsimage("hfsplus", rootdir, outfile, size, mountargs=mountargs,
               mkfsargs=["-v", label], graft=graft)
 
@@ -624,6 +1605,18 @@ def mkfsimage_from_disk(diskimage, fsimage, img_size=None, label="Anaconda"):
 
         mkext4img(img_mount.mount_dir, fsimage, size=img_size, label=label)
 
+# The compression arguments used by livemedia-creator when --compress-arg isn't passed
+DEFAULT_COMPRESS_ARGS = {"xz": ["-9"], "zstd": ["-19", "--long=27"]}
+
+def default_compress_args(compression):
+    """ Return the default compression arguments for the compression type
+
+    :param str compression: Compression type
+    :returns: A new list of the arguments, empty if the compression has no defaults
+    :rtype: list
+    """
+    return list(DEFAULT_COMPRESS_ARGS.get(compression, []))
+
 def default_image_name(compression, basename):
     """ Return a default image name with the correct suffix for the compression type.
 
@@ -633,5 +1626,5 @@ def default_image_name(compression, basename):
 
     If the compression is unknown it defaults to xz
     """
-    SUFFIXES = {"xz": ".xz", "gzip": ".gz", "bzip2": ".bz2", "lzma": ".lzma"}
+    SUFFIXES = {"xz": ".xz", "gzip": ".gz", "bzip2": ".bz2", "lzma": ".lzma", "zstd": ".zst"}
     return basename + SUFFIXES.get(compression, ".xz")
@@ -30,7 +30,8 @@ import tempfile
 from pylorax.executils import execWithRedirect, execReadlines
 from pylorax.imgutils import PartitionMount, mksparse, mkext4img, loop_detach
 from pylorax.imgutils import get_loop_name, dm_detach, mount, umount
-from pylorax.imgutils import mkqemu_img, mktar, mkcpio, mkfsimage_from_disk
+from pylorax.imgutils import mkqemu_img, mktar, mkcpio, mkfsimage_from_disk, mkoci
+from pylorax.imgutils import convert_image, dig_holes, log_image_size
 from pylorax.monitor import LogMonitor
 from pylorax.mount import IsoMountpoint
 from pylorax.sysutils import joinpaths, remove
@@ -77,6 +78,76 @@ def update_vagrant_metadata(path, size):
         json.dump(metadata, f, indent=4)
 
 
+def oci_image_config(runtime_config):
+    """Return the image configuration for the process settings in an OCI runtime config.json
+
+    :param str runtime_config: Path to the config.json file, or None
+    :returns: The Cmd, Env, WorkingDir, and User settings for an OCI image config
+    :rtype: dict
+    """
+    if not runtime_config:
+        return {}
+    with open(runtime_config, "r") as f:
+        process = json.load(f).get("process", {})
+    config = {}
+    if "args" in process:
+        config["Cmd"] = process["args"]
+    if "env" in process:
+        config["Env"] = process["env"]
+    if "cwd" in process:
+        config["WorkingDir"] = process["cwd"]
+    if "user" in process:
+        config["User"] = "%s:%s" % (process["user"].get("uid", 0), process["user"].get("gid", 0))
+    return config
+
+def make_oci(opts, rootfs, disk_img, compress_args):
+    """Make an OCI runtime bundle, or an OCI image layout with --oci-layout
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param str rootfs: Path to the installed root filesystem
+    :param str disk_img: The file to write
+    :param list compress_args: Arguments for the compression command
+    :returns: 0 on success
+    :rtype: int
+
+    The bundle places the filesystem under /rootfs/ and adds the json files at the top,
+    they are streamed into the archive so nothing needs to be copied first.
+    """
+    if opts.oci_layout:
+        return mkoci(rootfs, disk_img, opts.compression, compress_args,
+                     arch=opts.arch, config=oci_image_config(opts.oci_config))
+    return mktar(rootfs, disk_img, opts.compression, compress_args, prefix="rootfs",
+                 extra_files=[opts.oci_config, opts.oci_runtime])
+
+def make_vagrant(opts, box_img, disk_img, disk_size, compress_args):
+    """Package a qcow2 disk image as a Vagrant box
+
+    :param opts: options passed to livemedia-creator
+    :type opts: argparse options
+    :param str box_img: Path to the qcow2 image, it is moved into the box
+    :param str disk_img: The file to write
+    :param int disk_size: Disk size in MiB
+    :param list compress_args: Arguments for the compression command
+    :returns: 0 on success
+    :rtype: int
+    """
+    vagrant_dir = tempfile.mkdtemp(prefix="lmc-tmpdir-")
+    metadata_path = joinpaths(vagrant_dir, "metadata.json")
+    execWithRedirect("mv", ["-f", box_img, joinpaths(vagrant_dir, "box.img")], raise_err=True)
+    if opts.vagrant_metadata:
+        shutil.copy2(opts.vagrant_metadata, metadata_path)
+    else:
+        create_vagrant_metadata(metadata_path)
+    update_vagrant_metadata(metadata_path, disk_size)
+    if opts.vagrantfile:
+        shutil.copy2(opts.vagrantfile, joinpaths(vagrant_dir, "vagrantfile"))
+
+    log.info("Creating Vagrant image")
+    rc = mktar(vagrant_dir, disk_img, opts.compression, compress_args, selinux=False)
+    shutil.rmtree(vagrant_dir)
+    return rc
+
 def find_free_port(start=5900, end=5999, host="127.0.0.1"):
     """ Return first free port in range.
 
@@ -461,7 +532,7 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         # Create the sparse image
         mksparse(disk_img, disk_size * 1024**2)
 
-    log_monitor = LogMonitor(timeout=opts.timeout)
+    log_monitor = LogMonitor(timeout=opts.timeout, error_rules=opts.error_rules)
     args += ["--remotelog", "%s:%s" % (log_monitor.host, log_monitor.port)]
     cancel_funcs = [log_monitor.server.log_check]
     if cancel_func is not None:
@@ -490,7 +561,7 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
                 log.warning("Running setfiles on install tree failed: %s", str(e))
 
             if os.path.exists(disk_img):
-                execWithRedirect("du", ["-B", "1", disk_img])
+                log_image_size(disk_img)
             execWithRedirect("fstrim", ["-v", dirinstall_path])
         else:
             with PartitionMount(disk_img) as img_mount:
@@ -502,10 +573,10 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
 
                     # For image installs, run fstrim to discard unused blocks. This way
                     # unused blocks do not need to be allocated for sparse image types
-                    execWithRedirect("du", ["-B", "1", disk_img])
+                    log_image_size(disk_img)
                     execWithRedirect("fstrim", ["-v", img_mount.mount_dir])
         if os.path.exists(disk_img):
-            execWithRedirect("du", ["-B", "1", disk_img])
+            log_image_size(disk_img)
 
     except (subprocess.CalledProcessError, OSError) as e:
         log.error("Running anaconda failed: %s", e)
@@ -544,35 +615,17 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         for arg in opts.qemu_args:
             qemu_args += arg.split(" ", 1)
 
-        # convert the image to the selected format
-        if "-O" not in qemu_args:
-            qemu_args.extend(["-O", opts.image_type])
-        qemu_img = tempfile.mktemp(prefix="lmc-disk-", suffix=".img")
-        execWithRedirect("qemu-img", ["convert"] + qemu_args + [disk_img, qemu_img], raise_err=True)
-        if not opts.make_vagrant:
-            execWithRedirect("mv", ["-f", qemu_img, disk_img], raise_err=True)
-        else:
+        # convert the image to the selected format, replacing the raw image
+        convert_image(disk_img, disk_img, opts.image_type, qemu_args)
+        if opts.make_vagrant:
             # Take the new qcow2 image and package it up for Vagrant
             compress_args = []
             for arg in opts.compress_args:
                 compress_args += arg.split(" ", 1)
 
-            vagrant_dir = tempfile.mkdtemp(prefix="lmc-tmpdir-")
-            metadata_path = joinpaths(vagrant_dir, "metadata.json")
-            execWithRedirect("mv", ["-f", qemu_img, joinpaths(vagrant_dir, "box.img")], raise_err=True)
-            if opts.vagrant_metadata:
-                shutil.copy2(opts.vagrant_metadata, metadata_path)
-            else:
-                create_vagrant_metadata(metadata_path)
-            update_vagrant_metadata(metadata_path, disk_size)
-            if opts.vagrantfile:
-                shutil.copy2(opts.vagrantfile, joinpaths(vagrant_dir, "vagrantfile"))
-
-            log.info("Creating Vagrant image")
-            rc = mktar(vagrant_dir, disk_img, opts.compression, compress_args, selinux=False)
+            rc = make_vagrant(opts, disk_img, disk_img, disk_size, compress_args)
             if rc:
                 raise InstallError("novirt_install mktar failed: rc=%s" % rc)
-            shutil.rmtree(vagrant_dir)
     elif opts.make_tar:
         compress_args = []
         for arg in opts.compress_args:
@@ -584,23 +637,20 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         if rc:
             raise InstallError("novirt_install mktar failed: rc=%s" % rc)
     elif opts.make_oci:
-        # An OCI image places the filesystem under /rootfs/ and adds the json files at the top
-        # And then creates a tar of the whole thing.
         compress_args = []
         for arg in opts.compress_args:
             compress_args += arg.split(" ", 1)
 
-        shutil.copy2(opts.oci_config, ROOT_PATH)
-        shutil.copy2(opts.oci_runtime, ROOT_PATH)
-        rc = mktar(ROOT_PATH, disk_img, opts.compression, compress_args)
+        rc = make_oci(opts, dirinstall_path, disk_img, compress_args)
 
         if rc:
             raise InstallError("novirt_install mktar failed: rc=%s" % rc)
     else:
-        # Examine the image for sections that can be made sparse
-        execWithRedirect("du", ["-B", "1", disk_img])
-        execWithRedirect("fallocate", ["--dig-holes", "-v", disk_img], raise_err=True)
-        execWithRedirect("du", ["-B", "1", disk_img])
+        # Make the zeroed sections of the image sparse
+        try:
+            dig_holes(disk_img)
+        except OSError as e:
+            log.warning("Unable to make %s sparse: %s", disk_img, e)
 
     # For make_tar_disk, wrap the result in a tar file, and remove the original disk image.
     if opts.make_tar_disk:
@@ -636,7 +686,7 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
         iso_mount.umount()
         raise InstallError("ISO is missing stage2, cannot continue")
 
-    log_monitor = LogMonitor(install_log, timeout=opts.timeout)
+    log_monitor = LogMonitor(install_log, timeout=opts.timeout, error_rules=opts.error_rules)
     cancel_funcs = [log_monitor.server.log_check]
     if cancel_func is not None:
         cancel_funcs.append(cancel_func)
@@ -704,17 +754,13 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
         if rc:
             raise InstallError("virt_install failed")
     elif opts.make_oci:
-        # An OCI image places the filesystem under /rootfs/ and adds the json files at the top
-        # And then creates a tar of the whole thing.
         compress_args = []
         for arg in opts.compress_args:
             compress_args += arg.split(" ", 1)
 
-        with PartitionMount(diskimg_path, submount="rootfs") as img_mount:
-            if img_mount and img_mount.temp_dir:
-                shutil.copy2(opts.oci_config, img_mount.temp_dir)
-                shutil.copy2(opts.oci_runtime, img_mount.temp_dir)
-                rc = mktar(img_mount.temp_dir, disk_img, opts.compression, compress_args)
+        with PartitionMount(diskimg_path) as img_mount:
+            if img_mount and img_mount.mount_dir:
+                rc = make_oci(opts, img_mount.mount_dir, disk_img, compress_args)
             else:
                 rc = 1
         os.unlink(diskimg_path)
@@ -726,21 +772,9 @@ def virt_install(opts, install_log, disk_img, disk_size, cancel_func=None, tar_i
         for arg in opts.compress_args:
             compress_args += arg.split(" ", 1)
 
-        vagrant_dir = tempfile.mkdtemp(prefix="lmc-tmpdir-")
-        metadata_path = joinpaths(vagrant_dir, "metadata.json")
-        execWithRedirect("mv", ["-f", disk_img, joinpaths(vagrant_dir, "box.img")], raise_err=True)
-        if opts.vagrant_metadata:
-            shutil.copy2(opts.vagrant_metadata, metadata_path)
-        else:
-            create_vagrant_metadata(metadata_path)
-        update_vagrant_metadata(metadata_path, disk_size)
-        if opts.vagrantfile:
-            shutil.copy2(opts.vagrantfile, joinpaths(vagrant_dir, "vagrantfile"))
-
-        rc = mktar(vagrant_dir, disk_img, opts.compression, compress_args, selinux=False)
+        rc = make_vagrant(opts, disk_img, disk_img, disk_size, compress_args)
         if rc:
             raise InstallError("virt_install failed")
-        shutil.rmtree(vagrant_dir)
 
     # For make_tar_disk, wrap the result in a tar file, and remove the original disk image.
     if opts.make_tar_disk:
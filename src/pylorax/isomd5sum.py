@@ -0,0 +1,251 @@
+#
+# isomd5sum.py - implant and check the isomd5sum checksums of isos
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.isomd5sum")
+
+import hashlib
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from pylorax.base import DataHolder
+
+SECTOR_SIZE = 2048
+
+# The checksums are stored in the application use area of the primary volume descriptor
+APPDATA_OFFSET = 883
+APPDATA_SIZE = 512
+
+# The last sectors of the iso are not included in the checksum
+SKIPSECTORS = 15
+
+FRAGMENT_COUNT = 20
+FRAGMENT_SUM_SIZE = 60
+
+# implantisomd5 and checkisomd5 read 16 sectors at a time, and the fragment
+# sums are taken after the first read that starts in a new fragment.
+READ_SIZE = 16 * SECTOR_SIZE
+
+# Size of the reads done by the reader thread
+CHUNK_SIZE = 8 * 1024**2
+
+
+def _find_pvd(fd):
+    """Return the offset and contents of the primary volume descriptor"""
+    offset = 16 * SECTOR_SIZE
+    while True:
+        pvd = os.pread(fd, SECTOR_SIZE, offset)
+        if len(pvd) < SECTOR_SIZE or pvd[0] == 255:
+            raise RuntimeError("Could not find primary volume")
+        if pvd[0] == 1:
+            return offset, pvd
+        offset += SECTOR_SIZE
+
+def _fragment_ends(total_size, fragment_count):
+    """Return the (fragment, offset) where the fragment sums are taken"""
+    fragment_size = total_size // (fragment_count + 1)
+    if fragment_size == 0:
+        return []
+    ends = []
+    previous = 0
+    for offset in range(0, total_size, READ_SIZE):
+        current = offset // fragment_size
+        if current != previous:
+            ends.append((current, min(offset + READ_SIZE, total_size)))
+            previous = current
+    return ends
+
+def _fragment_sum(digest, size):
+    """Return the fragment sum, the first hex digit of each of the first size bytes"""
+    return "".join(("%x" % b)[0] for b in digest[:size])
+
+def _read_chunks(fd, size):
+    """Read the first size bytes of a file in large chunks, using a thread
+
+    :returns: Generator of (offset, data)
+
+    The next chunk is read while the previous one is being hashed.
+    """
+    chunks = queue.Queue(maxsize=4)
+    stop = threading.Event()
+
+    def reader():
+        offset = 0
+        try:
+            while offset < size and not stop.is_set():
+                data = os.pread(fd, min(CHUNK_SIZE, size - offset), offset)
+                if not data:
+                    raise RuntimeError("Short read at offset %d of %d" % (offset, size))
+                chunks.put((offset, data))
+                offset += len(data)
+            chunks.put(None)
+        except (OSError, RuntimeError) as e:
+            chunks.put(e)
+
+    try:
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+    thread = threading.Thread(target=reader, name="isomd5sum-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise RuntimeError(str(item))
+            yield item
+    finally:
+        stop.set()
+        # Let the reader finish if it is waiting to add a chunk
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+def _md5_iso(fd, appdata_offset, total_size, fragment_count):
+    """Calculate the md5 of an iso the same way as implantisomd5
+
+    :returns: (md5 hex digest, [(fragment, md5 digest)])
+
+    The application data is hashed as spaces, and the fragment sums are
+    taken at the same offsets as implantisomd5 takes them.
+    """
+    h = hashlib.md5()
+    sums = []
+    ends = _fragment_ends(total_size, fragment_count)
+    next_end = 0
+    for offset, data in _read_chunks(fd, total_size):
+        if offset < appdata_offset + APPDATA_SIZE and appdata_offset < offset + len(data):
+            data = bytearray(data)
+            start = max(appdata_offset - offset, 0)
+            end = min(appdata_offset + APPDATA_SIZE - offset, len(data))
+            data[start:end] = b" " * (end - start)
+        view = memoryview(data)
+        pos = 0
+        while next_end < len(ends) and ends[next_end][1] <= offset + len(data):
+            fragment, end = ends[next_end]
+            h.update(view[pos:end - offset])
+            pos = end - offset
+            sums.append((fragment, h.copy().digest()))
+            next_end += 1
+        h.update(view[pos:])
+    return h.hexdigest(), sums
+
+def _parse_appdata(appdata):
+    """Parse the isomd5sum values from the application data"""
+    def value(pattern):
+        m = re.search(pattern, appdata)
+        return m.group(1).decode("ascii") if m else None
+
+    md5 = value(rb"ISO MD5SUM = ([0-9a-fA-F]{32})")
+    if not md5:
+        return None
+    return DataHolder(md5=md5.lower(),
+                      skipsectors=int(value(rb"SKIPSECTORS = (\d+)") or 0),
+                      supported=value(rb"RHLISOSTATUS=(\d)") == "1",
+                      fragment_sums=value(rb"FRAGMENT SUMS = ([0-9a-fA-F]*)") or "",
+                      fragment_count=int(value(rb"FRAGMENT COUNT = (\d+)") or 0))
+
+
+def implant_isomd5(iso_path, supported=False, force=False):
+    """Implant the isomd5sum checksums into an iso, the same as implantisomd5
+
+    :param str iso_path: Path to the iso
+    :param bool supported: Set the RHLISOSTATUS supported flag
+    :param bool force: Replace checksums that are already in the iso
+    :returns: md5 hex digest
+    :rtype: str
+
+    The iso is read with large sequential reads, by a thread so that the reads
+    and the md5 calculation overlap. Raises RuntimeError if there is a problem.
+    """
+    start = time.time()
+    fd = os.open(iso_path, os.O_RDWR|os.O_CLOEXEC)
+    try:
+        pvd_offset, pvd = _find_pvd(fd)
+        appdata = pvd[APPDATA_OFFSET:APPDATA_OFFSET+APPDATA_SIZE]
+        if _parse_appdata(appdata) and not force:
+            raise RuntimeError("%s already has an md5 checksum" % iso_path)
+
+        iso_size = struct.unpack_from(">I", pvd, 84)[0] * SECTOR_SIZE
+        total_size = iso_size - SKIPSECTORS * SECTOR_SIZE
+        md5, sums = _md5_iso(fd, pvd_offset + APPDATA_OFFSET, total_size, FRAGMENT_COUNT)
+
+        size = FRAGMENT_SUM_SIZE // FRAGMENT_COUNT
+        fragment_sums = "".join(_fragment_sum(digest, size) for _, digest in sums)[:FRAGMENT_SUM_SIZE]
+        appdata = ";".join(["ISO MD5SUM = %s" % md5,
+                            "SKIPSECTORS = %d" % SKIPSECTORS,
+                            "RHLISOSTATUS=%d" % (1 if supported else 0),
+                            "FRAGMENT SUMS = %s" % fragment_sums,
+                            "FRAGMENT COUNT = %d" % FRAGMENT_COUNT,
+                            "THIS IS NOT THE SAME AS RUNNING MD5SUM ON THIS ISO!!"])
+        appdata = appdata.encode("ascii")[:APPDATA_SIZE].ljust(APPDATA_SIZE, b" ")
+        os.pwrite(fd, appdata, pvd_offset + APPDATA_OFFSET)
+    finally:
+        os.close(fd)
+
+    elapsed = time.time() - start
+    logger.info("implanted md5 %s into %s in %.1fs (%d MiB/s)", md5, iso_path, elapsed,
+                total_size / 1024**2 / max(elapsed, 0.001))
+    return md5
+
+
+def check_isomd5(iso_path):
+    """Check the isomd5sum checksums of an iso, the same as checkisomd5
+
+    :param str iso_path: Path to the iso
+    :returns: True if the md5 and the fragment sums match
+    :rtype: bool
+
+    Raises RuntimeError if the iso does not have an md5 checksum
+    """
+    fd = os.open(iso_path, os.O_RDONLY|os.O_CLOEXEC)
+    try:
+        pvd_offset, pvd = _find_pvd(fd)
+        info = _parse_appdata(pvd[APPDATA_OFFSET:APPDATA_OFFSET+APPDATA_SIZE])
+        if not info:
+            raise RuntimeError("%s does not have an md5 checksum" % iso_path)
+
+        iso_size = struct.unpack_from(">I", pvd, 84)[0] * SECTOR_SIZE
+        total_size = iso_size - info.skipsectors * SECTOR_SIZE
+        md5, sums = _md5_iso(fd, pvd_offset + APPDATA_OFFSET, total_size, info.fragment_count)
+    finally:
+        os.close(fd)
+
+    if info.fragment_count:
+        size = FRAGMENT_SUM_SIZE // info.fragment_count
+        for fragment, digest in sums:
+            if fragment > info.fragment_count:
+                break
+            expected = info.fragment_sums[(fragment - 1) * size:fragment * size]
+            if _fragment_sum(digest, size) != expected:
+                logger.error("%s fragment %d checksum does not match", iso_path, fragment)
+                return False
+
+    if md5 != info.md5:
+        logger.error("%s md5 %s does not match %s", iso_path, md5, info.md5)
+        return False
+    return True
@@ -0,0 +1,634 @@
+#
+# isoreader.py - read ISO9660 images without mounting them
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.isoreader")
+
+import calendar
+import errno
+import io
+import mmap
+import os
+import stat
+import struct
+
+from pylorax.base import DataHolder
+
+SECTOR_SIZE = 2048
+
+# Volume descriptor types
+VD_BOOT_RECORD = 0
+VD_PRIMARY = 1
+VD_SUPPLEMENTARY = 2
+VD_TERMINATOR = 255
+
+# Directory record flags
+FLAG_HIDDEN = 0x01
+FLAG_DIRECTORY = 0x02
+FLAG_ASSOCIATED = 0x04
+FLAG_MULTI_EXTENT = 0x80
+
+# El Torito platform ids
+PLATFORM_X86 = 0x00
+PLATFORM_PPC = 0x01
+PLATFORM_MAC = 0x02
+PLATFORM_EFI = 0xEF
+
+# Joliet UCS-2 escape sequences, levels 1, 2, and 3
+JOLIET_ESCAPES = (b"%/@", b"%/C", b"%/E")
+
+
+def _le16(data, offset):
+    return struct.unpack_from("<H", data, offset)[0]
+
+def _le32(data, offset):
+    return struct.unpack_from("<I", data, offset)[0]
+
+def _record_time(data, offset):
+    """Convert a 7 byte directory record timestamp to seconds since the epoch"""
+    year, month, day, hour, minute, second, gmtoff = struct.unpack_from("<6Bb", data, offset)
+    try:
+        return calendar.timegm((1900 + year, month, day, hour, minute, second)) - gmtoff * 15 * 60
+    except (ValueError, OverflowError):
+        return 0
+
+def _long_time(data, offset):
+    """Convert a 17 byte volume descriptor timestamp to seconds since the epoch"""
+    digits = bytes(data[offset:offset+16]).decode("ascii", "replace")
+    gmtoff = struct.unpack_from("<b", data, offset+16)[0]
+    try:
+        t = tuple(int(digits[i:j]) for i, j in ((0, 4), (4, 6), (6, 8), (8, 10), (10, 12), (12, 14)))
+        return calendar.timegm(t) - gmtoff * 15 * 60
+    except (ValueError, OverflowError):
+        return 0
+
+
+class ISOFile(io.RawIOBase):
+    """Read only file object for a file on an iso
+
+    The data is read directly from the iso's mmap, across all of the
+    extents of the file.
+    """
+    def __init__(self, iso, entry):
+        """
+        :param iso: The ISOReader of the iso
+        :type iso: ISOReader
+        :param entry: The file's entry, from ISOReader.stat
+        :type entry: DataHolder
+        """
+        super().__init__()
+        self.name = entry.path
+        self._mm = iso._mm
+        self._extents = [(lba * iso.block_size, length) for lba, length in entry.extents]
+        self._size = entry.size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        count = 0
+        pos = self._pos
+        ext_start = 0
+        for start, length in self._extents:
+            if count == len(view) or pos >= self._size:
+                break
+            if pos < ext_start + length:
+                skip = pos - ext_start
+                n = min(length - skip, len(view) - count)
+                view[count:count+n] = self._mm[start+skip:start+skip+n]
+                count += n
+                pos += n
+            ext_start += length
+        self._pos = pos
+        return count
+
+
+class ISOReader(object):
+    """Read the contents of an ISO9660 image without mounting it
+
+    The iso is mmapped and parsed in-process, it does not need root
+    privileges or any external programs. The names and modes come from the
+    Rock Ridge extensions when present, then from the Joliet tree, and
+    otherwise from the plain ISO9660 names, lowercased with the ;1 version
+    removed the same way the kernel shows them.
+    The El Torito boot catalog and the path table can also be read.
+
+    Paths are relative to the root of the iso, with or without a leading /.
+    Symlinks are not followed when looking up paths.
+    """
+    def __init__(self, iso_path):
+        """
+        :param str iso_path: Path to the iso
+
+        Raises RuntimeError if it is not an ISO9660 image
+        """
+        self.iso_path = iso_path
+        self._fd = os.open(iso_path, os.O_RDONLY|os.O_CLOEXEC)
+        try:
+            self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            os.close(self._fd)
+            raise RuntimeError("%s is not an ISO9660 image" % iso_path) from e
+        self._dirs = {}
+        self._copy_range = hasattr(os, "copy_file_range")
+
+        try:
+            self._read_descriptors()
+        except (RuntimeError, struct.error, IndexError) as e:
+            self.close()
+            raise RuntimeError("%s is not an ISO9660 image: %s" % (iso_path, e)) from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the iso"""
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            os.close(self._fd)
+
+    def _read_descriptors(self):
+        """Find the primary, Joliet, and El Torito volume descriptors"""
+        pvd = joliet = None
+        self._catalog_lba = None
+        offset = 16 * SECTOR_SIZE
+        while offset + SECTOR_SIZE <= len(self._mm):
+            vd = self._mm[offset:offset+SECTOR_SIZE]
+            if vd[1:6] != b"CD001":
+                break
+            if vd[0] == VD_PRIMARY and pvd is None:
+                pvd = vd
+            elif vd[0] == VD_SUPPLEMENTARY and vd[88:91] in JOLIET_ESCAPES and joliet is None:
+                joliet = vd
+            elif vd[0] == VD_BOOT_RECORD and vd[7:30] == b"EL TORITO SPECIFICATION":
+                self._catalog_lba = _le32(vd, 71)
+            elif vd[0] == VD_TERMINATOR:
+                break
+            offset += SECTOR_SIZE
+        if pvd is None:
+            raise RuntimeError("missing primary volume descriptor")
+
+        self.volume_id = pvd[40:72].decode("ascii", "replace").strip()
+        self.system_id = pvd[8:40].decode("ascii", "replace").strip()
+        self.volume_size = _le32(pvd, 80)
+        self.block_size = _le16(pvd, 128)
+        self.created = _long_time(pvd, 813)
+
+        # The SUSP skip length is set by the SP entry of the root directory's "." record
+        self._susp_skip = 0
+        self.rock_ridge = False
+        root = self._root_entry(pvd, False)
+        su = self._system_use(self._mm, root.extents[0][0] * self.block_size)
+        if su[:2] == b"SP" and su[4:6] == b"\xbe\xef":
+            self._susp_skip = su[6]
+            self.rock_ridge = True
+
+        self.joliet = joliet is not None
+        if self.rock_ridge or not self.joliet:
+            self._vd, self._ucs2 = pvd, False
+        else:
+            self._vd, self._ucs2 = joliet, True
+        self._root = self._root_entry(self._vd, self._ucs2)
+
+    def _root_entry(self, vd, ucs2):
+        """Return the entry of the root directory from a volume descriptor"""
+        root = self._record(vd, 156, ucs2)
+        root.name = ""
+        root.path = ""
+        return root
+
+    def _system_use(self, data, offset):
+        """Return the system use area of a directory record"""
+        length = data[offset]
+        name_len = data[offset+32]
+        # There is a padding byte when the length of the name is even
+        return data[offset + 33 + name_len + (1 - name_len % 2):offset + length]
+
+    def _susp(self, su):
+        """Yield the (signature, data) of the SUSP entries, following the CE continuations"""
+        areas = [su[self._susp_skip:]]
+        while areas:
+            area = areas.pop(0)
+            i = 0
+            while i + 4 <= len(area):
+                sig = bytes(area[i:i+2])
+                length = area[i+2]
+                if length < 4 or i + length > len(area):
+                    break
+                body = area[i+4:i+length]
+                if sig == b"CE":
+                    start = _le32(body, 0) * self.block_size + _le32(body, 8)
+                    areas.append(self._mm[start:start + _le32(body, 16)])
+                elif sig == b"ST":
+                    break
+                else:
+                    yield sig, body
+                i += length
+
+    def _record(self, data, offset, ucs2):
+        """Parse a directory record
+
+        :returns: The entry, or None for entries that should not be listed
+        :rtype: DataHolder
+        """
+        length = data[offset]
+        flags = data[offset+25]
+        name_len = data[offset+32]
+        raw_name = bytes(data[offset+33:offset+33+name_len])
+        is_dir = bool(flags & FLAG_DIRECTORY)
+
+        if raw_name in (b"\x00", b"\x01"):
+            name = raw_name.decode("ascii")
+        elif ucs2:
+            name = raw_name.decode("utf-16-be", "replace").split(";")[0]
+        else:
+            # The same as the kernel's map=normal, lowercase without the version
+            name = raw_name.decode("ascii", "replace").split(";")[0].lower()
+            if not is_dir and name.endswith("."):
+                name = name[:-1]
+
+        entry = DataHolder(name=name, path=None, is_dir=is_dir, is_link=False, target=None,
+                           size=_le32(data, offset+10), mode=None, uid=0, gid=0, nlink=1,
+                           mtime=_record_time(data, offset+18), hidden=bool(flags & FLAG_HIDDEN),
+                           multi_extent=bool(flags & FLAG_MULTI_EXTENT),
+                           extents=[(_le32(data, offset+2), _le32(data, offset+10))],
+                           relocated=False, child=None)
+        if flags & FLAG_ASSOCIATED:
+            return None
+
+        if self.rock_ridge and offset + length <= len(data):
+            self._rock_ridge(entry, self._system_use(data, offset))
+
+        if entry.mode is None:
+            entry.mode = (stat.S_IFDIR | 0o555) if entry.is_dir else (stat.S_IFREG | 0o444)
+        return entry
+
+    def _rock_ridge(self, entry, su):
+        """Update an entry with its Rock Ridge name, mode, symlink, and timestamps"""
+        name = None
+        link = []
+        link_continues = False
+        for sig, body in self._susp(su):
+            if sig == b"NM":
+                if body[0] & 0x06:
+                    # The current or parent directory
+                    continue
+                name = (name or "") + bytes(body[1:]).decode("utf-8", "replace")
+            elif sig == b"PX":
+                entry.mode = _le32(body, 0)
+                entry.nlink = _le32(body, 8)
+                entry.uid = _le32(body, 16)
+                entry.gid = _le32(body, 24)
+                entry.is_dir = stat.S_ISDIR(entry.mode)
+                entry.is_link = stat.S_ISLNK(entry.mode)
+            elif sig == b"SL":
+                i = 1
+                while i + 2 <= len(body):
+                    cflags, clen = body[i], body[i+1]
+                    if cflags & 0x02:
+                        part = "."
+                    elif cflags & 0x04:
+                        part = ".."
+                    elif cflags & 0x08:
+                        part = ""
+                    else:
+                        part = bytes(body[i+2:i+2+clen]).decode("utf-8", "replace")
+                    if link_continues:
+                        link[-1] += part
+                    else:
+                        link.append(part)
+                    link_continues = bool(cflags & 0x01)
+                    i += 2 + clen
+            elif sig == b"TF":
+                tflags = body[0]
+                size = 17 if tflags & 0x80 else 7
+                # The modification time follows the optional creation time
+                if tflags & 0x02:
+                    offset = 1 + (size if tflags & 0x01 else 0)
+                    if size == 17:
+                        entry.mtime = _long_time(body, offset)
+                    else:
+                        entry.mtime = _record_time(body, offset)
+            elif sig == b"CL":
+                # A deep directory that was moved, this is where it really is
+                entry.child = _le32(body, 0)
+                entry.is_dir = True
+            elif sig == b"RE":
+                entry.relocated = True
+        if name is not None:
+            entry.name = name
+        if link:
+            entry.target = "/".join(link) if link != [""] else "/"
+
+    def _read_dir(self, path, entry):
+        """Return the entries of a directory, {name: entry}"""
+        if path in self._dirs:
+            return self._dirs[path]
+
+        lba, size = entry.extents[0]
+        if entry.child is not None:
+            # Use the size from the "." record of the relocated directory
+            lba = entry.child
+            size = _le32(self._mm, lba * self.block_size + 10)
+
+        entries = {}
+        pos = lba * self.block_size
+        end = pos + size
+        current = None
+        while pos < end:
+            length = self._mm[pos]
+            if length == 0:
+                # Records do not cross sectors, the rest of this one is padding
+                pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            e = self._record(self._mm, pos, self._ucs2)
+            pos += length
+            if e is None or e.name in ("\x00", "\x01") or e.relocated:
+                continue
+            if current is not None:
+                # Further extents of a file larger than 4GiB
+                current.extents.extend(e.extents)
+                current.size += e.size
+                current.multi_extent = e.multi_extent
+                if not current.multi_extent:
+                    current = None
+                continue
+            e.path = "/".join([path, e.name]) if path else e.name
+            entries[e.name] = e
+            if e.multi_extent:
+                current = e
+        self._dirs[path] = entries
+        return entries
+
+    def stat(self, path):
+        """Return the details of a file or directory on the iso
+
+        :param str path: Path on the iso
+        :returns: An entry with name, path, is_dir, is_link, target, size, mode,
+                  uid, gid, nlink, mtime, and extents
+        :rtype: DataHolder
+
+        Raises FileNotFoundError if it is not on the iso
+        """
+        entry = self._root
+        parts = [p for p in path.split("/") if p and p != "."]
+        for i, name in enumerate(parts):
+            if not entry.is_dir:
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+            entries = self._read_dir("/".join(parts[:i]), entry)
+            if name not in entries:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            entry = entries[name]
+        return entry
+
+    def exists(self, path):
+        """Return True if the path exists on the iso"""
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def isdir(self, path):
+        """Return True if the path is a directory on the iso"""
+        try:
+            return self.stat(path).is_dir
+        except OSError:
+            return False
+
+    def isfile(self, path):
+        """Return True if the path is a regular file on the iso"""
+        try:
+            return stat.S_ISREG(self.stat(path).mode)
+        except OSError:
+            return False
+
+    def listdir(self, path=""):
+        """Return the names of the entries in a directory
+
+        :param str path: Directory on the iso
+        :rtype: list of str
+        """
+        entry = self.stat(path)
+        if not entry.is_dir:
+            raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        return list(self._read_dir(entry.path, entry))
+
+    def walk(self, path=""):
+        """Walk the directory tree, the same as os.walk
+
+        :param str path: Directory on the iso to start from
+        :returns: Generator of (dirpath, dirnames, filenames)
+        """
+        top = self.stat(path)
+        stack = [top]
+        while stack:
+            entry = stack.pop()
+            entries = self._read_dir(entry.path, entry)
+            dirs = [e for e in entries.values() if e.is_dir and not e.is_link]
+            yield (entry.path, [e.name for e in dirs],
+                   [e.name for e in entries.values() if not e.is_dir or e.is_link])
+            stack.extend(reversed(dirs))
+
+    def find(self, path=""):
+        """Return the paths of all of the files and directories under a directory
+
+        :param str path: Directory on the iso to start from
+        :rtype: list of str
+        """
+        paths = []
+        for dirpath, dirnames, filenames in self.walk(path):
+            paths.extend("/".join([dirpath, n]) if dirpath else n for n in dirnames + filenames)
+        return paths
+
+    def open(self, path):
+        """Open a file on the iso for reading
+
+        :param str path: Path on the iso
+        :returns: A binary file object
+        :rtype: io.BufferedReader
+        """
+        entry = self.stat(path)
+        if entry.is_dir:
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        return io.BufferedReader(ISOFile(self, entry), buffer_size=1024**2)
+
+    def read(self, path):
+        """Return the contents of a file on the iso
+
+        :param str path: Path on the iso
+        :rtype: bytes
+        """
+        with self.open(path) as f:
+            return f.read()
+
+    def _copy(self, entry, fd):
+        """Write the contents of a file to an open file descriptor"""
+        remaining = entry.size
+        for lba, length in entry.extents:
+            offset = lba * self.block_size
+            length = min(length, remaining)
+            remaining -= length
+            while length > 0:
+                if self._copy_range:
+                    try:
+                        n = os.copy_file_range(self._fd, fd, length, offset)
+                    except OSError:
+                        # Not supported between these filesystems, write from the mmap
+                        self._copy_range = False
+                        continue
+                else:
+                    n = os.write(fd, self._mm[offset:offset + min(length, 16*1024**2)])
+                if n == 0:
+                    raise RuntimeError("Short read of %s from %s" % (entry.path, self.iso_path))
+                offset += n
+                length -= n
+
+    def extract(self, path, dest):
+        """Extract a file or directory from the iso
+
+        :param str path: Path of the file or directory on the iso
+        :param str dest: Path to write it to, directories are extracted recursively
+
+        The mode and modification time are kept, but the extracted files are
+        always readable and writable by the user, and directories are
+        always usable by the user, so that they can be edited or removed.
+        When possible the data is copied by the kernel with copy_file_range.
+        """
+        entry = self.stat(path)
+        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+        if entry.is_link:
+            os.symlink(entry.target, dest)
+        elif entry.is_dir:
+            os.makedirs(dest, exist_ok=True)
+            dirs = [(entry, dest)]
+            for dirpath, dirnames, filenames in self.walk(entry.path):
+                rel = dirpath[len(entry.path):].lstrip("/")
+                for name in dirnames:
+                    d = os.path.join(dest, rel, name)
+                    os.makedirs(d, exist_ok=True)
+                    dirs.append((self.stat("/".join([dirpath, name])), d))
+                for name in filenames:
+                    self.extract("/".join([dirpath, name]), os.path.join(dest, rel, name))
+            # Set the directory modes and times last, after their contents are written
+            for e, d in reversed(dirs):
+                os.chmod(d, stat.S_IMODE(e.mode) | 0o700)
+                os.utime(d, (e.mtime, e.mtime))
+        elif stat.S_ISREG(entry.mode):
+            fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_CLOEXEC, 0o600)
+            try:
+                self._copy(entry, fd)
+                os.fchmod(fd, stat.S_IMODE(entry.mode) | 0o600)
+            finally:
+                os.close(fd)
+            os.utime(dest, (entry.mtime, entry.mtime))
+        else:
+            logger.debug("Skipping %s, it is not a file, directory, or symlink", entry.path)
+
+    def path_table(self):
+        """Return the entries of the little endian path table
+
+        :returns: Entries with name, extent, and parent, the 1-based index of the
+                  parent directory in the table. The root is first and has no name.
+        :rtype: list of DataHolder
+        """
+        size = _le32(self._vd, 132)
+        pos = _le32(self._vd, 140) * self.block_size
+        end = pos + size
+        table = []
+        while pos < end:
+            name_len = self._mm[pos]
+            if name_len == 0:
+                break
+            raw_name = self._mm[pos+8:pos+8+name_len]
+            if raw_name == b"\x00":
+                name = ""
+            elif self._ucs2:
+                name = raw_name.decode("utf-16-be", "replace")
+            else:
+                name = raw_name.decode("ascii", "replace").lower()
+            table.append(DataHolder(name=name, extent=_le32(self._mm, pos+2),
+                                    parent=_le16(self._mm, pos+6)))
+            pos += 8 + name_len + name_len % 2
+        return table
+
+    def boot_catalog(self):
+        """Return the entries of the El Torito boot catalog
+
+        :returns: Entries with platform, bootable, media, load_segment, system_type,
+                  sectors (512 byte), and lba (2048 byte). Empty if the iso is not bootable.
+        :rtype: list of DataHolder
+        """
+        if self._catalog_lba is None:
+            return []
+        catalog = self._mm[self._catalog_lba * SECTOR_SIZE:(self._catalog_lba + 1) * SECTOR_SIZE]
+        if len(catalog) < 64 or catalog[0] != 1 or catalog[30:32] != b"\x55\xaa":
+            raise RuntimeError("Invalid El Torito boot catalog in %s" % self.iso_path)
+
+        def boot_entry(offset, platform):
+            return DataHolder(platform=platform, bootable=catalog[offset] == 0x88,
+                              media=catalog[offset+1] & 0x0F,
+                              load_segment=_le16(catalog, offset+2),
+                              system_type=catalog[offset+4],
+                              sectors=_le16(catalog, offset+6),
+                              lba=_le32(catalog, offset+8))
+
+        entries = [boot_entry(32, catalog[1])]
+        offset = 64
+        while offset + 32 <= len(catalog) and catalog[offset] in (0x90, 0x91):
+            final = catalog[offset] == 0x91
+            platform = catalog[offset+1]
+            count = _le16(catalog, offset+2)
+            offset += 32
+            while count and offset + 32 <= len(catalog):
+                if catalog[offset] == 0x44:
+                    # Extension records are part of the previous entry
+                    offset += 32
+                    continue
+                entries.append(boot_entry(offset, platform))
+                offset += 32
+                count -= 1
+            if final:
+                break
+        return entries
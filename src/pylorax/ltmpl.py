@@ -24,9 +24,12 @@ import logging
 logger = logging.getLogger("pylorax.ltmpl")
 
 import os, re, glob, shlex, fnmatch
+import hashlib
+import stat
 from os.path import basename, isdir
 from subprocess import CalledProcessError
 import shutil
+from collections import defaultdict
 
 from pylorax.sysutils import joinpaths, safe_joinpaths, cpfile, mvfile, replace, remove
 from pylorax.dnfhelper import LoraxDownloadCallback, LoraxRpmCallback
@@ -37,7 +40,7 @@ from pylorax.imgutils import mkcpio, ProcMount
 import collections.abc
 from mako.lookup import TemplateLookup
 from mako.exceptions import text_error_template
-import sys, traceback
+import traceback
 import struct
 
 import libdnf5 as dnf5
@@ -46,16 +49,36 @@ from libdnf5.common import QueryCmp_EQ as EQ
 action_is_inbound = dnf5.base.transaction.transaction_item_action_is_inbound
 
 
+# Template lookups are shared so that mako only compiles each template once,
+# and parsed command lists are shared between runs that render the same text.
+_lookups = {}
+_parsed = {}
+_PARSED_MAX = 256
+
 class LoraxTemplate(object):
-    def __init__(self, directories=None):
+    def __init__(self, directories=None, module_directory=None):
         directories = directories or ["/usr/share/lorax"]
         # we have to add ["/"] to the template lookup directories or the
         # file includes won't work properly for absolute paths
         self.directories = ["/"] + directories
+        self.module_directory = module_directory
+
+    @property
+    def lookup(self):
+        """Return the TemplateLookup for these directories
+
+        mako checks the template's mtime each time it is used and recompiles it
+        when it has changed. When module_directory is set the compiled templates
+        are also saved there, so that they can be reused by later builds.
+        """
+        key = (tuple(self.directories), self.module_directory)
+        if key not in _lookups:
+            _lookups[key] = TemplateLookup(directories=self.directories,
+                                           module_directory=self.module_directory)
+        return _lookups[key]
 
     def parse(self, template_file, variables):
-        lookup = TemplateLookup(directories=self.directories)
-        template = lookup.get_template(template_file)
+        template = self.lookup.get_template(template_file)
 
         try:
             textbuf = template.render(**variables)
@@ -64,6 +87,12 @@ class LoraxTemplate(object):
             logger.error(text_error_template().render())
             raise
 
+        # The rendered text depends on the variables and on the filesystem (eg. exists()),
+        # so it is used as the key for the parsed commands.
+        key = (template.uri, hashlib.sha256(textbuf.encode("utf-8")).digest())
+        if key in _parsed:
+            return [list(line) for line in _parsed[key]]
+
         # split, strip and remove empty lines
         lines = textbuf.splitlines()
         lines = [line.strip() for line in lines]
@@ -81,6 +110,10 @@ class LoraxTemplate(object):
         except Exception as e:
             logger.error('shlex error processing "%s": %s', line, str(e))
             raise
+
+        if len(_parsed) >= _PARSED_MAX:
+            _parsed.clear()
+        _parsed[key] = tuple(tuple(line) for line in expanded_lines)
         return expanded_lines
 
 def split_and_expand(line):
@@ -114,6 +147,186 @@ def rexists(pathname, root=""):
         return True
     return False
 
+def batched(fn):
+    """Mark a template command whose removals are collected and run together
+    with the removals of the commands around it."""
+    fn.batched = True
+    return fn
+
+def _tree_size(path):
+    """Return the size of the files under a directory"""
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for f in files:
+            try:
+                st = os.lstat(joinpaths(root, f))
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+    return size
+
+class PackageFileIndex(object):
+    """An index of the files in the packages installed by a transaction
+
+    The package names and their files are read from the transaction once.
+    Whether a file is a directory in the installroot is cached until
+    :meth:`invalidate` is called.
+    """
+    def __init__(self, transaction, outroot):
+        """
+        :param transaction: The transaction that installed the packages
+        :type transaction: libdnf5.base.Transaction
+        :param str outroot: The root directory the packages were installed into
+        """
+        self.outroot = outroot
+        self._files = {}        # package name -> tuple of paths
+        self._isdir = {}        # path -> True if it is a directory in outroot
+
+        for tp in transaction.get_transaction_packages():
+            if not action_is_inbound(tp.get_action()):
+                continue
+            pkg = tp.get_package()
+            name = pkg.get_name()
+            self._files[name] = self._files.get(name, ()) + tuple(pkg.get_files())
+
+    def invalidate(self):
+        """Forget the cached directory flags, the installroot has been modified"""
+        self._isdir = {}
+
+    def _is_dir(self, path):
+        if path not in self._isdir:
+            self._isdir[path] = os.path.isdir(joinpaths(self.outroot, path))
+        return self._isdir[path]
+
+    def packages(self, *pkg_specs):
+        """Return the names of the packages matching the globs
+
+        :param pkg_specs: Package name globs
+        :type pkg_specs: str
+        :rtype: set of str
+        """
+        names = set()
+        for spec in pkg_specs:
+            if glob.has_magic(spec):
+                names.update(fnmatch.filter(self._files, spec))
+            elif spec in self._files:
+                names.add(spec)
+        return names
+
+    def files(self, *pkg_specs):
+        """Return the files, but not the directories, in the packages matching the globs
+
+        :param pkg_specs: Package name globs
+        :type pkg_specs: str
+        :rtype: set of str
+        """
+        # dnf/hawkey doesn't make any distinction between file, dir or ghost like yum did
+        # so only return the files.
+        return set(f for name in self.packages(*pkg_specs) for f in self._files[name] if not self._is_dir(f))
+
+class RemovalPlan(object):
+    """Collect the files removed by a series of template commands and remove them in one pass
+
+    The paths are grouped by their parent directory and unlinked relative to an
+    open directory fd, directories are removed with rmtree. Paths inside a
+    directory that is being removed are skipped. The number of bytes freed is
+    recorded for each command.
+    """
+    def __init__(self):
+        self._paths = {}    # path -> (True if it is a directory, origin)
+        self.freed = {}     # command -> bytes
+
+    def __len__(self):
+        return len(self._paths)
+
+    def _in_removed_dir(self, path):
+        """Return True if a parent of path is a directory in the plan"""
+        parent = os.path.dirname(path)
+        while parent not in ("/", ""):
+            if self._paths.get(parent, (False, None))[0]:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+    def add(self, cmd, paths, origin=None):
+        """Add paths to the plan
+
+        :param str cmd: The command removing the paths, used for the report
+        :param paths: Full paths to the files or directories to remove
+        :type paths: iterable of str
+        :param origin: Returned with the errors removing these paths, eg. the template line
+        :returns: The number of bytes that will be freed
+        :rtype: int
+
+        Paths that do not exist are ignored.
+        """
+        size = 0
+        for path in paths:
+            if path in self._paths or self._in_removed_dir(path):
+                continue
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            self._paths[path] = (is_dir, origin)
+            if is_dir:
+                size += _tree_size(path)
+            elif stat.S_ISREG(st.st_mode):
+                size += st.st_size
+        self.freed[cmd] = self.freed.get(cmd, 0) + size
+        return size
+
+    def execute(self):
+        """Remove everything in the plan and log the space freed by each command
+
+        :returns: The (origin, exception) of each origin whose paths could not be removed
+        :rtype: list of tuple
+
+        An error removing one path does not stop the others from being removed.
+        """
+        by_parent = defaultdict(list)
+        for path, (is_dir, origin) in self._paths.items():
+            if not self._in_removed_dir(path):
+                by_parent[os.path.dirname(path)].append((os.path.basename(path), is_dir, origin))
+
+        errors = {}
+        for parent in sorted(by_parent):
+            try:
+                dir_fd = os.open(parent, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                for _, _, origin in by_parent[parent]:
+                    errors.setdefault(id(origin), (origin, e))
+                continue
+            try:
+                for name, is_dir, origin in sorted(by_parent[parent], key=lambda p: p[0]):
+                    try:
+                        if is_dir:
+                            shutil.rmtree(joinpaths(parent, name))
+                        else:
+                            os.unlink(name, dir_fd=dir_fd)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        errors.setdefault(id(origin), (origin, e))
+            finally:
+                os.close(dir_fd)
+
+        for cmd, size in self.freed.items():
+            logger.debug("%s: freed %ikb", cmd, size/1024)
+        logger.info("removed %d files and directories, freed %ikb", len(self._paths),
+                    sum(self.freed.values())/1024)
+        self.clear()
+        return list(errors.values())
+
+    def clear(self):
+        """Drop everything in the plan without removing it"""
+        self._paths = {}
+        self.freed = {}
+
 class TemplateRunner(object):
     '''
     This class parses and executes Lorax templates. Sample usage:
@@ -136,12 +349,15 @@ class TemplateRunner(object):
     * Parsing and execution are *separate* passes - so you can't use the result
       of a command in an %if statement (or any other control statements)!
     '''
-    def __init__(self, fatalerrors=True, templatedir=None, defaults=None, builtins=None):
+    def __init__(self, fatalerrors=True, templatedir=None, defaults=None, builtins=None, cachedir=None):
         self.fatalerrors = fatalerrors
         self.templatedir = templatedir or "/usr/share/lorax"
+        self.cachedir = cachedir
         self.templatefile = None
         self.builtins = builtins or {}
         self.defaults = defaults or {}
+        self._batching = False
+        self._line = None
 
 
     def run(self, templatefile, **variables):
@@ -149,45 +365,84 @@ class TemplateRunner(object):
             variables.setdefault(k,v)
         logger.debug("executing %s with variables=%s", templatefile, variables)
         self.templatefile = templatefile
-        t = LoraxTemplate(directories=[self.templatedir])
+        t = LoraxTemplate(directories=[self.templatedir], module_directory=self.cachedir)
         commands = t.parse(templatefile, variables)
         self._run(commands)
 
+    def _flush(self):
+        """Run any work that has been batched up by the previous commands
+
+        :returns: The (line, exception) of the batched lines that failed
+        :rtype: list of tuple
+        """
+        return []
+
+    def _discard(self):
+        """Drop any batched work that has not been run"""
+
+    def _error(self, line, exc):
+        """Log a template command error, and raise it if errors are fatal"""
+        logger.error("template command error in %s:", self.templatefile)
+        logger.error("  %s", " ".join(line))
+        # format the exception traceback
+        exclines = traceback.format_exception(type(exc), exc, exc.__traceback__)
+        # skip the bit about "ltmpl.py, in _run()" - we know that
+        if len(exclines) > 2:
+            exclines.pop(1)
+        # log the "ErrorType: this is what happened" line
+        logger.error("  %s", exclines[-1].strip())
+        # and log the entire traceback to the debug log
+        for _line in ''.join(exclines).splitlines():
+            logger.debug("  %s", _line)
+        if self.fatalerrors:
+            raise exc
+
+    def _run_batch(self):
+        """Run the batched work, and handle its errors as errors of the lines that batched it"""
+        for origin, exc in self._flush():
+            if origin is None:
+                raise exc
+            line, skiperror = origin
+            if skiperror:
+                logger.debug("ignoring error")
+                continue
+            self._error(line, exc)
 
     def _run(self, parsed_template):
         logger.info("running %s", self.templatefile)
-        for (num, line) in enumerate(parsed_template,1):
-            logger.debug("template line %i: %s", num, " ".join(line))
-            skiperror = False
-            (cmd, args) = (line[0], line[1:])
-            # Following Makefile convention, if the command is prefixed with
-            # a dash ('-'), we'll ignore any errors on that line.
-            if cmd.startswith('-'):
-                cmd = cmd[1:]
-                skiperror = True
-            try:
+        try:
+            for (num, line) in enumerate(parsed_template,1):
+                logger.debug("template line %i: %s", num, " ".join(line))
+                skiperror = False
+                (cmd, args) = (line[0], line[1:])
+                # Following Makefile convention, if the command is prefixed with
+                # a dash ('-'), we'll ignore any errors on that line.
+                if cmd.startswith('-'):
+                    cmd = cmd[1:]
+                    skiperror = True
                 # grab the method named in cmd and pass it the given arguments
                 f = getattr(self, cmd, None)
-                if cmd[0] == '_' or cmd == 'run' or not isinstance(f, collections.abc.Callable):
-                    raise ValueError("unknown command %s" % cmd)
-                f(*args)
-            except Exception: # pylint: disable=broad-except
-                if skiperror:
-                    logger.debug("ignoring error")
-                    continue
-                logger.error("template command error in %s:", self.templatefile)
-                logger.error("  %s", " ".join(line))
-                # format the exception traceback
-                exclines = traceback.format_exception(*sys.exc_info())
-                # skip the bit about "ltmpl.py, in _run()" - we know that
-                exclines.pop(1)
-                # log the "ErrorType: this is what happened" line
-                logger.error("  %s", exclines[-1].strip())
-                # and log the entire traceback to the debug log
-                for _line in ''.join(exclines).splitlines():
-                    logger.debug("  %s", _line)
-                if self.fatalerrors:
-                    raise
+                # Removals are collected and run before the next command that isn't a removal
+                self._batching = getattr(f, "batched", False)
+                if not self._batching:
+                    self._run_batch()
+                # The batched work records the line it came from
+                self._line = (line, skiperror)
+                try:
+                    if cmd[0] == '_' or cmd == 'run' or not isinstance(f, collections.abc.Callable):
+                        raise ValueError("unknown command %s" % cmd)
+                    f(*args)
+                except Exception as e: # pylint: disable=broad-except
+                    if skiperror:
+                        logger.debug("ignoring error")
+                        continue
+                    self._error(line, e)
+            self._batching = False
+            self._run_batch()
+        finally:
+            self._batching = False
+            self._line = None
+            self._discard()
 
 
 class InstallpkgMixin:
@@ -390,11 +645,15 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
     * Commands should raise exceptions for errors - don't use sys.exit()
     '''
     def __init__(self, inroot, outroot, dbo=None, fatalerrors=True,
-                                        templatedir=None, defaults=None, basearch=None):
+                                        templatedir=None, defaults=None, basearch=None,
+                                        pkgcache=None, cachedir=None):
         self.inroot = inroot
         self.outroot = outroot
         self.dbo = dbo
+        self.pkgcache = pkgcache
         self.transaction = None
+        self._fileindex = None
+        self._removals = RemovalPlan()
         if dbo:
             self.goal = dnf5.base.Goal(self.dbo)
         else:
@@ -408,7 +667,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         if basearch:
             self._filter_arches.append(basearch)
 
-        super(LoraxTemplateRunner, self).__init__(fatalerrors, templatedir, defaults, builtins)
+        super(LoraxTemplateRunner, self).__init__(fatalerrors, templatedir, defaults, builtins, cachedir)
         # TODO: set up custom logger with a filter to add line info
 
     def _out(self, path):
@@ -433,18 +692,9 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         if self.transaction is None:
             raise RuntimeError("Transaction needs to be run before calling _filelists")
 
-        pkglist = []
-        for tp in self.transaction.get_transaction_packages():
-            if not action_is_inbound(tp.get_action()):
-                continue
-
-            pkg = tp.get_package()
-            if any(fnmatch.fnmatch(pkg.get_name(), spec) for spec in pkg_specs):
-                pkglist.append(pkg)
-
-        # dnf/hawkey doesn't make any distinction between file, dir or ghost like yum did
-        # so only return the files.
-        return set(f for pkg in pkglist for f in pkg.get_files() if not os.path.isdir(self._out(f)))
+        if self._fileindex is None:
+            self._fileindex = PackageFileIndex(self.transaction, self.outroot)
+        return self._fileindex.files(*pkg_specs)
 
     def _getsize(self, *files):
         return sum(os.path.getsize(self._out(f)) for f in files if os.path.isfile(self._out(f)))
@@ -543,7 +793,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
 
     def installimg(self, *args):
         '''
-        installimg [--xz|--gzip|--bzip2|--lzma] [-ARG|--ARG=OPTION] SRCDIR DESTFILE
+        installimg [--xz|--gzip|--bzip2|--lzma|--zstd] [-ARG|--ARG=OPTION] SRCDIR DESTFILE
           Create a compressed cpio archive of the contents of SRCDIR and place
           it in DESTFILE.
 
@@ -554,11 +804,12 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             installimg ${LORAXDIR}/updates/ images/updates.img
             installimg --xz -6 ${LORAXDIR}/updates/ images/updates.img
             installimg --xz -9 --memlimit-compress=3700MiB ${LORAXDIR}/updates/ images/updates.img
+            installimg --zstd -19 ${LORAXDIR}/updates/ images/updates.img
 
           Optionally use a different compression type and override the default args
           passed to it. The default is xz -9
         '''
-        COMPRESSORS = ("--xz", "--gzip", "--bzip2", "--lzma")
+        COMPRESSORS = ("--xz", "--gzip", "--bzip2", "--lzma", "--zstd")
         if len(args) < 2:
             raise ValueError("Not enough args for installimg.")
 
@@ -733,16 +984,40 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
 
         mvfile(self._out(src), self._out(dest))
 
+    def _flush(self):
+        """Remove the files collected by the previous removal commands
+
+        This runs before every command that isn't a removal, any of which may
+        modify the installroot, so the cached directory flags are dropped too.
+        """
+        errors = self._removals.execute() if self._removals else []
+        if self._fileindex is not None:
+            self._fileindex.invalidate()
+        return errors
+
+    def _discard(self):
+        """Drop the removals that have not been run"""
+        self._removals.clear()
+
+    def _remove_paths(self, cmd, paths):
+        """Remove full paths now, or add them to the removal plan when called from a template"""
+        if self._batching:
+            self._removals.add(cmd, paths, self._line)
+            return
+        for f in paths:
+            if os.path.lexists(f):
+                remove(f)
+                logger.debug("removed %s", f)
+
+    @batched
     def remove(self, *fileglobs):
         '''
         remove FILEGLOB [FILEGLOB ...]
           Remove all the named files or directories.
           Will *not* raise exceptions if the file(s) are not found.
         '''
-        for g in fileglobs:
-            for f in rglob(self._out(g)):
-                remove(f)
-                logger.debug("removed %s", f)
+        self._remove_paths("remove %s" % " ".join(fileglobs),
+                           [f for g in fileglobs for f in rglob(self._out(g))])
 
     def chmod(self, fileglob, mode):
         '''
@@ -800,6 +1075,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             logger.error('command returned failure (%d)', e.returncode)
             raise
 
+    @batched
     def removepkg(self, *pkgs):
         '''
         removepkg PKGGLOB [PKGGLOB...]
@@ -814,7 +1090,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             # TODO: also remove directories that aren't owned by anything else
             if filepaths:
                 logger.debug("removepkg %s: %ikb", p, self._getsize(*filepaths)/1024)
-                self.remove(*filepaths)
+                self._remove_paths("removepkg %s" % p, [self._out(f) for f in filepaths])
             else:
                 logger.debug("removepkg %s: no files to remove!", p)
 
@@ -825,6 +1101,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
           commands.
         '''
         logger.info("Checking dependencies")
+        self._fileindex = None
         self.transaction = self.goal.resolve()
         if self.transaction.get_problems() != NO_PROBLEM:
             err = "\n".join(self.transaction.get_resolve_logs_as_strings())
@@ -838,6 +1115,10 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         # Write out the packages installed, including debuginfo packages
         self._write_package_log()
 
+        if self.pkgcache:
+            self.pkgcache.link_packages([t.get_package() for t in self.transaction.get_transaction_packages()
+                                         if action_is_inbound(t.get_action())])
+
         logger.info("Downloading packages")
 
         downloader_callbacks = LoraxDownloadCallback(num_pkgs)
@@ -848,6 +1129,10 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             logger.error("Failed to download the following packages: %s", e)
             raise
 
+        # dnf removes the downloaded packages after the transaction, store them first
+        if self.pkgcache:
+            self.pkgcache.store_packages()
+
         logger.info("Preparing transaction from installation source")
 
         display = LoraxRpmCallback()
@@ -866,6 +1151,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
         if len(self._filelist("anaconda-core")) == 0:
             raise RuntimeError("Failed to reset dbo to installed package set")
 
+    @batched
     def removefrom(self, pkg, *globs):
         '''
         removefrom PKGGLOB [--allbut] FILEGLOB [FILEGLOB...]
@@ -885,13 +1171,18 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             globs = globs[1:]
         # get pkg filelist and find files that match the globs
         filelist = self._filelist(pkg)
+        # match all the globs in one pass over the filelist, the named groups
+        # record which glob matched.
+        globs_re = re.compile("|".join("(?P<g%d>%s)" % (i, fnmatch.translate(g)) for i, g in enumerate(globs)))
         matches = set()
-        for g in globs:
-            globs_re = re.compile(fnmatch.translate(g))
-            m = [f for f in filelist if globs_re.match(f)]
+        matched = set()
+        for f in filelist:
+            m = globs_re.match(f)
             if m:
-                matches.update(m)
-            else:
+                matches.add(f)
+                matched.add(m.lastgroup)
+        for i, g in enumerate(globs):
+            if "g%d" % i not in matched:
                 logger.debug("removefrom %s %s: no files matched!", pkg, g)
         # are we removing the matches, or keeping only the matches?
         if keepmatches:
@@ -903,7 +1194,7 @@ class LoraxTemplateRunner(TemplateRunner, InstallpkgMixin):
             logger.debug("removefrom %s: removed %i/%i files, %ikb/%ikb", cmd,
                              len(remove_files), len(filelist),
                              self._getsize(*remove_files)/1024, self._getsize(*filelist)/1024)
-            self.remove(*remove_files)
+            self._remove_paths("removefrom %s" % cmd, [self._out(f) for f in remove_files])
         else:
             logger.debug("removefrom %s: no files to remove!", cmd)
 
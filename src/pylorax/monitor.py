@@ -20,19 +20,128 @@
 import logging
 log = logging.getLogger("livemedia-creator")
 
+import asyncio
 import re
-import socket
-import socketserver
 import threading
 import time
 
-class LogRequestHandler(socketserver.BaseRequestHandler):
+from pylorax.base import DataHolder
+
+def load_error_rules(path):
+    """
+    Read a file of extra error rules
+
+    :param str path: Path to the rules file
+    :returns: The substrings and the regular expressions
+    :rtype: tuple of (list, list)
+
+    Each line is a string that indicates the installation has failed. Lines
+    starting with re: are regular expressions, and lines starting with # are comments.
+    """
+    simple_tests, re_tests = [], []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if line.startswith("re:"):
+                re.compile(line[3:])
+                re_tests.append(line[3:])
+            else:
+                simple_tests.append(line)
+    return simple_tests, re_tests
+
+class ErrorMatcher(object):
+    """
+    Find the log lines that match a set of error rules
+
+    Instead of checking every rule against every line in python, a block of
+    lines is searched for each rule with str.find, or with the rule's regex
+    compiled in multiline mode, so the loop over the text runs in C. Only the
+    lines found that way are checked against the rules in order, the same
+    as search does. Lines containing IGNORED never match.
+    """
+    def __init__(self, simple_tests, re_tests, ignore="IGNORED"):
+        """
+        :param list simple_tests: Substrings that indicate an error
+        :param list re_tests: Regular expressions that indicate an error
+        :param str ignore: Lines containing this string are skipped
+        """
+        self.ignore = ignore
+        # (rule, compiled regex or None for substrings)
+        self.rules = [(t, None) for t in simple_tests]
+        self.rules += [(t, re.compile(t)) for t in re_tests]
+        self._multiline = [re.compile(t, re.M) if r else None for t, r in self.rules]
+
+    def search(self, line):
+        """
+        Check a single line
+
+        :param str line: The log line
+        :returns: The rule that matched or None
+        :rtype: str
+        """
+        if self.ignore in line:
+            return None
+        for rule, regex in self.rules:
+            if regex is None:
+                if rule in line:
+                    return rule
+            elif regex.search(line):
+                return rule
+        return None
+
+    def _find(self, idx, text):
+        """Return the start of each line of text that may match a rule"""
+        rule, _regex = self.rules[idx]
+        multiline = self._multiline[idx]
+        pos = 0
+        while True:
+            if multiline is None:
+                found = text.find(rule, pos)
+            else:
+                m = multiline.search(text, pos)
+                found = m.start() if m else -1
+            if found < 0:
+                return
+            yield text.rfind("\n", 0, found) + 1
+            pos = text.find("\n", found) + 1
+            if pos == 0:
+                return
+
+    def scan(self, text):
+        """
+        Check a block of lines
+
+        :param str text: Lines of text, separated by newlines
+        :returns: The (rule, line) of each matching line, in order
+        :rtype: list of tuple
+        """
+        # Start of each line -> the first rule that may match it
+        candidates = {}
+        for idx in range(len(self.rules)):
+            for start in self._find(idx, text):
+                candidates[start] = min(candidates.get(start, idx), idx)
+
+        matches = []
+        for start in sorted(candidates):
+            end = text.find("\n", start)
+            line = text[start:end if end >= 0 else len(text)]
+            if self.ignore in line:
+                continue
+            for rule, regex in self.rules[candidates[start]:]:
+                if (regex is None and rule in line) or (regex and regex.search(line)):
+                    matches.append((rule, line))
+                    break
+        return matches
+
+class LogRequestHandler(object):
     """
-    Handle monitoring and saving the logfiles from the virtual install
+    Check the lines from one log channel for errors
 
-    Incoming data is written to self.server.log_path and each line is checked
-    for patterns that would indicate that the installation failed.
-    self.server.log_error is set True when this happens.
+    Each line is checked for patterns that would indicate that the installation
+    failed. self.server.log_error is set True when this happens, and
+    self.server.error_rule is set to the pattern that matched.
     """
 
     simple_tests = [
@@ -56,54 +165,50 @@ class LogRequestHandler(socketserver.BaseRequestHandler):
         r"packaging: .* requires .*"
     ]
 
-    def setup(self):
-        """Start writing to self.server.log_path"""
+    # When a subclass overrides iserror it is called for every line, otherwise blocks of
+    # lines are checked with the server's ErrorMatcher. Subclasses can opt out of calling
+    # their iserror for every line by setting this to False, or force it with True.
+    check_each_line = None
 
-        if self.server.log_path:
-            self.fp = open(self.server.log_path, "w") # pylint: disable=attribute-defined-outside-init
+    def __init__(self, server, client_address):
+        """
+        :param LogServer server: The server the channel is connected to
+        :param tuple client_address: Address of the channel's client
+        """
+        self.server = server
+        self.client_address = client_address
+        self.lines = 0
+        self.bytes = 0
+        if self.check_each_line is None:
+            self._each_line = type(self).iserror is not LogRequestHandler.iserror
         else:
-            self.fp = None
-        self.request.settimeout(10)
+            self._each_line = self.check_each_line
 
-    def handle(self):
+    def handle_lines(self, text):
         """
-        Write incoming data to a logfile and check for errors
+        Check complete lines of text for errors
 
-        Split incoming data into lines and check for any Tracebacks or other
-        errors that indicate that the install failed.
+        :param str text: One or more lines, ending with a newline
+        """
+        if self._each_line:
+            for line in text.split("\n")[:-1]:
+                self.iserror(line)
+        else:
+            for rule, line in self.server.matcher.scan(text):
+                self.error(rule, line)
+        self.lines += text.count("\n")
+        self.bytes += len(text)
 
-        Loops until self.server.kill is True
+    def error(self, rule, line):
         """
-        log.info("Processing logs from %s", self.client_address)
-        data = b""
-        while True:
-            if self.server.kill:
-                break
-
-            try:
-                data += self.request.recv(4096)
-                for line in data.splitlines(keepends=True):
-                    if line.endswith(b"\n"):
-                        # Ignore invalid UTF8 inside lines
-                        self.iserror(str(line[:-1], "utf8", "ignore"))
-                        if self.fp:
-                            self.fp.write(str(line, "utf8", "ignore"))
-                            self.fp.flush()
-                        data = b""
-                    else:
-                        # Not the end of the line, keep for later
-                        data = line
-                        break
-            except socket.timeout:
-                pass
-            except Exception as e:       # pylint: disable=broad-except
-                log.info("log processing killed by exception: %s", e)
-                break
-
-    def finish(self):
-        log.info("Shutting down log processing")
-        if self.fp:
-            self.fp.close()
+        Record a line that indicates the installation failed
+
+        :param str rule: The rule that matched
+        :param str line: The log line
+        """
+        self.server.log_error = True
+        self.server.error_line = line
+        self.server.error_rule = rule
 
     def iserror(self, line):
         """
@@ -113,41 +218,147 @@ class LogRequestHandler(socketserver.BaseRequestHandler):
 
         If the line contains IGNORED it will be skipped.
         """
-        if "IGNORED" in line:
-            return
+        rule = self.server.matcher.search(line)
+        if rule:
+            self.error(rule, line)
 
-        for t in self.simple_tests:
-            if t in line:
-                self.server.log_error = True
-                self.server.error_line = line
-                return
-        for t in self.re_tests:
-            if re.search(t, line):
-                self.server.log_error = True
-                self.server.error_line = line
-                return
 
+class LogServer(object):
+    """
+    An asyncio TCP server that listens for log data
 
-class LogServer(socketserver.TCPServer):
-    """A TCP Server that listens for log data"""
+    Any number of clients can connect at the same time, eg. anaconda opens one
+    connection for each of its remote loggers. Each connection is a channel,
+    its data is split into lines that are checked by a request handler and
+    written to log_path. Writes are batched and flushed once a second.
+    """
 
-    # Number of seconds to wait for a connection after startup
-    timeout = 60
+    # Number of seconds to wait for a connection after startup before logging a warning
+    no_data_warning = 60
 
-    def __init__(self, log_path, *args, **kwargs):
+    def __init__(self, log_path, server_address, handler_class=LogRequestHandler, timeout=None,
+                 error_rules=None):
         """
         Setup the log server
 
-        :param str log_path: Path to the log file to write
+        :param str log_path: Path to the log file to write, or None
+        :param tuple server_address: The (host, port) to listen to, port 0 picks a free port
+        :param handler_class: Class used to check each channel's lines
+        :param int timeout: Minutes to wait for the installation before canceling it
+        :param str error_rules: Path to a file with extra error rules, see load_error_rules
         """
         self.kill = False
         self.log_error = False
         self.error_line = ""
+        self.error_rule = None
+        simple_tests, re_tests = load_error_rules(error_rules) if error_rules else ([], [])
+        self.matcher = ErrorMatcher(handler_class.simple_tests + simple_tests,
+                                    handler_class.re_tests + re_tests)
         self.log_path = log_path
-        self._timeout = kwargs.pop("timeout", None)
-        if self._timeout:
-            self._start_time = time.time()
-        socketserver.TCPServer.__init__(self, *args, **kwargs)
+        self.handler_class = handler_class
+        self.channels = []
+        self.lines_per_sec = 0.0
+        self._timeout = timeout
+        self._start_time = time.time()
+        self._fp = None
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+                            asyncio.start_server(self._handle, *server_address))
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+
+    def serve(self):
+        """Handle the channels until kill is set, writing their lines to log_path"""
+        asyncio.set_event_loop(self._loop)
+        if not self.log_path:
+            self._loop.run_until_complete(self._serve())
+            return
+        with open(self.log_path, "w") as self._fp:
+            self._loop.run_until_complete(self._serve())
+        self._fp = None
+
+    async def _serve(self):
+        last_time, last_lines = time.time(), 0
+        warned = False
+        while not self.kill:
+            await asyncio.sleep(0.1)
+            now = time.time()
+            if now - last_time < 1:
+                continue
+            lines = self.lines
+            self.lines_per_sec = (lines - last_lines) / (now - last_time)
+            last_time, last_lines = now, lines
+            if self._fp:
+                self._fp.flush()
+            if not self.channels and not warned and now > self._start_time + self.no_data_warning:
+                log.warning("No log data received after %d seconds", self.no_data_warning)
+                warned = True
+
+        self._server.close()
+        await self._server.wait_closed()
+
+        # Let the channel handlers finish writing their last lines
+        pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        if pending:
+            await asyncio.wait(pending, timeout=2)
+
+    async def _handle(self, reader, writer):
+        """Read a channel's data, split it into lines, and check and write them"""
+        client_address = writer.get_extra_info("peername")
+        log.info("Processing logs from %s", client_address)
+        handler = self.handler_class(self, client_address)
+        self.channels.append(handler)
+        data = bytearray()
+        try:
+            while not self.kill:
+                try:
+                    chunk = await asyncio.wait_for(reader.read(65536), 0.5)
+                except asyncio.TimeoutError:
+                    continue
+                if not chunk:
+                    if data:
+                        # Keep the last line when the channel is closed without a newline
+                        self._write_lines(handler, data.decode("utf8", "ignore") + "\n")
+                    break
+                data += chunk
+                end = data.rfind(b"\n")
+                if end < 0:
+                    # Not the end of the line, keep it for later
+                    continue
+                # Ignore invalid UTF8 inside lines
+                text = data[:end+1].decode("utf8", "ignore")
+                del data[:end+1]
+                self._write_lines(handler, text)
+        except Exception as e:       # pylint: disable=broad-except
+            log.info("log processing killed by exception: %s", e)
+        finally:
+            writer.close()
+
+    def _write_lines(self, handler, text):
+        """Check complete lines with the channel's handler and write them to the log"""
+        handler.handle_lines(text)
+        if self._fp:
+            self._fp.write(text)
+
+    @property
+    def lines(self):
+        """Total number of lines received"""
+        return sum(c.lines for c in self.channels)
+
+    @property
+    def bytes(self):
+        """Total number of bytes written to the log"""
+        return sum(c.bytes for c in self.channels)
+
+    def metrics(self):
+        """
+        Return the current log metrics
+
+        :returns: lines, bytes, lines_per_sec, channels, error_line, and error_rule
+        :rtype: DataHolder
+        """
+        return DataHolder(lines=self.lines, bytes=self.bytes, lines_per_sec=self.lines_per_sec,
+                          channels=len(self.channels), error_line=self.error_line,
+                          error_rule=self.error_rule)
 
     def log_check(self):
         """
@@ -164,6 +375,10 @@ class LogServer(socketserver.TCPServer):
             taking_too_long = False
         return self.log_error or taking_too_long
 
+    def server_close(self):
+        """Close the event loop"""
+        self._loop.close()
+
 
 class LogMonitor(object):
     """
@@ -172,13 +387,15 @@ class LogMonitor(object):
     This needs to be running before the virt-install runs, it expects
     there to be a listener on the port used for the virtio log port.
     """
-    def __init__(self, log_path=None, host="localhost", port=0, timeout=None, log_request_handler_class=LogRequestHandler):
+    def __init__(self, log_path=None, host="localhost", port=0, timeout=None, log_request_handler_class=LogRequestHandler,
+                 error_rules=None):
         """
         Start a thread to monitor the logs.
 
         :param str log_path: Path to the logfile to write
         :param str host: Host to bind to. Default is localhost.
         :param int port: Port to listen to or 0 to pick a port
+        :param str error_rules: Path to a file with extra error rules
 
         If 0 is passed for the port the dynamically assigned port will be
         available as self.port
@@ -186,15 +403,23 @@ class LogMonitor(object):
         If log_path isn't set then it only monitors the logs, instead of
         also writing them to disk.
         """
-        self.server = LogServer(log_path, (host, port), log_request_handler_class, timeout=timeout)
+        self.server = LogServer(log_path, (host, port), log_request_handler_class, timeout=timeout,
+                                error_rules=error_rules)
         self.host, self.port = self.server.server_address
         self.log_path = log_path
-        self.server_thread = threading.Thread(target=self.server.handle_request)
+        self.server_thread = threading.Thread(target=self.server.serve)
         self.server_thread.daemon = True
         self.server_thread.start()
 
+    def metrics(self):
+        """Return the current log metrics, see LogServer.metrics"""
+        return self.server.metrics()
+
     def shutdown(self):
         """Force shutdown of the monitoring thread"""
+        log.info("Shutting down log processing")
         self.server.kill = True
         self.server_thread.join()
         self.server.server_close()
+        m = self.server.metrics()
+        log.info("Processed %d log lines, %d KiB, from %d channels", m.lines, m.bytes // 1024, m.channels)
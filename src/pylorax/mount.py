@@ -21,88 +21,108 @@ import logging
 log = logging.getLogger("livemedia-creator")
 
 import os
-import iso9660
+import shutil
+import tempfile
 
 from pylorax.imgutils import mount, umount
+from pylorax.isoreader import ISOReader
 
 class IsoMountpoint(object):
     """
-    Mount the iso and check to make sure the vmlinuz and initrd.img files exist
+    Check the iso for the vmlinuz and initrd.img files and copy them out of it
 
     Also check the iso for a a stage2 image and set a flag and extract the
     iso's label.
 
     stage2 can be either LiveOS/squashfs.img or images/install.img
+
+    The iso is read with ISOReader so root privileges are not needed, it is
+    only mounted when it includes a /repodata directory.
     """
     def __init__(self, iso_path, initrd_path=None):
         """
-        Mount the iso
+        Read the iso
 
-        :param str iso_path: Path to the iso to mount
+        :param str iso_path: Path to the iso to read
         :param str initrd_path: Optional path to initrd
 
         initrd_path can be used to point to a tree with a newer
         initrd.img than the iso has. The iso is still used for stage2.
 
-        self.kernel and self.initrd point to the kernel and initrd.
+        self.kernel and self.initrd point to copies of the kernel and initrd.
         self.stage2 is set to True if there is a stage2 image.
         self.repo is the path to the mounted iso if there is a /repodata dir.
         """
         self.label = None
         self.iso_path = iso_path
         self.initrd_path = initrd_path
-
-        if not self.initrd_path:
-            self.mount_dir = mount(self.iso_path, opts="loop")
-        else:
-            self.mount_dir = self.initrd_path
+        self.mounted = False
 
         kernel_list = [("/isolinux/vmlinuz", "/isolinux/initrd.img"),
                        ("/ppc/ppc64/vmlinuz", "/ppc/ppc64/initrd.img"),
                        ("/images/pxeboot/vmlinuz", "/images/pxeboot/initrd.img"),
                        ("/images/kernel.img", "/images/initrd.img")]
 
-        if os.path.isdir(self.mount_dir+"/repodata"):
-            self.repo = self.mount_dir
-        else:
-            self.repo = None
-        self.stage2 = os.path.exists(self.mount_dir+"/LiveOS/squashfs.img") or \
-                      os.path.exists(self.mount_dir+"/images/install.img")
-
-        try:
-            for kernel, initrd in kernel_list:
-                if (os.path.isfile(self.mount_dir+kernel) and
-                    os.path.isfile(self.mount_dir+initrd)):
-                    self.kernel = self.mount_dir+kernel
-                    self.initrd = self.mount_dir+initrd
-                    break
+        with ISOReader(self.iso_path) as iso:
+            if self.initrd_path:
+                self.mount_dir = self.initrd_path
+                isdir = lambda p: os.path.isdir(self.mount_dir+p)
+                isfile = lambda p: os.path.isfile(self.mount_dir+p)
+                exists = lambda p: os.path.exists(self.mount_dir+p)
             else:
-                raise RuntimeError("Missing kernel and initrd file in iso, failed"
-                                   " to search under: {0}".format(kernel_list))
-        except:
-            self.umount()
-            raise
+                self.mount_dir = tempfile.mkdtemp(prefix="lmc-iso-")
+                isdir, isfile, exists = iso.isdir, iso.isfile, iso.exists
+
+            try:
+                if isdir("/repodata"):
+                    if not self.initrd_path:
+                        # The repo needs to be a directory, mount the iso
+                        os.rmdir(self.mount_dir)
+                        self.mount_dir = mount(self.iso_path, opts="loop")
+                        self.mounted = True
+                    self.repo = self.mount_dir
+                else:
+                    self.repo = None
+                self.stage2 = exists("/LiveOS/squashfs.img") or exists("/images/install.img")
+
+                for kernel, initrd in kernel_list:
+                    if isfile(kernel) and isfile(initrd):
+                        if self.initrd_path or self.mounted:
+                            self.kernel = self.mount_dir+kernel
+                            self.initrd = self.mount_dir+initrd
+                        else:
+                            self.kernel = self.mount_dir+"/"+os.path.basename(kernel)
+                            self.initrd = self.mount_dir+"/"+os.path.basename(initrd)
+                            iso.extract(kernel, self.kernel)
+                            iso.extract(initrd, self.initrd)
+                        break
+                else:
+                    raise RuntimeError("Missing kernel and initrd file in iso, failed"
+                                       " to search under: {0}".format(kernel_list))
+            except:
+                self.umount()
+                raise
 
         self.get_iso_label()
 
     def umount( self ):
-        """Unmount the iso"""
-        if not self.initrd_path:
+        """Unmount the iso, or remove the copies of the kernel and initrd"""
+        if self.mounted:
             umount(self.mount_dir)
+            self.mounted = False
+        elif not self.initrd_path and os.path.isdir(self.mount_dir):
+            shutil.rmtree(self.mount_dir)
 
     def get_iso_label(self):
         """
-        Get the iso's label using pycdio
+        Get the iso's label using ISOReader
 
         Sets self.label if one is found
         """
         try:
-            iso = iso9660.ISO9660.IFS(source=self.iso_path)
-            if not iso.is_open():
-                raise RuntimeError("error opening file")
-
-            self.label = iso.get_volume_id()
-            if self.label is None:
+            with ISOReader(self.iso_path) as iso:
+                self.label = iso.volume_id
+            if not self.label:
                 self.label = ""
                 raise RuntimeError("error reading volume id")
         except RuntimeError as e:
@@ -0,0 +1,165 @@
+#
+# pkgcache.py - package store shared between builds
+#
+# Copyright (C) 2026  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+logger = logging.getLogger("pylorax.pkgcache")
+
+import errno
+import fcntl
+import os
+import shutil
+
+from pylorax.sysutils import joinpaths
+
+
+class PackageCache(object):
+    """A content addressed store of downloaded packages
+
+    Packages are stored under their checksum from the repository metadata so
+    the same file can be shared by builds using different repositories, and
+    by several lorax processes at the same time.
+
+    Before downloading, cached packages are hard linked into the location dnf
+    downloads them to so that dnf skips them. After downloading, the new
+    packages are hard linked into the store. Files are added with an atomic
+    rename, and the least recently used files are removed when the store is
+    larger than its size budget.
+    """
+    def __init__(self, cachedir, size=20*1024**3):
+        """
+        :param str cachedir: Directory to store the packages in
+        :param int size: Maximum size of the store, in bytes
+        """
+        self.cachedir = cachedir
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.bytes_reused = 0
+        self._missed = []
+
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    @staticmethod
+    def _checksum(pkg):
+        """Return the checksum type and value for a package, or None if it doesn't have one"""
+        checksum = pkg.get_checksum()
+        if not checksum.get_checksum():
+            return None
+        return (checksum.get_type_str(), checksum.get_checksum())
+
+    def _path(self, checksum):
+        """Return the path to a package in the store"""
+        ctype, value = checksum
+        return joinpaths(self.cachedir, ctype, value[:2], value + ".rpm")
+
+    @staticmethod
+    def _link(src, dest):
+        """Hard link src to dest, replacing dest. Copy it if they are on different filesystems."""
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = "%s.%d.tmp" % (dest, os.getpid())
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(src, tmp)
+        os.rename(tmp, dest)
+
+    def link_packages(self, pkgs):
+        """Link the packages that are in the store into dnf's download location
+
+        :param pkgs: Packages that are going to be downloaded
+        :type pkgs: list of libdnf5.rpm.Package
+        """
+        self._missed = []
+        for pkg in pkgs:
+            checksum = self._checksum(pkg)
+            if not checksum:
+                continue
+            path = self._path(checksum)
+            try:
+                # The mtime is used to find the least recently used packages
+                os.utime(path)
+                self._link(path, pkg.get_package_path())
+            except FileNotFoundError:
+                self.misses += 1
+                self._missed.append(pkg)
+                continue
+            self.hits += 1
+            self.bytes_reused += pkg.get_download_size()
+
+    def store_packages(self):
+        """Add the packages downloaded by dnf to the store"""
+        for pkg in self._missed:
+            src = pkg.get_package_path()
+            if not os.path.exists(src):
+                logger.debug("%s was not downloaded, not caching it", src)
+                continue
+            self._link(src, self._path(self._checksum(pkg)))
+        self._missed = []
+        self.evict()
+
+        logger.info("package cache: %d hits, %d misses, %d MiB reused",
+                    self.hits, self.misses, self.bytes_reused // 1024**2)
+
+    def evict(self):
+        """Remove the least recently used packages until the store fits in its size budget
+
+        Only one process evicts packages at a time, if another process is already
+        doing it this returns immediately.
+        """
+        lock_fd = os.open(joinpaths(self.cachedir, ".lock"), os.O_RDWR|os.O_CREAT|os.O_CLOEXEC, 0o644)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            entries = []
+            total = 0
+            for root, _dirs, files in os.walk(self.cachedir):
+                for f in files:
+                    if not f.endswith(".rpm"):
+                        continue
+                    path = joinpaths(root, f)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+
+            if total <= self.size:
+                return
+            entries.sort()
+            removed = 0
+            for _mtime, size, path in entries:
+                if total <= self.size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            logger.info("package cache: removed %d least recently used packages", removed)
+        finally:
+            os.close(lock_fd)
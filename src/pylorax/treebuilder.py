@@ -23,8 +23,15 @@ logger = logging.getLogger("pylorax.treebuilder")
 import os, re
 from os.path import basename
 from shutil import copytree, copy2
-from subprocess import CalledProcessError
-from pathlib import Path
+from subprocess import CalledProcessError, Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import json
+import lzma
+import multiprocessing
+import struct
+import zlib
 import libdnf5 as dnf5
 from libdnf5.common import QueryCmp_EQ as EQ
 
@@ -33,7 +40,9 @@ from pylorax.base import DataHolder
 from pylorax.ltmpl import LoraxTemplateRunner
 import pylorax.imgutils as imgutils
 from pylorax.imgutils import DracutChroot
-from pylorax.executils import runcmd, runcmd_output, execWithCapture
+from pylorax.elfutils import ElfVerifier, ELF_MAGIC, elf_section, resolve_path
+from pylorax.executils import runcmd
+from pylorax.isomd5sum import implant_isomd5
 
 templatemap = {
     'x86_64':  'x86.tmpl',
@@ -42,25 +51,92 @@ templatemap = {
     'aarch64': 'aarch64.tmpl',
 }
 
-def generate_module_info(moddir, outfile=None):
-    def module_desc(mod):
-        output = runcmd_output(["modinfo", "-F", "description", mod])
-        return output.strip()
+def _decompress_module(path, data):
+    """Return the uncompressed data of a kernel module"""
+    if path.endswith(".xz"):
+        return lzma.decompress(data)
+    elif path.endswith(".gz"):
+        return gzip.decompress(data)
+    elif path.endswith(".zst"):
+        with Popen(["zstd", "-dcq"], stdin=PIPE, stdout=PIPE) as proc:
+            data, _ = proc.communicate(data)
+        if proc.returncode:
+            raise RuntimeError("zstd failed to decompress %s" % path)
+        return data
+    return data
+
+def module_description(path, data=None):
+    """Return the description of a kernel module, like modinfo -F description
+
+    :param str path: Path to the module, it may be compressed with xz, gzip, or zstd
+    :param bytes data: The contents of the module file, if it has already been read
+    :returns: The module's description, or an empty string
+    :rtype: str
+    """
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    data = _decompress_module(path, data)
+    modinfo = elf_section(data, ".modinfo") or b""
+    desc = [f[12:] for f in modinfo.split(b"\0") if f.startswith(b"description=")]
+    return b"\n".join(desc).decode("utf-8", "replace").strip()
+
+def generate_module_info(moddir, outfile=None, cachefile=None):
+    """Write the module-info file for the block and network drivers
+
+    :param str moddir: The kernel's module directory
+    :param str outfile: File to write, defaults to module-info in moddir
+    :param str cachefile: JSON file used to store the descriptions of the modules by their hash
+
+    The modules are read in parallel, and modules found in the cache file are not
+    decompressed again.
+    """
     def read_module_set(name):
         with open(joinpaths(moddir,name)) as f:
             return set(l.strip() for l in f if ".ko" in l)
     modsets = {'scsi':read_module_set("modules.block"),
                'eth':read_module_set("modules.networking")}
 
-    modinfo = list()
+    cache = {}
+    if cachefile and os.path.exists(cachefile):
+        try:
+            with open(cachefile, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except ValueError as e:
+            logger.warning("ignoring corrupt module info cache %s: %s", cachefile, e)
+
+    def module_desc(mod):
+        with open(mod, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in cache:
+            try:
+                cache[digest] = module_description(mod, data)
+            except (RuntimeError, OSError, EOFError, lzma.LZMAError, zlib.error, struct.error, ValueError) as e:
+                logger.warning("Failed to read the description of %s: %s", mod, e)
+                return ""
+        return cache[digest]
+
+    modules = list()
     for root, _dirs, files in os.walk(moddir):
         for modtype, modset in modsets.items():
             for mod in modset.intersection(files):  # modules in this dir
-                (name, _ext) = os.path.splitext(mod) # foo.ko -> (foo, .ko)
-                desc = module_desc(joinpaths(root,mod)) or "%s driver" % name
-                modinfo.append(dict(name=name, type=modtype, desc=desc))
+                modules.append((joinpaths(root, mod), mod, modtype))
+
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        descs = list(executor.map(module_desc, [m[0] for m in modules]))
+
+    modinfo = list()
+    for (_path, mod, modtype), desc in zip(modules, descs):
+        (name, _ext) = os.path.splitext(mod) # foo.ko -> (foo, .ko)
+        modinfo.append(dict(name=name, type=modtype, desc=desc or "%s driver" % name))
     _write_modinfo(modinfo, outfile or joinpaths(moddir,"module-info"))
 
+    if cachefile:
+        with open(cachefile + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.rename(cachefile + ".tmp", cachefile)
+
 def _write_modinfo(modinfo, outfile):
     if os.path.islink(outfile):
         os.unlink(outfile)
@@ -79,7 +155,9 @@ class RuntimeBuilder(object):
                  add_templates=None,
                  add_template_vars=None,
                  skip_branding=False,
-                 root=None):
+                 root=None,
+                 pkgcache=None,
+                 cachedir=None):
         self.dbo = dbo
         if dbo:
             root = dbo.get_config().installroot
@@ -89,7 +167,8 @@ class RuntimeBuilder(object):
 
         self._runner = LoraxTemplateRunner(inroot=root, outroot=root,
                                            dbo=dbo, templatedir=templatedir,
-                                           basearch=arch.basearch)
+                                           basearch=arch.basearch,
+                                           pkgcache=pkgcache, cachedir=cachedir)
         self.add_templates = add_templates or []
         self.add_template_vars = add_template_vars or {}
         self._installpkgs = installpkgs or []
@@ -185,65 +264,79 @@ class RuntimeBuilder(object):
         self._runner.run("runtime-cleanup.tmpl")
 
     def verify(self):
-        '''Ensure that contents of the installroot can run'''
-        status = True
+        '''Ensure that contents of the installroot can run
 
-        ELF_MAGIC = b'\x7fELF'
-
-        # Iterate over all files in /usr/bin
-        # NOTE: Fedora 42 has merged these into the same directory
-        # For ELF files, gather them into a list and we'll check them all at
-        # the end. For files with a #!, check them as we go
-        elf_files = []
-        for path in (str(x) for x in Path(self.vars.root + '/usr/bin').iterdir() \
-                     if x.is_file()):
-            with open(path, "rb") as f:
-                magic = f.read(4)
-                if magic == ELF_MAGIC:
-                    # Save the path, minus the chroot prefix
-                    elf_files.append(path[len(self.vars.root):])
-                elif magic[:2] == b'#!':
-                    # Reopen the file as text and read the first line.
-                    # Open as latin-1 so that stray 8-bit characters don't make
-                    # things blow up. We only really care about ASCII parts.
-                    with open(path, "rt", encoding="latin-1") as f_text:
-                        # Remove the #!, split on space, and take the first part
-                        shabang = f_text.readline()[2:].split()[0]
-
-                    # Does the path exist?
-                    if not os.path.exists(self.vars.root + shabang):
-                        logger.error('%s, needed by %s, does not exist', shabang, path)
-                        status = False
-
-        # Now, run ldd on all the ELF files
-        # Just run ldd once on everything so it isn't logged a million times.
-        # At least one thing in the list isn't going to be a dynamic executable,
-        # so use execWithCapture to ignore the exit code.
-        filename = ''
-        for line in execWithCapture('ldd', elf_files, root=self.vars.root,
-                log_output=False, filter_stderr=True).split('\n'):
-            if line and not line[0].isspace():
-                # New filename header, strip the : at the end and save
-                filename = line[:-1]
-            elif 'not found' in line:
-                logger.error('%s, needed by %s, not found', line.split()[0], filename)
-                status = False
+        The shared libraries needed by the ELF files, and the interpreters of
+        the scripts, in /usr/bin must exist. Problems with the files in
+        /usr/sbin, /usr/libexec, and the library directories are logged as
+        warnings. The libraries are found by reading the ELF files, nothing
+        in the installroot is run.
+        '''
+        root = self.vars.root
+        verifier = ElfVerifier(root)
+
+        # (directory, problems are errors, check scripts)
+        # NOTE: Fedora 42 has merged /usr/sbin into /usr/bin
+        checks = [("/usr/bin", True, True), ("/usr/sbin", False, True), ("/usr/libexec", False, True),
+                  ("/usr/lib64", False, False), ("/usr/lib", False, False)]
+        # Kernel modules and firmware aren't linked against anything
+        skip = ("/usr/lib/modules", "/usr/lib/firmware")
+
+        status = True
+        seen = set()
+        for topdir, fatal, scripts in checks:
+            elf_files = []
+            if not os.path.isdir(root + topdir) or os.path.islink(root + topdir):
+                continue
+            for dirpath, dirs, files in os.walk(root + topdir):
+                dirs[:] = [d for d in dirs if joinpaths(dirpath, d)[len(root):] not in skip]
+                for f in files:
+                    path = joinpaths(dirpath, f)
+                    if path in seen or not os.path.isfile(path) or os.path.islink(path):
+                        continue
+                    seen.add(path)
+                    with open(path, "rb") as fp:
+                        magic = fp.read(4)
+                    if magic == ELF_MAGIC:
+                        # Save the path, minus the chroot prefix
+                        elf_files.append(path[len(root):])
+                    elif scripts and magic[:2] == b'#!':
+                        # Reopen the file as text and read the first line.
+                        # Open as latin-1 so that stray 8-bit characters don't make
+                        # things blow up. We only really care about ASCII parts.
+                        with open(path, "rt", encoding="latin-1") as f_text:
+                            # Remove the #!, split on space, and take the first part
+                            shabang = f_text.readline()[2:].split()
+                        if shabang and not resolve_path(root, shabang[0]):
+                            if fatal:
+                                logger.error('%s, needed by %s, does not exist', shabang[0], path)
+                                status = False
+                            else:
+                                logger.warning('%s, needed by %s, does not exist', shabang[0], path)
+
+            for lib, needed_by in verifier.check(elf_files):
+                if fatal:
+                    logger.error('%s, needed by %s, not found', lib, needed_by)
+                    status = False
+                else:
+                    logger.warning('%s, needed by %s, not found', lib, needed_by)
 
         return status
 
-    def generate_module_data(self):
+    def generate_module_data(self, cachefile=None):
         root = self.vars.root
         moddir = joinpaths(root, "lib/modules/")
         for kernel in findkernels(root=root):
             ksyms = joinpaths(root, "boot/System.map-%s" % kernel.version)
             logger.info("doing depmod and module-info for %s", kernel.version)
             runcmd(["depmod", "-a", "-F", ksyms, "-b", root, kernel.version])
-            generate_module_info(moddir+kernel.version, outfile=moddir+"module-info")
+            generate_module_info(moddir+kernel.version, outfile=moddir+"module-info",
+                                 cachefile=cachefile)
 
     def create_squashfs_runtime(self, outfile="/var/tmp/squashfs.img", compression="xz", compressargs=None, size=2):
         """Create a plain squashfs runtime"""
         compressargs = compressargs or []
-        os.makedirs(os.path.dirname(outfile))
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
 
         # squash the rootfs
         return imgutils.mksquashfs(self.vars.root, outfile, compression, compressargs)
@@ -261,7 +354,7 @@ class RuntimeBuilder(object):
                                  "Anaconda", size=size)
         except CalledProcessError as e:
             if e.stdout and "No space left on device" in e.stdout:
-                logger.error("The rootfs ran out of space with size=%d", size)
+                logger.error("The rootfs ran out of space with size=%s", size or "auto")
             raise
 
         # squash the live rootfs and clean up workdir
@@ -272,7 +365,7 @@ class RuntimeBuilder(object):
     def create_erofs_runtime(self, outfile="/var/tmp/erofs.img", compression="zstd", compressargs=None, size=2):
         """Create a plain erofs runtime"""
         compressargs = compressargs or []
-        os.makedirs(os.path.dirname(outfile))
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
 
         # erofs the rootfs
         return imgutils.mkerofs(self.vars.root, outfile, compression, compressargs)
@@ -290,7 +383,7 @@ class RuntimeBuilder(object):
                                  "Anaconda", size=size)
         except CalledProcessError as e:
             if e.stdout and "No space left on device" in e.stdout:
-                logger.error("The rootfs ran out of space with size=%d", size)
+                logger.error("The rootfs ran out of space with size=%s", size or "auto")
             raise
 
         # compress the live rootfs and clean up workdir
@@ -305,7 +398,8 @@ class TreeBuilder(object):
     '''Builds the arch-specific boot images.
     inroot should be the installtree root (the newly-built runtime dir)'''
     def __init__(self, product, arch, inroot, outroot, runtime, isolabel, domacboot=True, doupgrade=True,
-                 templatedir=None, add_templates=None, add_template_vars=None, workdir=None, extra_boot_args=""):
+                 templatedir=None, add_templates=None, add_template_vars=None, workdir=None, extra_boot_args="",
+                 cachedir=None):
 
         # NOTE: if you pass an arg named "runtime" to a mako template it'll
         # clobber some mako internal variables - hence "runtime_img".
@@ -317,7 +411,7 @@ class TreeBuilder(object):
                                workdir=workdir, lower=string_lower,
                                extra_boot_args=extra_boot_args)
         self._runner = LoraxTemplateRunner(inroot, outroot, templatedir=templatedir,
-                                           basearch=arch.basearch)
+                                           basearch=arch.basearch, cachedir=cachedir)
         self._runner.defaults = self.vars
         self.add_templates = add_templates or []
         self.add_template_vars = add_template_vars or {}
@@ -328,7 +422,7 @@ class TreeBuilder(object):
     def kernels(self):
         return findkernels(root=self.vars.inroot)
 
-    def rebuild_initrds(self, add_args=None, backup="", prefix=""):
+    def rebuild_initrds(self, add_args=None, backup="", prefix="", jobs=1):
         '''Rebuild all the initrds in the tree. If backup is specified, each
         initrd will be renamed with backup as a suffix before rebuilding.
         If backup is empty, the existing initrd files will be overwritten.
@@ -337,6 +431,9 @@ class TreeBuilder(object):
 
         If the initrd doesn't exist its name will be created based on the
         name of the kernel.
+
+        jobs is the number of initrds to build at the same time, 0 uses
+        one job per cpu.
         '''
         add_args = add_args or []
         args = ["--nomdadmconf", "--nolvmconf"] + add_args
@@ -346,24 +443,27 @@ class TreeBuilder(object):
         if not self.kernels:
             raise RuntimeError("No kernels found, cannot rebuild_initrds")
 
-        with DracutChroot(self.vars.inroot) as dracut:
-            for kernel in self.kernels:
-                if prefix:
-                    idir = os.path.dirname(kernel.path)
-                    outfile = joinpaths(idir, prefix+'-'+kernel.version+'.img')
-                elif hasattr(kernel, "initrd"):
-                    # If there is an existing initrd, use that
-                    outfile = kernel.initrd.path
-                else:
-                    # Construct an initrd from the kernel name
-                    outfile = kernel.path.replace("vmlinuz-", "initrd-") + ".img"
-                logger.info("rebuilding %s", outfile)
+        dracut_jobs = []
+        for kernel in self.kernels:
+            if prefix:
+                idir = os.path.dirname(kernel.path)
+                outfile = joinpaths(idir, prefix+'-'+kernel.version+'.img')
+            elif hasattr(kernel, "initrd"):
+                # If there is an existing initrd, use that
+                outfile = kernel.initrd.path
+            else:
+                # Construct an initrd from the kernel name
+                outfile = kernel.path.replace("vmlinuz-", "initrd-") + ".img"
+            logger.info("rebuilding %s", outfile)
+
+            if backup:
+                initrd = joinpaths(self.vars.inroot, outfile)
+                if os.path.exists(initrd):
+                    os.rename(initrd, initrd + backup)
+            dracut_jobs.append(args + [outfile, kernel.version])
 
-                if backup:
-                    initrd = joinpaths(self.vars.inroot, outfile)
-                    if os.path.exists(initrd):
-                        os.rename(initrd, initrd + backup)
-                dracut.Run(args + [outfile, kernel.version])
+        with DracutChroot(self.vars.inroot) as dracut:
+            dracut.RunJobs(dracut_jobs, jobs)
 
     def build(self):
         templatefile = templatemap[self.vars.arch.basearch]
@@ -377,7 +477,7 @@ class TreeBuilder(object):
         for _section, data in self.treeinfo_data.items():
             if 'boot.iso' in data:
                 iso = joinpaths(self.vars.outroot, data['boot.iso'])
-                runcmd(["implantisomd5", iso])
+                implant_isomd5(iso)
 
     @property
     def dracut_hooks_path(self):
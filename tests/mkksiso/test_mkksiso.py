@@ -7,11 +7,13 @@ import subprocess
 import tempfile
 import time
 import unittest
+from unittest import mock
 
 from mkksiso import AlterKernelArgs, JoinKernelArgs, SplitCmdline, quote, WrapKernelArgs
 from mkksiso import GetCmdline, ListKernelArgs, udev_escape
 from mkksiso import EditIsolinux, EditGrub2, EditS390
 from mkksiso import CheckDiscinfo, GetISODetails, ExtractISOFiles, MakeKickstartISO
+from mkksiso import ReadBatchSpecs, MakeKickstartISOs
 
 
 def check_cfg_results(self, tmpdir, configs):
@@ -108,6 +110,58 @@ console=tty1 quiet rhgb
             with self.assertRaises(RuntimeError):
                 CheckDiscinfo(tmpdir + "/.discinfo.bad")
 
+    def test_ReadBatchSpecs(self):
+        with tempfile.TemporaryDirectory(prefix="mkksiso-") as tmpdir:
+            defaults = {"cmdline": "console=ttyS0", "rm_args": "", "add_paths": ["/srv/repo"]}
+
+            # A JSON list
+            with open(tmpdir + "/batch.json", "w") as f:
+                f.write('[{"output": "one.iso", "ks": "one.ks"},'
+                        ' {"output": "/srv/isos/two.iso", "volid": "TWO", "add": ["extra"],'
+                        ' "replace": [["FROM", "TO"]], "rm_args": "quiet"}]')
+            specs = ReadBatchSpecs(tmpdir + "/batch.json", "/var/tmp/out", defaults)
+            self.assertEqual(len(specs), 2)
+            self.assertEqual(specs[0]["output_iso"], "/var/tmp/out/one.iso")
+            self.assertEqual(specs[0]["ks"], tmpdir + "/one.ks")
+            self.assertEqual(specs[0]["rm_args"], "inst.ks")
+            self.assertEqual(specs[0]["cmdline"], "console=ttyS0")
+            self.assertEqual(specs[0]["add_paths"], ["/srv/repo"])
+            self.assertEqual(specs[1]["output_iso"], "/srv/isos/two.iso")
+            self.assertEqual(specs[1]["new_volid"], "TWO")
+            self.assertEqual(specs[1]["add_paths"], [tmpdir + "/extra"])
+            self.assertEqual(specs[1]["replace_list"], [("FROM", "TO")])
+            self.assertEqual(specs[1]["rm_args"], "quiet")
+
+            # The default lists are not shared between the isos
+            self.assertIsNot(specs[0]["add_paths"], defaults["add_paths"])
+
+            # One object per line
+            with open(tmpdir + "/batch.jsonl", "w") as f:
+                f.write('{"output": "one.iso"}\n\n{"output": "two.iso", "cmdline": "two"}\n')
+            specs = ReadBatchSpecs(tmpdir + "/batch.jsonl", "/var/tmp/out")
+            self.assertEqual([s["output_iso"] for s in specs], ["/var/tmp/out/one.iso", "/var/tmp/out/two.iso"])
+            self.assertEqual(specs[1]["cmdline"], "two")
+
+            # Unknown keys and missing outputs are errors
+            for data in ['[{"output": "one.iso", "kickstart": "one.ks"}]', '[{"ks": "one.ks"}]', '{"output": ']:
+                with open(tmpdir + "/bad.json", "w") as f:
+                    f.write(data)
+                with self.assertRaises(RuntimeError):
+                    ReadBatchSpecs(tmpdir + "/bad.json", tmpdir)
+
+    def test_MakeKickstartISOs_errors(self):
+        """Test that an unexpected error making one iso does not stop the others"""
+        def make_iso(_input_iso, output_iso, **_kwargs):
+            if output_iso == "/var/tmp/out/bad.iso":
+                raise KeyError("volid")
+
+        specs = [{"output_iso": "/var/tmp/out/good.iso"}, {"output_iso": "/var/tmp/out/bad.iso"}]
+        with mock.patch("mkksiso.SourceISO"), \
+             mock.patch("mkksiso.MakeKickstartISO", side_effect=make_iso) as mk:
+            with self.assertRaisesRegex(RuntimeError, "Failed to make /var/tmp/out/bad.iso$"):
+                MakeKickstartISOs("/var/tmp/boot.iso", specs, jobs=2)
+        self.assertEqual(mk.call_count, 2)
+
 
 class EditConfigsTestCase(unittest.TestCase):
     def setUp(self):
@@ -296,3 +350,22 @@ class ISOTestCase(unittest.TestCase):
             self.assertTrue(filecmp.cmp(os.path.join(tmpdir, "1", "test.iso"),
                                         os.path.join(tmpdir, "2", "test.iso"), shallow=False),
                             "ISO are not identical")
+
+    def test_MakeKickstartISOs(self):
+        """
+        Test making several isos from one input iso
+        """
+        with tempfile.TemporaryDirectory(prefix="mkksiso-dir-") as tmpdir:
+            specs = [{"output_iso": tmpdir + "/one.iso", "cmdline": "one=1", "new_volid": "Fedora-one"},
+                     {"output_iso": tmpdir + "/two.iso", "cmdline": "two=2", "new_volid": "Fedora-two"},
+                     {"output_iso": tmpdir + "/three.iso", "cmdline": "three=3"}]
+            MakeKickstartISOs(self.test_iso, specs, skip_efi=True, jobs=2)
+
+            for iso, volid, arg in [("one.iso", "Fedora-one", "one=1"),
+                                    ("two.iso", "Fedora-two", "two=2"),
+                                    ("three.iso", "Fedora-rawhide-test", "three=3")]:
+                self.assertEqual(GetISODetails(tmpdir + "/" + iso)[0], volid)
+                with tempfile.TemporaryDirectory(prefix="mkksiso-") as extractdir:
+                    ExtractISOFiles(tmpdir + "/" + iso, ["boot/grub2/grub.cfg"], extractdir)
+                    with open(extractdir + "/boot/grub2/grub.cfg") as f:
+                        self.assertIn(arg, f.read())
@@ -0,0 +1,105 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import tempfile
+import unittest
+
+from pylorax.checkpoint import Checkpoints, hash_paths
+from pylorax.sysutils import joinpaths
+
+def run_stages(workdir, stages, resume):
+    """Run the stages, returning the names of the ones that were not skipped"""
+    checkpoints = Checkpoints(workdir, stages, resume=resume)
+    ran = []
+    for name, _inputs, _restart in stages:
+        if checkpoints.needed(name):
+            ran.append(name)
+            with open(joinpaths(workdir, name), "w") as f:
+                f.write(name)
+            checkpoints.done(name, [joinpaths(workdir, name)])
+    return ran
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="lorax.test.checkpoint.")
+        self.stages = [("install", ["anaconda"], True),
+                       ("cleanup", "cleanup-1", False),
+                       ("runtime", "squashfs", True),
+                       ("build", "x86", True)]
+
+    def tearDown(self):
+        for f in os.listdir(self.workdir):
+            os.unlink(joinpaths(self.workdir, f))
+        os.rmdir(self.workdir)
+
+    def test_hash_paths(self):
+        """Test hashing files and directories"""
+        with open(joinpaths(self.workdir, "x86.tmpl"), "w") as f:
+            f.write("# x86 template\n")
+        digest = hash_paths([self.workdir])
+        self.assertEqual(hash_paths([self.workdir]), digest)
+        with open(joinpaths(self.workdir, "x86.tmpl"), "a") as f:
+            f.write("# edited\n")
+        self.assertNotEqual(hash_paths([self.workdir]), digest)
+        self.assertNotEqual(hash_paths([joinpaths(self.workdir, "missing")]), digest)
+
+    def test_no_resume(self):
+        """Test that every stage runs without resume"""
+        self.assertEqual(run_stages(self.workdir, self.stages, False), ["install", "cleanup", "runtime", "build"])
+        self.assertEqual(run_stages(self.workdir, self.stages, False), ["install", "cleanup", "runtime", "build"])
+
+    def test_resume_finished(self):
+        """Test that resuming a finished build skips everything"""
+        run_stages(self.workdir, self.stages, False)
+        self.assertEqual(run_stages(self.workdir, self.stages, True), [])
+
+    def test_resume_changed(self):
+        """Test that resume runs the changed stage and the ones after it"""
+        run_stages(self.workdir, self.stages, False)
+        self.stages[2] = ("runtime", "erofs", True)
+        self.assertEqual(run_stages(self.workdir, self.stages, True), ["runtime", "build"])
+        self.assertEqual(run_stages(self.workdir, self.stages, True), [])
+
+    def test_resume_restart(self):
+        """Test that a changed stage that cannot be restarted runs the stage before it"""
+        run_stages(self.workdir, self.stages, False)
+        self.stages[1] = ("cleanup", "cleanup-2", False)
+        self.assertEqual(run_stages(self.workdir, self.stages, True), ["install", "cleanup", "runtime", "build"])
+
+    def test_resume_failed(self):
+        """Test resuming a build that failed part way through"""
+        checkpoints = Checkpoints(self.workdir, self.stages)
+        checkpoints.done("install")
+        checkpoints.done("cleanup")
+        self.assertEqual(run_stages(self.workdir, self.stages, True), ["runtime", "build"])
+
+    def test_resume_output_changed(self):
+        """Test that a stage runs again when its output has been removed"""
+        run_stages(self.workdir, self.stages, False)
+        os.unlink(joinpaths(self.workdir, "runtime"))
+        self.assertEqual(run_stages(self.workdir, self.stages, True), ["runtime", "build"])
+
+    def test_previous_outputs(self):
+        """Test the outputs recorded by the previous run"""
+        self.assertEqual(Checkpoints(self.workdir, self.stages, resume=True).previous_outputs(), set())
+        run_stages(self.workdir, self.stages, False)
+        self.stages[2] = ("runtime", "erofs", True)
+        checkpoints = Checkpoints(self.workdir, self.stages, resume=True)
+        # The stages that are going to run again are still listed
+        self.assertEqual(checkpoints.previous_outputs(), set(joinpaths(self.workdir, name)
+                                                             for name, _inputs, _restart in self.stages))
+        self.assertEqual(Checkpoints(self.workdir, self.stages, resume=False).previous_outputs(), set())
@@ -0,0 +1,103 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import os
+import subprocess
+import tempfile
+import unittest
+
+from pylorax.checksum import sparse_sha256, file_checksum, record_checksum, checksum_files
+from pylorax.checksum import write_checksums
+from pylorax.imgutils import mkcpio
+from pylorax.sysutils import joinpaths
+
+def sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class ChecksumTest(unittest.TestCase):
+    def test_sparse_sha256(self):
+        """Test hashing sparse files"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            path = joinpaths(tmpdir, "empty")
+            open(path, "wb").close()
+            self.assertEqual(sparse_sha256(path), hashlib.sha256(b"").hexdigest())
+
+            # Data in the middle, not aligned, and a hole at the end
+            path = joinpaths(tmpdir, "sparse")
+            with open(path, "wb") as f:
+                f.seek(3 * 1024**2 + 123)
+                f.write(os.urandom(100000))
+                f.seek(5 * 1024**2)
+                f.write(b"more data")
+                f.truncate(9 * 1024**2 + 7)
+            self.assertEqual(sparse_sha256(path), sha256(path))
+
+            path = joinpaths(tmpdir, "full")
+            with open(path, "wb") as f:
+                f.write(os.urandom(1024**2 + 17))
+            self.assertEqual(sparse_sha256(path), sha256(path))
+
+    def test_record_checksum(self):
+        """Test using the checksum recorded while writing a file"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            path = joinpaths(tmpdir, "file")
+            with open(path, "wb") as f:
+                f.write(b"written")
+            record_checksum(path, "recorded")
+            self.assertEqual(file_checksum(path), "recorded")
+
+            # Changing the file invalidates the recorded checksum
+            with open(path, "ab") as f:
+                f.write(b" again")
+            self.assertEqual(file_checksum(path), sha256(path))
+
+    def test_mkcpio_checksum(self):
+        """Test hashing the compressed output while it is written"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            os.makedirs(joinpaths(tmpdir, "root", "etc"))
+            with open(joinpaths(tmpdir, "root", "etc", "passwd"), "w") as f:
+                f.write("root:x:0:0:root:/root:/bin/bash\n")
+            for compression in [None, "zstd"]:
+                outfile = joinpaths(tmpdir, "initrd-%s.img" % compression)
+                self.assertEqual(mkcpio(joinpaths(tmpdir, "root"), outfile, compression=compression), 0)
+                self.assertEqual(checksum_files([outfile])[outfile], sha256(outfile))
+
+    def test_write_checksums(self):
+        """Test writing a CHECKSUM manifest"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            os.makedirs(joinpaths(tmpdir, "images", "pxeboot"))
+            for name, data in [("images/boot.iso", b"iso"), ("images/pxeboot/vmlinuz", b"kernel"),
+                               (".treeinfo", b"[general]\n")]:
+                with open(joinpaths(tmpdir, name), "wb") as f:
+                    f.write(data)
+            os.symlink("boot.iso", joinpaths(tmpdir, "images", "link.iso"))
+
+            manifest = write_checksums(tmpdir)
+            self.assertEqual(manifest, joinpaths(tmpdir, "CHECKSUM"))
+            with open(manifest) as f:
+                lines = f.read().splitlines()
+            self.assertIn("# images/boot.iso: 3 bytes", lines)
+            self.assertIn("SHA256 (images/boot.iso) = %s" % hashlib.sha256(b"iso").hexdigest(), lines)
+            self.assertEqual(len([l for l in lines if l.startswith("SHA256")]), 3)
+
+            # Writing it again doesn't include the old manifest
+            write_checksums(tmpdir)
+            with open(manifest) as f:
+                self.assertNotIn("CHECKSUM", f.read().replace("# The image checksum", ""))
+
+            subprocess.check_call(["sha256sum", "--quiet", "-c", "CHECKSUM"], cwd=tmpdir)
@@ -30,6 +30,7 @@ from pylorax.base import DataHolder
 from pylorax.creator import FakeDNF, create_pxe_config, make_appliance, make_runtime, squashfs_args
 from pylorax.creator import calculate_disk_size, dracut_args, DRACUT_DEFAULT
 from pylorax.creator import get_arch, find_ostree_root, check_kickstart, make_livecd
+from pylorax.creator import make_multi_images, multi_output_name, image_cache_key
 from pylorax.executils import runcmd_output
 from pylorax.sysutils import joinpaths
 
@@ -471,23 +472,141 @@ class CreatorTest(unittest.TestCase):
                     # Test with no dracut args
                     opts = DataHolder(project="Fedora", releasever="32", lorax_templates=lorax_templates, volid=None,
                                       release="", variant="", bugurl="", isfinal=False,
-                                      domacboot=False, extra_boot_args="", dracut_args=None, dracut_conf=None)
+                                      domacboot=False, extra_boot_args="", dracut_args=None, dracut_conf=None,
+                                      dracut_jobs=1)
                     make_livecd(opts, joinpaths(tmpdir, "mount_dir"), joinpaths(tmpdir, "work_dir"))
-                    ri.assert_called_with(add_args=DRACUT_DEFAULT)
+                    ri.assert_called_with(add_args=DRACUT_DEFAULT, jobs=1)
 
                     # Test with --dracut-arg
                     opts = DataHolder(project="Fedora", releasever="32", lorax_templates=lorax_templates, volid=None,
                                       release="", variant="", bugurl="", isfinal=False,
                                       domacboot=False, extra_boot_args="", 
-                                      dracut_args=["--xz",  "--omit plymouth", "--add livenet dmsquash-live dmsquash-live-ntfs"], dracut_conf=None)
+                                      dracut_args=["--xz",  "--omit plymouth", "--add livenet dmsquash-live dmsquash-live-ntfs"], dracut_conf=None,
+                                      dracut_jobs=0)
                     make_livecd(opts, joinpaths(tmpdir, "mount_dir"), joinpaths(tmpdir, "work_dir"))
-                    ri.assert_called_with(add_args=["--xz",  "--omit", "plymouth", "--add", "livenet dmsquash-live dmsquash-live-ntfs"])
+                    ri.assert_called_with(add_args=["--xz",  "--omit", "plymouth", "--add", "livenet dmsquash-live dmsquash-live-ntfs"], jobs=0)
 
 
                     # Test with --dracut-conf
                     opts = DataHolder(project="Fedora", releasever="32", lorax_templates=lorax_templates, volid=None,
                                       release="", variant="", bugurl="", isfinal=False,
                                       domacboot=False, extra_boot_args="", dracut_args=None, 
-                                      dracut_conf="/var/tmp/project/lmc-dracut.conf")
+                                      dracut_conf="/var/tmp/project/lmc-dracut.conf", dracut_jobs=4)
                     make_livecd(opts, joinpaths(tmpdir, "mount_dir"), joinpaths(tmpdir, "work_dir"))
-                    ri.assert_called_with(add_args=["--conf", "/var/tmp/project/lmc-dracut.conf"])
+                    ri.assert_called_with(add_args=["--conf", "/var/tmp/project/lmc-dracut.conf"], jobs=4)
+
+    def test_multi_output_name(self):
+        """Test the --make-multi output names"""
+        opts = DataHolder(compression="zstd", oci_layout=False)
+        self.assertEqual(multi_output_name(opts, "iso"), "iso")
+        self.assertEqual(multi_output_name(opts, "pxe-live"), "pxe-live")
+        self.assertEqual(multi_output_name(opts, "tar"), "root.tar.zst")
+        self.assertEqual(multi_output_name(opts, "oci"), "bundle.tar.zst")
+        self.assertEqual(multi_output_name(opts, "qcow2"), "disk.qcow2")
+        self.assertEqual(multi_output_name(opts, "vagrant"), "vagrant.tar.zst")
+        opts.oci_layout = True
+        self.assertEqual(multi_output_name(opts, "oci"), "oci-archive.tar")
+
+    def test_make_multi_images(self):
+        """Test running the --make-multi outputs in parallel"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            disk_img = joinpaths(tmpdir, "disk.img")
+            with open(disk_img, "wb") as f:
+                f.truncate(10 * 1024**2)
+
+            def fake_output(_opts, output, _disk_img, _img_mount, disk_size, outfile):
+                self.assertEqual(disk_size, 10)
+                if output == "qcow2":
+                    raise RuntimeError("qemu-img failed")
+                open(outfile, "w").close()
+
+            opts = DataHolder(make_multi=["tar", "qcow2", "oci"], multi_jobs=0, result_dir=tmpdir,
+                              compression="xz", oci_layout=True)
+            with mock.patch("pylorax.creator.PartitionMount") as pm:
+                pm.return_value.__enter__.return_value.mount_dir = tmpdir
+                with mock.patch("pylorax.creator.make_multi_output", side_effect=fake_output):
+                    with self.assertRaisesRegex(RuntimeError, "Creating qcow2 failed"):
+                        make_multi_images(opts, disk_img)
+                    pm.assert_called_with(disk_img, read_only=True)
+
+                    opts.make_multi = ["tar", "oci"]
+                    results = make_multi_images(opts, disk_img)
+            self.assertEqual([r.output for r in results], ["tar", "oci"])
+            self.assertEqual([r.error for r in results], [None, None])
+            self.assertTrue(os.path.exists(joinpaths(tmpdir, "root.tar.xz")))
+            self.assertTrue(os.path.exists(joinpaths(tmpdir, "oci-archive.tar")))
+
+    def test_make_multi_images_iso(self):
+        """Test the --make-multi iso is finished before the root partition is mounted"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            disk_img = joinpaths(tmpdir, "disk.img")
+            with open(disk_img, "wb") as f:
+                f.truncate(10 * 1024**2)
+
+            with mock.patch("pylorax.creator.PartitionMount") as pm:
+                pm.return_value.__enter__.return_value.mount_dir = tmpdir
+                def fake_output(_opts, output, _disk_img, img_mount, _disk_size, outfile):
+                    if output == "tar":
+                        self.assertIsNotNone(img_mount)
+                    else:
+                        self.assertIsNone(img_mount)
+                    if output == "iso":
+                        pm.assert_not_called()
+                    open(outfile, "w").close()
+
+                opts = DataHolder(make_multi=["tar", "iso", "qcow2"], multi_jobs=0, result_dir=tmpdir,
+                                  compression="xz", oci_layout=False)
+                with mock.patch("pylorax.creator.make_multi_output", side_effect=fake_output):
+                    results = make_multi_images(opts, disk_img)
+            self.assertEqual([r.output for r in results], ["tar", "iso", "qcow2"])
+            self.assertEqual([r.error for r in results], [None, None, None])
+
+    def test_image_cache_key(self):
+        """Test the image cache key"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            os.makedirs(joinpaths(tmpdir, "repo", "repodata"))
+            with open(joinpaths(tmpdir, "repo", "repodata", "repomd.xml"), "w") as f:
+                f.write("<repomd>first</repomd>")
+            with open(joinpaths(tmpdir, "boot.iso"), "wb") as f:
+                f.write(b"boot.iso")
+            ks_path = joinpaths(tmpdir, "test.ks")
+            with open(ks_path, "w") as f:
+                f.write("url --url=file://%s/repo\n"
+                        "part / --size=4096\n"
+                        "shutdown\n" % tmpdir)
+
+            opts = DataHolder(no_virt=False, make_iso=True, make_fsimage=False, make_pxe_live=False,
+                              make_tar=False, make_oci=False, make_vagrant=False, make_tar_disk=False,
+                              iso=joinpaths(tmpdir, "boot.iso"), ks=[ks_path], arch="x86_64",
+                              releasever="40", image_type=None, qemu_args=[], fs_label="Anaconda",
+                              image_size_align=0, virt_uefi=False, kernel_args=None, anaconda_args=None)
+            def key():
+                ks = KickstartParser(makeVersion(), errorsAreFatal=False, missingIncludeIsFatal=False)
+                ks.readKickstart(ks_path)
+                return image_cache_key(opts, ks)
+
+            first = key()
+            self.assertEqual(len(first), 64)
+            self.assertEqual(key(), first)
+
+            # The same disk image is used for --make-iso and --make-pxe-live
+            opts.make_iso = False
+            opts.make_pxe_live = True
+            self.assertEqual(key(), first)
+
+            # Changes to the repository, installer, or kickstart make a new key
+            with open(joinpaths(tmpdir, "repo", "repodata", "repomd.xml"), "w") as f:
+                f.write("<repomd>second</repomd>")
+            second = key()
+            self.assertNotEqual(second, first)
+            with open(joinpaths(tmpdir, "boot.iso"), "wb") as f:
+                f.write(b"new boot.iso")
+            third = key()
+            self.assertNotEqual(third, second)
+            with open(ks_path, "a") as f:
+                f.write("%packages\nkernel\n%end\n")
+            self.assertNotEqual(key(), third)
+
+            # Only images are cached
+            opts.make_tar = True
+            self.assertIsNone(key())
@@ -0,0 +1,147 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import struct
+import tempfile
+import unittest
+
+from pylorax.elfutils import ElfVerifier, read_elf, read_ld_so_conf, resolve_path
+from pylorax.sysutils import joinpaths
+
+def make_fake_elf(needed=None, runpath=None, rpath=None, interp=None, elfclass=2, has_strtab=True):
+    """Return a little endian ELF file with a dynamic section and no code
+
+    :param needed: DT_NEEDED library names
+    :type needed: list of str
+    :param str runpath: DT_RUNPATH
+    :param str rpath: DT_RPATH
+    :param str interp: Program interpreter
+    :param int elfclass: 1 for 32 bit, 2 for 64 bit
+    :param bool has_strtab: Include the DT_STRTAB entry
+    """
+    strtab = b"\0"
+    def add_string(s):
+        nonlocal strtab
+        offset = len(strtab)
+        strtab += s.encode("utf-8") + b"\0"
+        return offset
+
+    dynamic = [(1, add_string(n)) for n in needed or []]
+    if runpath:
+        dynamic.append((29, add_string(runpath)))
+    if rpath:
+        dynamic.append((15, add_string(rpath)))
+
+    if elfclass == 2:
+        ehsize, phentsize, phdr, dyn = 64, 56, "<IIQQQQQQ", "<qQ"
+    else:
+        ehsize, phentsize, phdr, dyn = 52, 32, "<IIIIIIII", "<iI"
+    phnum = 3 if interp else 2
+    strtab_off = ehsize + phnum * phentsize
+    if has_strtab:
+        dynamic.append((5, strtab_off))
+    dynamic.append((0, 0))
+    interp_data = interp.encode("utf-8") + b"\0" if interp else b""
+    interp_off = strtab_off + len(strtab)
+    dyn_off = interp_off + len(interp_data)
+    dyn_data = b"".join(struct.pack(dyn, tag, val) for tag, val in dynamic)
+    size = dyn_off + len(dyn_data)
+
+    def program_header(p_type, offset, filesz):
+        if elfclass == 2:
+            return struct.pack(phdr, p_type, 4, offset, offset, offset, filesz, filesz, 8)
+        return struct.pack(phdr, p_type, offset, offset, offset, filesz, filesz, 4, 4)
+
+    data = b"\x7fELF" + bytes([elfclass, 1, 1]) + b"\0" * 9
+    if elfclass == 2:
+        data += struct.pack("<HHIQQQIHHHHHH", 3, 62, 1, 0, ehsize, 0, 0, ehsize, phentsize, phnum, 64, 0, 0)
+    else:
+        data += struct.pack("<HHIIIIIHHHHHH", 3, 3, 1, 0, ehsize, 0, 0, ehsize, phentsize, phnum, 40, 0, 0)
+    data += program_header(1, 0, size)
+    data += program_header(2, dyn_off, len(dyn_data))
+    if interp:
+        data += program_header(3, interp_off, len(interp_data))
+    return data + strtab + interp_data + dyn_data
+
+class ElfUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="lorax.test.root.")
+        for d in ["usr/bin", "usr/lib64", "usr/lib/baz", "opt/bar/lib", "etc/ld.so.conf.d"]:
+            os.makedirs(joinpaths(self.root, d))
+        os.symlink("usr/lib64", joinpaths(self.root, "lib64"))
+
+        def write(path, data):
+            with open(joinpaths(self.root, path), "wb") as f:
+                f.write(data)
+
+        interp = "/lib64/ld-linux-x86-64.so.2"
+        write("usr/lib64/ld-linux-x86-64.so.2", make_fake_elf())
+        write("usr/bin/foo", make_fake_elf(["libfoo.so.1", "libmissing.so.1"], interp=interp))
+        write("usr/bin/baz", make_fake_elf(["libbaz.so"], runpath="$ORIGIN/../lib/baz", interp=interp))
+        write("usr/lib/baz/libbaz.so", make_fake_elf(["libfoo.so.1"]))
+        write("usr/lib64/libfoo.so.1.0", make_fake_elf(["libbar.so.1", "libother.so.1"]))
+        os.symlink("libfoo.so.1.0", joinpaths(self.root, "usr/lib64/libfoo.so.1"))
+        write("opt/bar/lib/libbar.so.1", make_fake_elf())
+        # A 32 bit library is not used by 64 bit programs
+        write("usr/lib64/libother.so.1", make_fake_elf(elfclass=1))
+        write("etc/ld.so.conf", b"include ld.so.conf.d/*.conf\n")
+        write("etc/ld.so.conf.d/bar.conf", b"# bar libraries\n/opt/bar/lib\n")
+
+    def tearDown(self):
+        for dirpath, dirs, files in os.walk(self.root, topdown=False):
+            for f in files:
+                os.unlink(joinpaths(dirpath, f))
+            for d in dirs:
+                path = joinpaths(dirpath, d)
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    os.rmdir(path)
+        os.rmdir(self.root)
+
+    def test_read_elf(self):
+        """Test reading the dynamic section"""
+        info = read_elf(joinpaths(self.root, "usr/bin/baz"))
+        self.assertEqual(info.elfclass, 2)
+        self.assertEqual(info.needed, ["libbaz.so"])
+        self.assertEqual(info.runpath, ["$ORIGIN/../lib/baz"])
+        self.assertEqual(info.interp, "/lib64/ld-linux-x86-64.so.2")
+        self.assertEqual(read_elf(joinpaths(self.root, "etc/ld.so.conf")), None)
+
+        # Without a string table the names cannot be read
+        path = joinpaths(self.root, "usr/bin/nostrtab")
+        with open(path, "wb") as f:
+            f.write(make_fake_elf(["libfoo.so.1"], has_strtab=False))
+        info = read_elf(path)
+        self.assertEqual(info.elfclass, 2)
+        self.assertEqual(info.needed, [])
+
+    def test_read_ld_so_conf(self):
+        """Test reading ld.so.conf with includes"""
+        self.assertEqual(read_ld_so_conf(self.root), ["/opt/bar/lib"])
+
+    def test_resolve_path(self):
+        """Test resolving symlinks inside the root"""
+        self.assertEqual(resolve_path(self.root, "/lib64/libfoo.so.1"), "/usr/lib64/libfoo.so.1.0")
+        self.assertEqual(resolve_path(self.root, "/lib64/libmissing.so.1"), None)
+
+    def test_verifier(self):
+        """Test finding missing libraries"""
+        verifier = ElfVerifier(self.root)
+        self.assertEqual(verifier.check(["/usr/bin/foo", "/usr/bin/baz"]),
+                         [("libmissing.so.1", "/usr/bin/foo"),
+                          ("libother.so.1", "/usr/lib64/libfoo.so.1.0")])
@@ -0,0 +1,112 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from pylorax.fatimage import FATImage, mkfatimg
+
+
+def mkefidir(path):
+    """Make a fake EFI/BOOT directory"""
+    os.makedirs(os.path.join(path, "fonts"))
+    with open(os.path.join(path, "BOOTX64.EFI"), "wb") as f:
+        f.write(os.urandom(100000))
+    with open(os.path.join(path, "grub.cfg"), "w") as f:
+        f.write("set timeout=60\n")
+    with open(os.path.join(path, "fonts/unicode.pf2"), "wb") as f:
+        f.write(os.urandom(3000))
+    with open(os.path.join(path, "Long Mixed Case Name.txt"), "w") as f:
+        f.write("I AM A LONG NAME\n")
+
+def read_bpb(path):
+    with open(path, "rb") as f:
+        boot = f.read(512)
+    bps, spc, reserved, nfats, root_entries, total16 = struct.unpack_from("<HBHBHH", boot, 11)
+    total = total16 or struct.unpack_from("<I", boot, 32)[0]
+    fat32 = struct.unpack_from("<H", boot, 22)[0] == 0
+    ebpb = 64 if fat32 else 36
+    volume_id, label, fs_type = struct.unpack_from("<I11s8s", boot, ebpb + 3)
+    return bps, spc, total, volume_id, label, fs_type, boot[510:]
+
+
+class FATImageTest(unittest.TestCase):
+    def test_mkfatimg(self):
+        """Test writing a FAT image without mounting it"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            img = os.path.join(work_dir, "efiboot.img")
+            with mock.patch.dict(os.environ, {"SOURCE_DATE_EPOCH": "1700000000"}):
+                g = mkfatimg(img, graft={"EFI/BOOT": os.path.join(work_dir, "BOOT")}, label="ANACONDA")
+            self.assertEqual(g.fat_type, 12)
+            self.assertEqual(os.path.getsize(img), g.total * 512)
+            bps, spc, total, volume_id, label, fs_type, sig = read_bpb(img)
+            self.assertEqual((bps, spc * bps, total), (512, g.cluster_size, g.total))
+            self.assertEqual(volume_id, 1700000000)
+            self.assertEqual(label, b"ANACONDA   ")
+            self.assertEqual(fs_type, b"FAT12   ")
+            self.assertEqual(sig, b"\x55\xaa")
+
+            # The same files and SOURCE_DATE_EPOCH make the same image
+            img2 = os.path.join(work_dir, "efiboot2.img")
+            with mock.patch.dict(os.environ, {"SOURCE_DATE_EPOCH": "1700000000"}):
+                mkfatimg(img2, graft={"EFI/BOOT": os.path.join(work_dir, "BOOT")}, label="ANACONDA")
+            with open(img, "rb") as f1, open(img2, "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_fat_types(self):
+        """Test the FAT type and size of images"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            with open(os.path.join(work_dir, "initrd.img"), "wb") as f:
+                f.truncate(20 * 1024**2)
+            fat = FATImage(label="EFI", volume_id=0x1234abcd, timestamp=1700000000)
+            fat.add("EFI/BOOT", os.path.join(work_dir, "BOOT"))
+            fat.add("images/pxeboot/", os.path.join(work_dir, "initrd.img"))
+
+            img = os.path.join(work_dir, "efiboot.img")
+            for fat_type in (16, 32):
+                g = fat.write(img, fat_type=fat_type)
+                self.assertEqual(g.fat_type, fat_type)
+                self.assertEqual(read_bpb(img)[5], b"FAT%d   " % fat_type)
+                self.assertEqual(os.path.getsize(img), g.total * 512)
+
+            # An exact size
+            g = fat.write(img, size=64 * 1024**2)
+            self.assertEqual(os.path.getsize(img), 64 * 1024**2)
+            self.assertEqual(read_bpb(img)[2], 64 * 1024**2 // 512)
+
+            # Too small
+            with self.assertRaises(RuntimeError):
+                fat.write(img, size=1024**2)
+
+    def test_bad_names(self):
+        """Test names that do not fit"""
+        with self.assertRaises(RuntimeError):
+            FATImage(label="THIS IS TOO LONG")
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            fat = FATImage()
+            fat.add("EFI/BOOT", os.path.join(work_dir, "BOOT"))
+            with self.assertRaises(RuntimeError):
+                fat.add("efi/boot/fonts", os.path.join(work_dir, "BOOT/grub.cfg"))
+
+    @unittest.skipUnless(shutil.which("fsck.fat") and shutil.which("mtype"), "requires dosfstools and mtools")
+    def test_fsck_mtools(self):
+        """Test the image with fsck.fat and mtools"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            img = os.path.join(work_dir, "efiboot.img")
+            for fat_type in (12, 16, 32):
+                mkfatimg(img, graft={"EFI/BOOT": os.path.join(work_dir, "BOOT")}, label="ANACONDA",
+                         fat_type=fat_type)
+                subprocess.check_call(["fsck.fat", "-n", img])
+                env = dict(os.environ, MTOOLS_SKIP_CHECK="1")
+                grub_cfg = subprocess.check_output(["mtype", "-i", img, "::EFI/BOOT/grub.cfg"], env=env)
+                self.assertEqual(grub_cfg, b"set timeout=60\n")
+                long_name = subprocess.check_output(["mtype", "-i", img, "::EFI/BOOT/Long Mixed Case Name.txt"], env=env)
+                self.assertEqual(long_name, b"I AM A LONG NAME\n")
+                listing = subprocess.check_output(["mdir", "-i", img, "-b", "::EFI/BOOT/"], env=env)
+                self.assertIn(b"::/EFI/BOOT/grub.cfg", listing)
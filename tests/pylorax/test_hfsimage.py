@@ -0,0 +1,157 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from pylorax.hfsimage import HFSPlusImage, BLOCK_SIZE, NODE_SIZE
+from pylorax.cmdline.mkefiboot import mkmacboot
+
+
+def mkefidir(path):
+    """Make a fake EFI/BOOT directory"""
+    os.makedirs(os.path.join(path, "fonts"))
+    with open(os.path.join(path, "BOOTX64.EFI"), "wb") as f:
+        f.write(os.urandom(100000))
+    with open(os.path.join(path, "grubx64.efi"), "wb") as f:
+        f.write(os.urandom(200000))
+    with open(os.path.join(path, "grub.cfg"), "w") as f:
+        f.write("set timeout=60\n")
+    for i in range(500):
+        with open(os.path.join(path, "fonts/font-%03d.pf2" % i), "wb") as f:
+            f.write(os.urandom(100))
+
+def read_header(path):
+    with open(path, "rb") as f:
+        f.seek(1024)
+        header = f.read(512)
+        f.seek(-1024, os.SEEK_END)
+        alternate = f.read(512)
+    return header, alternate
+
+def read_catalog(path):
+    """Return the (parent id, name, record type, cnid, file contents) of the catalog leaf records"""
+    header, _ = read_header(path)
+    size, _, _, start = struct.unpack_from(">QIII", header, 272)
+    records = []
+    with open(path, "rb") as f:
+        f.seek(start * BLOCK_SIZE)
+        catalog = f.read(size)
+        node = struct.unpack_from(">I", catalog, 14 + 10)[0]
+        while node:
+            data = catalog[node * NODE_SIZE:(node + 1) * NODE_SIZE]
+            flink, _, kind, _, count = struct.unpack_from(">IIbBH", data)
+            assert kind == -1
+            for i in range(count):
+                offset = struct.unpack_from(">H", data, NODE_SIZE - 2 * (i + 1))[0]
+                key_length, parent_id, name_length = struct.unpack_from(">HIH", data, offset)
+                name = data[offset+8:offset+8+2*name_length].decode("utf-16-be")
+                record = offset + 2 + key_length
+                record_type = struct.unpack_from(">h", data, record)[0]
+                cnid = struct.unpack_from(">I", data, record + 8)[0] if record_type in (1, 2) else 0
+                contents = None
+                if record_type == 2:
+                    # The data fork's size and first extent
+                    fork_size, _, _, fork_start = struct.unpack_from(">QIII", data, record + 88)
+                    f.seek(fork_start * BLOCK_SIZE)
+                    contents = f.read(fork_size)
+                records.append((parent_id, name, record_type, cnid, contents))
+            node = flink
+    return records
+
+
+class HFSImageTest(unittest.TestCase):
+    def test_write(self):
+        """Test writing an HFS+ image without mounting it"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            img = HFSPlusImage(label="Fedora", timestamp=1700000000, volume_id=0x0123456789abcdef)
+            img.add("EFI/BOOT", os.path.join(work_dir, "BOOT"))
+            img.add_data("mach_kernel", b"Dummy kernel for booting")
+            img.copy("EFI/BOOT/grubx64.efi", "System/Library/CoreServices/")
+            self.assertEqual(img.glob("EFI/*/grub*.cfg"), ["EFI/BOOT/grub.cfg"])
+            img.bless("EFI/BOOT", "EFI/BOOT/grubx64.efi")
+
+            hfs_img = os.path.join(work_dir, "macboot.img")
+            g = img.write(hfs_img)
+            self.assertEqual(os.path.getsize(hfs_img), g.total_blocks * BLOCK_SIZE)
+            header, alternate = read_header(hfs_img)
+            self.assertEqual(header, alternate)
+            signature, version = struct.unpack_from(">2sH", header)
+            self.assertEqual((signature, version), (b"H+", 4))
+            file_count, folder_count, block_size, total_blocks = struct.unpack_from(">IIII", header, 32)
+            self.assertEqual((file_count, folder_count), (505, 6))
+            self.assertEqual((block_size, total_blocks), (BLOCK_SIZE, g.total_blocks))
+
+            # The blessed folder and file
+            finder_info = struct.unpack_from(">8I", header, 80)
+            self.assertEqual(finder_info[0], img.cnid("EFI/BOOT"))
+            self.assertEqual(finder_info[1], img.cnid("EFI/BOOT/grubx64.efi"))
+            self.assertEqual(finder_info[5], img.cnid("EFI/BOOT"))
+            self.assertEqual(finder_info[6:], (0x01234567, 0x89abcdef))
+
+            # The catalog is in order, with a thread for each record
+            records = read_catalog(hfs_img)
+            keys = [(parent_id, name.lower()) for parent_id, name, _, _, _ in records]
+            self.assertEqual(keys, sorted(keys))
+            self.assertEqual(sum(1 for r in records if r[2] in (3, 4)), file_count + folder_count + 1)
+            self.assertIn((1, "Fedora"), [(r[0], r[1]) for r in records if r[2] == 1])
+            files = dict(((r[0], r[1]), r[4]) for r in records if r[2] == 2)
+            with open(os.path.join(work_dir, "BOOT/grubx64.efi"), "rb") as f:
+                grub = f.read()
+            self.assertEqual(files[(img.cnid("EFI/BOOT"), "grubx64.efi")], grub)
+            self.assertEqual(files[(img.cnid("System/Library/CoreServices"), "grubx64.efi")], grub)
+            self.assertEqual(files[(2, "mach_kernel")], b"Dummy kernel for booting")
+
+            # The same files, timestamp, and volume id make the same image
+            hfs_img2 = os.path.join(work_dir, "macboot2.img")
+            img.write(hfs_img2)
+            with open(hfs_img, "rb") as f1, open(hfs_img2, "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+            # An exact size
+            g = img.write(hfs_img, size=16 * 1024**2)
+            self.assertEqual(os.path.getsize(hfs_img), 16 * 1024**2)
+            with self.assertRaises(RuntimeError):
+                img.write(hfs_img, size=1024**2)
+
+    def test_bad_paths(self):
+        """Test adding and blessing paths that do not fit"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            img = HFSPlusImage()
+            img.add("EFI/BOOT", os.path.join(work_dir, "BOOT"))
+            with self.assertRaises(RuntimeError):
+                img.add("efi/boot/FONTS", os.path.join(work_dir, "BOOT/grub.cfg"))
+            with self.assertRaises(RuntimeError):
+                img.bless("EFI/BOOT/grub.cfg", "EFI/BOOT/grubx64.efi")
+            with self.assertRaises(RuntimeError):
+                img.copy("EFI/BOOT/missing.efi", "System/")
+            with self.assertRaises(RuntimeError):
+                img.cnid("EFI/BOOT")
+
+    def test_mkmacboot(self):
+        """Test making a Mac EFI boot image as a user"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            hfs_img = os.path.join(work_dir, "macboot.img")
+            mkmacboot(os.path.join(work_dir, "BOOT"), hfs_img, "ANACONDA", product="Fedora 45")
+            records = read_catalog(hfs_img)
+            names = set(r[1] for r in records)
+            for name in ["mach_kernel", "SystemVersion.plist", "boot.efi", "grubx64.efi", "grub.cfg"]:
+                self.assertIn(name, names)
+            plist = [r[4] for r in records if r[1] == "SystemVersion.plist"][0]
+            self.assertIn(b"<string>Fedora 45</string>", plist)
+            finder_info = struct.unpack_from(">2I", read_header(hfs_img)[0], 80)
+            self.assertIn((finder_info[0], "grubx64.efi", 2, finder_info[1]),
+                          [(r[0], r[1], r[2], r[3]) for r in records])
+
+    @unittest.skipUnless(shutil.which("fsck.hfsplus"), "requires hfsplus-tools")
+    def test_fsck(self):
+        """Test the image with fsck.hfsplus"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mkefidir(os.path.join(work_dir, "BOOT"))
+            hfs_img = os.path.join(work_dir, "macboot.img")
+            mkmacboot(os.path.join(work_dir, "BOOT"), hfs_img, "ANACONDA")
+            subprocess.check_call(["fsck.hfsplus", "-f", "-n", hfs_img])
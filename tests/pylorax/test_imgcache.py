@@ -0,0 +1,120 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from pylorax.imgcache import ImageCache, repo_state
+from pylorax.sysutils import joinpaths
+
+def make_image(path, data=b"installed"):
+    """Make a sparse 8MiB image with some data in the middle"""
+    with open(path, "wb") as f:
+        f.truncate(8 * 1024**2)
+        f.seek(4 * 1024**2)
+        f.write(data)
+
+class ImageCacheTest(unittest.TestCase):
+    def test_get_put(self):
+        """Test storing and reusing an image"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            cache = ImageCache(joinpaths(tmpdir, "cache"))
+            disk_img = joinpaths(tmpdir, "disk.img")
+            self.assertFalse(cache.get("abcd", disk_img))
+            self.assertFalse(os.path.exists(disk_img))
+
+            make_image(disk_img)
+            cache.put("abcd", disk_img, {"kickstart": "test.ks"})
+            self.assertTrue(os.path.exists(joinpaths(tmpdir, "cache", "abcd.json")))
+
+            # The copy is independent of the cached image, and still sparse
+            reused = joinpaths(tmpdir, "reused.img")
+            self.assertTrue(cache.get("abcd", reused))
+            with open(reused, "r+b") as f:
+                f.write(b"changed")
+            with open(disk_img, "rb") as a, open(joinpaths(tmpdir, "cache", "abcd.img"), "rb") as b:
+                self.assertEqual(a.read(), b.read())
+            self.assertLess(os.stat(reused).st_blocks * 512, 8 * 1024**2)
+
+    def test_evict(self):
+        """Test removing the least recently used images"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            cache = ImageCache(joinpaths(tmpdir, "cache"), size=1024**3)
+            for key in ["old", "new"]:
+                disk_img = joinpaths(tmpdir, key + ".img")
+                with open(disk_img, "wb") as f:
+                    f.write(os.urandom(1024**2))
+                cache.put(key, disk_img)
+            past = time.time() - 3600
+            os.utime(joinpaths(tmpdir, "cache", "old.img"), (past, past))
+
+            cache.size = 1024**2 + 4096
+            cache.evict()
+            self.assertFalse(os.path.exists(joinpaths(tmpdir, "cache", "old.img")))
+            self.assertFalse(os.path.exists(joinpaths(tmpdir, "cache", "old.json")))
+            self.assertTrue(os.path.exists(joinpaths(tmpdir, "cache", "new.img")))
+
+    def test_put_errors(self):
+        """Test images that are not stored"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            cache = ImageCache(joinpaths(tmpdir, "cache"), size=1024**2)
+            disk_img = joinpaths(tmpdir, "disk.img")
+            with open(disk_img, "wb") as f:
+                f.write(os.urandom(2 * 1024**2))
+
+            # Larger than the cache
+            cache.put("large", disk_img)
+            self.assertEqual(os.listdir(joinpaths(tmpdir, "cache")), [])
+
+            # The temporary copy is removed when storing the image fails
+            make_image(disk_img)
+            with mock.patch("pylorax.imgcache.os.rename", side_effect=OSError(28, "No space left on device")):
+                with self.assertRaises(OSError):
+                    cache.put("full", disk_img)
+            self.assertFalse([f for f in os.listdir(joinpaths(tmpdir, "cache")) if f.endswith(".tmp")])
+
+    def test_repo_state(self):
+        """Test the repository state digest"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            os.makedirs(joinpaths(tmpdir, "repo", "repodata"))
+            with open(joinpaths(tmpdir, "repo", "repodata", "repomd.xml"), "w") as f:
+                f.write("<repomd>first</repomd>")
+            baseurl = "file://" + joinpaths(tmpdir, "repo")
+            first = repo_state(baseurl)
+            self.assertEqual(first, hashlib.sha256(b"<repomd>first</repomd>").hexdigest())
+
+            # The first mirror is used
+            with open(joinpaths(tmpdir, "mirrorlist"), "w") as f:
+                f.write("# mirrors\n%s/\nhttp://mirror.example.com/\n" % baseurl)
+            self.assertEqual(repo_state(mirrorlist="file://" + joinpaths(tmpdir, "mirrorlist")), first)
+
+            with open(joinpaths(tmpdir, "repo", "repodata", "repomd.xml"), "w") as f:
+                f.write("<repomd>second</repomd>")
+            self.assertNotEqual(repo_state(baseurl), first)
+
+            # The metalink has the checksum of repomd.xml
+            with open(joinpaths(tmpdir, "metalink"), "w") as f:
+                f.write('<metalink><files><file name="repomd.xml"><verification>'
+                        '<hash type="md5">1234</hash><hash type="sha256">ABCDEF</hash>'
+                        '</verification></file></files></metalink>')
+            self.assertEqual(repo_state(metalink="file://" + joinpaths(tmpdir, "metalink")), "abcdef")
+
+            with self.assertRaises(RuntimeError):
+                repo_state()
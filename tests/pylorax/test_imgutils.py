@@ -14,22 +14,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import errno
 import glob
+import hashlib
+import io
+import json
 import os
 import parted
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, PIPE, run
 import tarfile
 import tempfile
 import unittest
 
 from ..lib import get_file_magic
-from pylorax.executils import runcmd
-from pylorax.imgutils import mkcpio, mktar, mksquashfs, mksparse, mkqcow2, mkerofs
+from pylorax.executils import runcmd, runcmd_output
+from pylorax.imgutils import mkcpio, mktar, mksquashfs, mksparse, mkqcow2, mkerofs, mkoci
 from pylorax.imgutils import loop_attach, loop_detach
 from pylorax.imgutils import get_loop_name, LoopDev, dm_attach, dm_detach, DMDev, Mount
-from pylorax.imgutils import mkdosimg, mkext4img, mkbtrfsimg, mkhfsimg, default_image_name
+from pylorax.imgutils import mkdosimg, mkext4img, mkbtrfsimg, mkhfsimg, default_image_name, mkfs_populate
+from pylorax.imgutils import default_compress_args
+from pylorax.imgutils import estimate_size, TreeUsage
 from pylorax.imgutils import mount, umount, kpartx_disk_img, PartitionMount, mkfsimage_from_disk
-from pylorax.imgutils import DracutChroot
+from pylorax.imgutils import DracutChroot, dig_holes, _write_compressed, OciArchiveWriter, CpioWriter
 from pylorax.sysutils import joinpaths
 
 def mkfakerootdir(rootdir):
@@ -134,6 +140,53 @@ class ImgUtilsTest(unittest.TestCase):
                 file_details = get_file_magic(disk_img.name)
                 self.assertTrue("cpio" in file_details, file_details)
 
+    def test_mkcpio_contents(self):
+        """Test the contents of the cpio archive made by mkcpio"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+                mkfakerootdir(work_dir)
+                os.link(joinpaths(work_dir, "/etc/passwd"), joinpaths(work_dir, "/etc/passwd-"))
+                os.symlink("../etc/passwd", joinpaths(work_dir, "/root/passwd"))
+                os.environ["SOURCE_DATE_EPOCH"] = "1000000000"
+                try:
+                    self.assertEqual(mkcpio(work_dir, disk_img.name, compression=None), 0)
+                finally:
+                    del os.environ["SOURCE_DATE_EPOCH"]
+
+                with open(disk_img.name, "rb") as f:
+                    names = run(["cpio", "-t", "--quiet"], stdin=f, stdout=PIPE, check=True).stdout
+                self.assertEqual(names.decode("utf-8").splitlines(),
+                                 [".", "./etc", "./etc/passwd", "./etc/passwd-", "./home", "./home/bart",
+                                  "./home/bart/.bashrc", "./root", "./root/.bashrc", "./root/passwd",
+                                  "./usr", "./usr/bin", "./usr/local"])
+
+                with tempfile.TemporaryDirectory(prefix="lorax.test.") as out_dir:
+                    with open(disk_img.name, "rb") as f:
+                        run(["cpio", "-idm", "--quiet"], stdin=f, cwd=out_dir, check=True)
+                    with open(joinpaths(out_dir, "/etc/passwd-")) as f:
+                        self.assertEqual(f.read(), "I AM FAKE FILE /ETC/PASSWD")
+                    self.assertEqual(os.stat(joinpaths(out_dir, "/etc/passwd")).st_ino,
+                                     os.stat(joinpaths(out_dir, "/etc/passwd-")).st_ino)
+                    self.assertEqual(os.readlink(joinpaths(out_dir, "/root/passwd")), "../etc/passwd")
+                    self.assertEqual(os.stat(joinpaths(out_dir, "/home/bart/.bashrc")).st_mtime, 1000000000)
+
+    def test_cpio_limits(self):
+        """Test the newc header limits of CpioWriter"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            old_file = joinpaths(work_dir, "old")
+            open(old_file, "w").close()
+            os.utime(old_file, (-1000, -1000))
+            out = io.BytesIO()
+            CpioWriter(out).write_tree(old_file)
+            # Times before the epoch are stored as the epoch, the mtime is the 6th field
+            self.assertEqual(out.getvalue()[46:54], b"00000000")
+
+            big_file = joinpaths(work_dir, "big")
+            with open(big_file, "wb") as f:
+                f.truncate(4 * 1024**3)
+            with self.assertRaises(RuntimeError):
+                CpioWriter(io.BytesIO()).write_tree(big_file)
+
     def test_mktar(self):
         """Test mktar function"""
         with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
@@ -153,7 +206,8 @@ class ImgUtilsTest(unittest.TestCase):
                 for (compression, magic) in [("xz", "XZ compressed"),
                                              ("lzma", "LZMA compressed"),
                                              ("gzip", "gzip compressed"),
-                                             ("bzip2", "bzip2 compressed")]:
+                                             ("bzip2", "bzip2 compressed"),
+                                             ("zstd", "Zstandard compressed")]:
                     os.unlink(disk_img.name)
                     mktar(work_dir, disk_img.name, compression=compression)
 
@@ -161,6 +215,85 @@ class ImgUtilsTest(unittest.TestCase):
                     file_details = get_file_magic(disk_img.name)
                     self.assertTrue(magic in file_details, (compression, magic, file_details))
 
+    def test_write_compressed_error(self):
+        """Test that an error writing the archive stops the compressor"""
+        def write_archive(fobj):
+            fobj.write(os.urandom(1000))
+            raise ValueError("bad archive entry")
+
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            outfile = joinpaths(work_dir, "archive.xz")
+            with self.assertRaises(ValueError):
+                _write_compressed(outfile, "xz", None, write_archive)
+
+    def test_mktar_bundle(self):
+        """Test mktar with a prefix and extra files, like an OCI runtime bundle"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            root_dir = joinpaths(work_dir, "root")
+            os.makedirs(root_dir)
+            mkfakerootdir(root_dir)
+            os.link(joinpaths(root_dir, "/etc/passwd"), joinpaths(root_dir, "/etc/passwd-"))
+            with open(joinpaths(work_dir, "config.json"), "w") as f:
+                f.write("{}")
+            tar_img = joinpaths(work_dir, "bundle.tar")
+            mktar(root_dir, tar_img, compression=None, prefix="rootfs",
+                  extra_files=[joinpaths(work_dir, "config.json")])
+
+            with tarfile.TarFile(tar_img) as t:
+                names = t.getnames()
+                self.assertEqual(names[0], "./rootfs")
+                self.assertEqual(names[-1], "./config.json")
+                self.assertEqual(names[1:-1], sorted(names[1:-1]))
+                self.assertTrue("./rootfs/etc/passwd" in names)
+                passwd = t.getmember("./rootfs/etc/passwd-")
+                self.assertTrue(passwd.islnk())
+                self.assertEqual(passwd.linkname, "./rootfs/etc/passwd")
+
+    def test_mkoci(self):
+        """Test making an OCI image layout archive"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            root_dir = joinpaths(work_dir, "root")
+            os.makedirs(root_dir)
+            mkfakerootdir(root_dir)
+            oci_img = joinpaths(work_dir, "oci-archive.tar")
+            self.assertEqual(mkoci(root_dir, oci_img, compression=None, arch="x86_64",
+                                   config={"Cmd": ["/bin/bash"]}), 0)
+
+            with tarfile.TarFile(oci_img) as t:
+                def blob(digest):
+                    data = t.extractfile("blobs/sha256/" + digest[7:]).read()
+                    self.assertEqual("sha256:" + hashlib.sha256(data).hexdigest(), digest)
+                    return data
+
+                self.assertEqual(json.load(t.extractfile("oci-layout")), {"imageLayoutVersion": "1.0.0"})
+                index = json.load(t.extractfile("index.json"))
+                self.assertEqual(index["manifests"][0]["platform"]["architecture"], "amd64")
+                manifest = json.loads(blob(index["manifests"][0]["digest"]))
+                config = json.loads(blob(manifest["config"]["digest"]))
+                self.assertEqual(config["config"]["Cmd"], ["/bin/bash"])
+                layer = manifest["layers"][0]
+                self.assertEqual(layer["mediaType"], "application/vnd.oci.image.layer.v1.tar")
+                # Uncompressed, the layer's digest is the same as its diff_id
+                self.assertEqual(config["rootfs"]["diff_ids"], [layer["digest"]])
+                with tarfile.open(fileobj=io.BytesIO(blob(layer["digest"]))) as lt:
+                    self.assertTrue("./etc/passwd" in lt.getnames())
+
+    def test_oci_layer_disk_full(self):
+        """Test that an OCI layer fails when the output cannot be written"""
+        class FullFile(io.BytesIO):
+            def write(self, data):
+                if self.tell() + len(data) > 64 * 1024:
+                    raise OSError(errno.ENOSPC, "No space left on device")
+                return super().write(data)
+
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with open(joinpaths(work_dir, "random"), "wb") as f:
+                f.write(os.urandom(8 * 1024**2))
+            writer = OciArchiveWriter(FullFile())
+            with self.assertRaises(OSError) as e:
+                writer.add_layer(work_dir, compression="zstd", selinux=False)
+            self.assertEqual(e.exception.errno, errno.ENOSPC)
+
     def test_mktar_single_file(self):
         with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img,\
                 tempfile.NamedTemporaryFile(prefix="lorax.test.input.") as input_file:
@@ -202,6 +335,28 @@ class ImgUtilsTest(unittest.TestCase):
             mksparse(disk_img.name, 42 * 1024**2)
             self.assertEqual(os.stat(disk_img.name).st_size, 42 * 1024**2)
 
+    def test_dig_holes(self):
+        """Test making the zeroed blocks of an image sparse"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+            # Written zeros, data, more written zeros, a hole, and a short block at the end
+            data = os.urandom(8192 + 100)
+            disk_img.write(bytes(8 * 1024**2))
+            disk_img.write(data)
+            disk_img.write(bytes(6 * 1024**2 - 100))
+            disk_img.seek(20 * 1024**2)
+            disk_img.write(b"end")
+            disk_img.flush()
+            with open(disk_img.name, "rb") as f:
+                before = f.read()
+
+            r = dig_holes(disk_img.name)
+            self.assertEqual(r.apparent, 20 * 1024**2 + 3)
+            self.assertLess(r.allocated, 1024**2)
+            self.assertGreater(r.allocated_before, 14 * 1024**2)
+            self.assertEqual(r.read, 14 * 1024**2 + 8192 + 3)
+            with open(disk_img.name, "rb") as f:
+                self.assertEqual(f.read(), before)
+
     def test_mkqcow2(self):
         """Test mkqcow2 function"""
         with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
@@ -288,6 +443,42 @@ class ImgUtilsTest(unittest.TestCase):
                 file_details = get_file_magic(disk_img.name)
                 self.assertTrue("ext2 filesystem" in file_details, file_details)
 
+    def test_mkext4img_populate(self):
+        """Test mkext4img without a loop device"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+                mkfakerootdir(work_dir)
+                self.assertTrue(mkfs_populate("ext4", work_dir, disk_img.name, 16*1024**2, ["-L", "Anaconda"]))
+                file_details = get_file_magic(disk_img.name)
+                self.assertTrue(any(s in file_details for s in ("ext2 filesystem", "ext4 filesystem")), file_details)
+                passwd = runcmd_output(["debugfs", "-R", "cat /etc/passwd", disk_img.name])
+                self.assertTrue("I AM FAKE FILE /ETC/PASSWD" in passwd, passwd)
+
+                # Grafts need to use a loop device
+                graft = {"ext4test/": "./tests/pylorax/templates/install-cmd.tmpl"}
+                self.assertFalse(mkfs_populate("ext4", work_dir, disk_img.name, 16*1024**2, graft=graft))
+
+    def test_estimate_size(self):
+        """Test estimating the size of an ext4 filesystem"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            with tempfile.NamedTemporaryFile(prefix="lorax.test.disk.") as disk_img:
+                mkfakerootdir(work_dir)
+                with open(joinpaths(work_dir, "large-file"), "w") as f:
+                    f.write("A" * 8 * 1024**2)
+                # Hard links and holes don't use any more space
+                os.link(joinpaths(work_dir, "large-file"), joinpaths(work_dir, "large-file-link"))
+                with open(joinpaths(work_dir, "sparse-file"), "w") as f:
+                    f.truncate(1024**3)
+
+                usage = TreeUsage()
+                usage.add(work_dir)
+                self.assertEqual(usage.files.count(8 * 1024**2), 1)
+                self.assertEqual(max(usage.files), 8 * 1024**2)
+
+                size = estimate_size(work_dir, fstype="ext4")
+                self.assertTrue(8 * 1024**2 < size < 16 * 1024**2, size)
+                self.assertTrue(mkfs_populate("ext4", work_dir, disk_img.name, size, ["-b", "4096", "-m", "0"]))
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def test_small_mkext4img(self):
         """Test mkext4img error handling"""
@@ -328,10 +519,19 @@ class ImgUtilsTest(unittest.TestCase):
 
     def test_default_image_name(self):
         """Test default_image_name function"""
-        for compression, suffix in [("xz", ".xz"), ("gzip", ".gz"), ("bzip2", ".bz2"), ("lzma", ".lzma")]:
+        for compression, suffix in [("xz", ".xz"), ("gzip", ".gz"), ("bzip2", ".bz2"), ("lzma", ".lzma"), ("zstd", ".zst")]:
             filename = default_image_name(compression, "foobar")
             self.assertTrue(filename.endswith(suffix))
 
+    def test_default_compress_args(self):
+        """Test default_compress_args function"""
+        self.assertEqual(default_compress_args("xz"), ["-9"])
+        self.assertEqual(default_compress_args("zstd"), ["-19", "--long=27"])
+        self.assertEqual(default_compress_args("gzip"), [])
+        # The caller can change the list without changing the defaults
+        default_compress_args("zstd").append("-v")
+        self.assertEqual(default_compress_args("zstd"), ["-19", "--long=27"])
+
     @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
     def test_partition_mount(self):
         """Test PartitionMount context manager (requires loop)"""
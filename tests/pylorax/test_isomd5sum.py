@@ -0,0 +1,83 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from pylorax.isomd5sum import implant_isomd5, check_isomd5, SECTOR_SIZE, APPDATA_OFFSET, APPDATA_SIZE
+
+
+def mkfakeiso(path, sectors=1024):
+    """Make a file with random data and an iso volume descriptor"""
+    data = bytearray(os.urandom(sectors * SECTOR_SIZE))
+    pvd = 16 * SECTOR_SIZE
+    data[pvd:pvd+SECTOR_SIZE] = bytes(SECTOR_SIZE)
+    data[pvd] = 1
+    data[pvd+1:pvd+6] = b"CD001"
+    data[pvd+80:pvd+88] = struct.pack("<I", sectors) + struct.pack(">I", sectors)
+    data[pvd+SECTOR_SIZE] = 255
+    data[pvd+SECTOR_SIZE+1:pvd+SECTOR_SIZE+6] = b"CD001"
+    with open(path, "wb") as f:
+        f.write(data)
+
+def flip_byte(path, offset):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        b = f.read(1)
+        f.seek(offset)
+        f.write(bytes([b[0] ^ 0xff]))
+
+
+class IsoMD5SumTest(unittest.TestCase):
+    def test_implant_check(self):
+        """Test implanting and checking the md5"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            iso = os.path.join(work_dir, "test.iso")
+            mkfakeiso(iso)
+            md5 = implant_isomd5(iso)
+            with open(iso, "rb") as f:
+                f.seek(16 * SECTOR_SIZE + APPDATA_OFFSET)
+                appdata = f.read(APPDATA_SIZE)
+            self.assertTrue(appdata.startswith(b"ISO MD5SUM = %s;SKIPSECTORS = 15;" % md5.encode("ascii")))
+            self.assertIn(b"FRAGMENT COUNT = 20;", appdata)
+            self.assertTrue(check_isomd5(iso))
+
+            # It is already implanted
+            with self.assertRaises(RuntimeError):
+                implant_isomd5(iso)
+            self.assertEqual(implant_isomd5(iso, force=True), md5)
+
+            # The skipped sectors at the end are not checked
+            flip_byte(iso, 1024 * SECTOR_SIZE - 1)
+            self.assertTrue(check_isomd5(iso))
+
+            # Changing the data is caught by a fragment sum
+            flip_byte(iso, 512 * SECTOR_SIZE)
+            self.assertFalse(check_isomd5(iso))
+
+    def test_not_implanted(self):
+        """Test checking an iso without an md5"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            iso = os.path.join(work_dir, "test.iso")
+            mkfakeiso(iso)
+            with self.assertRaises(RuntimeError):
+                check_isomd5(iso)
+
+            with open(iso, "wb") as f:
+                f.write(bytes(64 * SECTOR_SIZE))
+            with self.assertRaises(RuntimeError):
+                implant_isomd5(iso)
+
+    @unittest.skipUnless(shutil.which("checkisomd5") and shutil.which("implantisomd5"), "requires isomd5sum")
+    def test_isomd5sum_compatible(self):
+        """Test that the isomd5sum tools and these functions agree"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            iso = os.path.join(work_dir, "test.iso")
+            mkfakeiso(iso)
+            implant_isomd5(iso)
+            subprocess.check_call(["checkisomd5", iso])
+
+            mkfakeiso(iso)
+            subprocess.check_call(["implantisomd5", iso])
+            self.assertTrue(check_isomd5(iso))
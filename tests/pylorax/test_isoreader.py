@@ -0,0 +1,134 @@
+import os
+import stat
+import subprocess
+import tempfile
+import unittest
+
+from pylorax.isoreader import ISOReader, PLATFORM_X86, PLATFORM_EFI
+from pylorax.sysutils import joinpaths
+
+
+def mktestiso(rootdir, volid, args=None):
+    """Make an iso with a few files, a symlink, and boot images"""
+    sysroot = joinpaths(rootdir, "sysroot")
+    files = {"images/pxeboot/vmlinuz": b"I AM FAKE KERNEL\n" * 1000,
+             "images/pxeboot/initrd.img": b"I AM FAKE INITRD\n",
+             "images/efiboot.img": b"E" * 4096,
+             "isolinux/isolinux.bin": b"B" * 2048,
+             "a-long-file-name-with-MixedCase.txt": b"LONG NAME\n",
+             "empty": b""}
+    for f, data in files.items():
+        p = joinpaths(sysroot, f)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(p, "wb") as ff:
+            ff.write(data)
+    os.chmod(joinpaths(sysroot, "images/pxeboot/vmlinuz"), 0o755)
+    if "-R" in (args or []):
+        os.symlink("images/pxeboot/vmlinuz", joinpaths(sysroot, "vmlinuz"))
+
+    iso = joinpaths(rootdir, "test.iso")
+    cmd = ["xorrisofs", "-o", iso, "-V", volid] + (args or []) + [
+           "-b", "isolinux/isolinux.bin", "-c", "isolinux/boot.cat",
+           "-no-emul-boot", "-boot-load-size", "4",
+           "-eltorito-alt-boot", "-e", "images/efiboot.img", "-no-emul-boot",
+           sysroot]
+    subprocess.check_call(cmd)
+    return iso, files
+
+
+class ISOReaderTest(unittest.TestCase):
+    def test_rock_ridge(self):
+        """Test reading an iso with Rock Ridge and Joliet"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            iso_path, files = mktestiso(work_dir, "Fedora-test-iso-x86_64", ["-R", "-J"])
+            with ISOReader(iso_path) as iso:
+                self.assertEqual(iso.volume_id, "Fedora-test-iso-x86_64")
+                self.assertTrue(iso.rock_ridge)
+                self.assertTrue(iso.joliet)
+
+                listing = iso.find()
+                for f in files:
+                    self.assertIn(f, listing)
+                self.assertIn("images/pxeboot", listing)
+                self.assertEqual(sorted(iso.listdir("/images")), ["efiboot.img", "pxeboot"])
+
+                for f, data in files.items():
+                    self.assertEqual(iso.read(f), data)
+                    self.assertEqual(iso.stat(f).size, len(data))
+                self.assertEqual(stat.S_IMODE(iso.stat("images/pxeboot/vmlinuz").mode), 0o755)
+                self.assertTrue(iso.isdir("/images/pxeboot"))
+                self.assertTrue(iso.isfile("/images/pxeboot/vmlinuz"))
+                self.assertFalse(iso.exists("/images/pxeboot/missing"))
+                with self.assertRaises(FileNotFoundError):
+                    iso.stat("/images/pxeboot/missing")
+
+                # Symlinks are not followed
+                self.assertTrue(iso.stat("vmlinuz").is_link)
+                self.assertEqual(iso.stat("vmlinuz").target, "images/pxeboot/vmlinuz")
+                self.assertFalse(iso.isfile("vmlinuz"))
+
+                # Streaming reads and seeks
+                with iso.open("images/pxeboot/vmlinuz") as f:
+                    f.seek(17 * 500)
+                    self.assertEqual(f.read(17), b"I AM FAKE KERNEL\n")
+                    self.assertEqual(len(f.read()), 17 * 499)
+
+                # The path table lists the directories, the root is first
+                table = iso.path_table()
+                self.assertEqual(table[0].name, "")
+                self.assertEqual(len(table), 4)
+
+                catalog = iso.boot_catalog()
+                self.assertEqual([e.platform for e in catalog], [PLATFORM_X86, PLATFORM_EFI])
+                self.assertTrue(all(e.bootable for e in catalog))
+                self.assertEqual(catalog[0].lba, iso.stat("isolinux/isolinux.bin").extents[0][0])
+                self.assertEqual(catalog[1].lba, iso.stat("images/efiboot.img").extents[0][0])
+
+    def test_joliet(self):
+        """Test reading the Joliet names from an iso without Rock Ridge"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            iso_path, _ = mktestiso(work_dir, "Fedora-test-iso-x86_64", ["-J"])
+            with ISOReader(iso_path) as iso:
+                self.assertFalse(iso.rock_ridge)
+                self.assertTrue(iso.joliet)
+                self.assertIn("a-long-file-name-with-MixedCase.txt", iso.listdir())
+                self.assertEqual(iso.read("images/pxeboot/initrd.img"), b"I AM FAKE INITRD\n")
+
+    def test_iso9660(self):
+        """Test reading the plain ISO9660 names, lowercased without the version"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            iso_path, _ = mktestiso(work_dir, "Fedora-test-iso-x86_64")
+            with ISOReader(iso_path) as iso:
+                self.assertFalse(iso.rock_ridge)
+                self.assertFalse(iso.joliet)
+                self.assertIn("images/pxeboot/initrd.img", iso.find())
+                self.assertEqual(iso.read("images/pxeboot/initrd.img"), b"I AM FAKE INITRD\n")
+
+    def test_extract(self):
+        """Test extracting files and directories"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            iso_path, files = mktestiso(work_dir, "Fedora-test-iso-x86_64", ["-R", "-J"])
+            with ISOReader(iso_path) as iso:
+                dest = joinpaths(work_dir, "extract")
+                iso.extract("/", dest)
+                for f, data in files.items():
+                    with open(joinpaths(dest, f), "rb") as ff:
+                        self.assertEqual(ff.read(), data)
+                self.assertEqual(os.readlink(joinpaths(dest, "vmlinuz")), "images/pxeboot/vmlinuz")
+                self.assertEqual(stat.S_IMODE(os.stat(joinpaths(dest, "images/pxeboot/vmlinuz")).st_mode), 0o755)
+                self.assertEqual(os.stat(joinpaths(dest, "empty")).st_size, 0)
+
+                # Extracted files can be edited
+                iso.extract("images/pxeboot/initrd.img", joinpaths(work_dir, "a/b/initrd.img"))
+                with open(joinpaths(work_dir, "a/b/initrd.img"), "ab") as ff:
+                    ff.write(b"EDITED\n")
+
+    def test_not_iso(self):
+        """Test opening a file that is not an iso"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.") as f:
+            with self.assertRaises(RuntimeError):
+                ISOReader(f.name)
+            f.write(b"\0" * 64 * 1024)
+            f.flush()
+            with self.assertRaises(RuntimeError):
+                ISOReader(f.name)
@@ -20,14 +20,44 @@ from rpmfluff import SimpleRpmBuild, SourceFile, expectedArch
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
 import libdnf5 as dnf5
 
 from pylorax.dnfbase import get_dnf_base_object
 from pylorax.ltmpl import LoraxTemplate, LoraxTemplateRunner
-from pylorax.ltmpl import brace_expand, split_and_expand, rglob, rexists
+from pylorax.ltmpl import brace_expand, split_and_expand, rglob, rexists, RemovalPlan
+from pylorax.ltmpl import PackageFileIndex
 from pylorax.sysutils import joinpaths
 
+class FakePackage(object):
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+
+    def get_name(self):
+        return self.name
+
+    def get_files(self):
+        return self.files
+
+class FakeTransactionPackage(object):
+    def __init__(self, pkg):
+        self.pkg = pkg
+
+    def get_action(self):
+        return dnf5.base.transaction.TransactionItemAction_INSTALL
+
+    def get_package(self):
+        return self.pkg
+
+class FakeTransaction(object):
+    def __init__(self, pkgs):
+        self.pkgs = pkgs
+
+    def get_transaction_packages(self):
+        return [FakeTransactionPackage(p) for p in self.pkgs]
+
 class TemplateFunctionsTestCase(unittest.TestCase):
     def test_brace_expand(self):
         """Test expanding braces"""
@@ -55,6 +85,67 @@ class TemplateFunctionsTestCase(unittest.TestCase):
         self.assertTrue(rexists("chmod*tmpl", "./tests/pylorax/templates"))
         self.assertFalse(rexists("einstein", "./tests/pylorax/templates"))
 
+    def test_package_file_index(self):
+        """Test the index of package files"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            os.makedirs(joinpaths(tmpdir, "usr/share/doc/foo"))
+            transaction = FakeTransaction([FakePackage("foo", ["/usr/bin/foo", "/usr/share/doc/foo"]),
+                                           FakePackage("foo-libs", ["/usr/lib64/libfoo.so.1"]),
+                                           FakePackage("bar", ["/usr/bin/bar", "/usr/share/doc/foo"])])
+            index = PackageFileIndex(transaction, tmpdir)
+            self.assertEqual(index.packages("foo*"), set(["foo", "foo-libs"]))
+            self.assertEqual(index.packages("foo", "missing"), set(["foo"]))
+            self.assertEqual(index.files("foo"), set(["/usr/bin/foo"]))
+            self.assertEqual(index.files("foo*"), set(["/usr/bin/foo", "/usr/lib64/libfoo.so.1"]))
+
+            # Directories are cached until the index is invalidated
+            os.rmdir(joinpaths(tmpdir, "usr/share/doc/foo"))
+            self.assertEqual(index.files("foo"), set(["/usr/bin/foo"]))
+            index.invalidate()
+            self.assertEqual(index.files("foo"), set(["/usr/bin/foo", "/usr/share/doc/foo"]))
+
+    def test_removal_plan(self):
+        """Test removing files with a RemovalPlan"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            os.makedirs(joinpaths(tmpdir, "usr/share/doc/pkg"))
+            for f in ["usr/share/doc/pkg/README", "usr/bin/foo", "usr/bin/bar"]:
+                os.makedirs(os.path.dirname(joinpaths(tmpdir, f)), exist_ok=True)
+                with open(joinpaths(tmpdir, f), "w") as fp:
+                    fp.write("x" * 1024)
+
+            plan = RemovalPlan()
+            self.assertEqual(plan.add("remove /usr/share/doc", [joinpaths(tmpdir, "usr/share/doc")]), 1024)
+            # Files inside a directory being removed are not counted twice
+            self.assertEqual(plan.add("removepkg pkg", [joinpaths(tmpdir, "usr/share/doc/pkg/README"),
+                                                        joinpaths(tmpdir, "usr/bin/foo"),
+                                                        joinpaths(tmpdir, "missing")]), 1024)
+            self.assertEqual(len(plan), 2)
+            plan.execute()
+            self.assertEqual(len(plan), 0)
+            self.assertFalse(os.path.exists(joinpaths(tmpdir, "usr/share/doc")))
+            self.assertFalse(os.path.exists(joinpaths(tmpdir, "usr/bin/foo")))
+            self.assertTrue(os.path.exists(joinpaths(tmpdir, "usr/bin/bar")))
+
+    def test_removal_errors(self):
+        """Test errors from batched removals are handled as errors of the line that removed them"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            runner = LoraxTemplateRunner(inroot=tmpdir, outroot=tmpdir)
+            with mock.patch("pylorax.ltmpl.os.unlink", side_effect=PermissionError("denied")):
+                # Errors are ignored on a -remove line
+                open(joinpaths(tmpdir, "lorax-file"), "w").close()
+                runner._run([["-remove", "/lorax-file"], ["mkdir", "/lorax-dir"]])
+                self.assertTrue(os.path.isdir(joinpaths(tmpdir, "lorax-dir")))
+
+                # And raised before the next command runs on a remove line
+                with self.assertRaises(PermissionError):
+                    runner._run([["remove", "/lorax-file"], ["mkdir", "/lorax-dir-2"]])
+                self.assertFalse(os.path.exists(joinpaths(tmpdir, "lorax-dir-2")))
+
+                # The removals are not left for the next template when a batched command fails
+                with self.assertRaises(IndexError):
+                    runner._run([["remove", "/lorax-file"], ["removefrom", "lorax-pkg"]])
+                self.assertEqual(len(runner._removals), 0)
+
 class LoraxTemplateTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -80,6 +171,29 @@ class LoraxTemplateTestCase(unittest.TestCase):
                                     ['installpkg', 'foo-one', 'foo-two'],
                                     ['run_pkg_transaction']])
 
+    def test_parse_cache(self):
+        """Test that edited templates are not served from the cache"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            tmpl_path = joinpaths(tmpdir, "cache-test.tmpl")
+            with open(tmpl_path, "w") as f:
+                f.write("installpkg ${pkg}-{one,two}\n")
+
+            cachedir = joinpaths(tmpdir, "cache")
+            templates = LoraxTemplate([tmpdir], module_directory=cachedir)
+            self.assertEqual(templates.parse("cache-test.tmpl", {"pkg": "foo"}),
+                             [["installpkg", "foo-one", "foo-two"]])
+            self.assertEqual(templates.parse("cache-test.tmpl", {"pkg": "bar"}),
+                             [["installpkg", "bar-one", "bar-two"]])
+            self.assertTrue(len(os.listdir(cachedir)) > 0)
+
+            # Change the template and make sure its mtime is newer
+            with open(tmpl_path, "w") as f:
+                f.write("removepkg ${pkg}\n")
+            st = os.stat(tmpl_path)
+            os.utime(tmpl_path, (st.st_atime + 10, st.st_mtime + 10))
+            self.assertEqual(templates.parse("cache-test.tmpl", {"pkg": "foo"}),
+                             [["removepkg", "foo"]])
+
 @contextmanager
 def in_tempdir(prefix='tmp'):
     """Execute a block of code with chdir in a temporary location"""
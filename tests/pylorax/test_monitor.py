@@ -1,8 +1,10 @@
+import os
 import socket
+import tempfile
 import time
 import unittest
 
-from pylorax.monitor import LogMonitor
+from pylorax.monitor import LogMonitor, LogRequestHandler, ErrorMatcher, load_error_rules
 
 class LogMonitorTest(unittest.TestCase):
     def test_monitor(self):
@@ -85,3 +87,130 @@ class LogMonitorTest(unittest.TestCase):
                 self.assertEqual(monitor.server.error_line, "Traceback (Not a real traceback)")
         finally:
             monitor.shutdown()
+
+    def test_monitor_channels(self):
+        """Test logging from several connections at the same time"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            log_path = os.path.join(tmpdir, "virt-install.log")
+            monitor = LogMonitor(log_path, timeout=1)
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as a, \
+                     socket.socket(socket.AF_INET, socket.SOCK_STREAM) as b:
+                    a.connect((monitor.host, monitor.port))
+                    b.connect((monitor.host, monitor.port))
+                    a.sendall(b"anaconda line one\nanaconda line ")
+                    b.sendall(b"program line one\n")
+                    a.sendall(b"two\n")
+                    time.sleep(1)
+                    self.assertFalse(monitor.server.log_check())
+                    b.sendall(b"Traceback (Not a real traceback)\n")
+                    time.sleep(1)
+                    self.assertTrue(monitor.server.log_check())
+
+                    metrics = monitor.metrics()
+                    self.assertEqual(metrics.channels, 2)
+                    self.assertEqual(metrics.lines, 4)
+                    self.assertEqual(metrics.error_line, "Traceback (Not a real traceback)")
+            finally:
+                monitor.shutdown()
+
+            with open(log_path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(sorted(lines), ["Traceback (Not a real traceback)", "anaconda line one",
+                                             "anaconda line two", "program line one"])
+
+    def test_monitor_unterminated(self):
+        """Test an error on the last line of a channel without a newline"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            log_path = os.path.join(tmpdir, "virt-install.log")
+            monitor = LogMonitor(log_path, timeout=1)
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.connect((monitor.host, monitor.port))
+                    s.sendall(b"line1\nTraceback (Not a real traceback)")
+                time.sleep(1)
+                self.assertTrue(monitor.server.log_check())
+                self.assertEqual(monitor.server.error_line, "Traceback (Not a real traceback)")
+                self.assertEqual(monitor.metrics().lines, 2)
+            finally:
+                monitor.shutdown()
+
+            with open(log_path) as f:
+                self.assertEqual(f.read(), "line1\nTraceback (Not a real traceback)\n")
+
+    def test_monitor_iserror(self):
+        """Test a handler that checks each line itself"""
+        class LineHandler(LogRequestHandler):
+            def iserror(self, line):
+                if line.startswith("FATAL"):
+                    self.error("FATAL", line)
+
+        monitor = LogMonitor(timeout=1, log_request_handler_class=LineHandler)
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.connect((monitor.host, monitor.port))
+                s.sendall(b"Traceback (Not checked by this handler)\n")
+                time.sleep(1)
+                self.assertFalse(monitor.server.log_check())
+                s.sendall(b"FATAL: a real failure\n")
+                time.sleep(1)
+                self.assertTrue(monitor.server.log_check())
+                self.assertEqual(monitor.server.error_line, "FATAL: a real failure")
+        finally:
+            monitor.shutdown()
+
+        # Opting out of the per line checks uses the error rules
+        LineHandler.check_each_line = False
+        monitor = LogMonitor(timeout=1, log_request_handler_class=LineHandler)
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.connect((monitor.host, monitor.port))
+                s.sendall(b"FATAL: not an error rule\n")
+                time.sleep(1)
+                self.assertFalse(monitor.server.log_check())
+                s.sendall(b"Traceback (Not a real traceback)\n")
+                time.sleep(1)
+                self.assertTrue(monitor.server.log_check())
+        finally:
+            monitor.shutdown()
+
+    def test_error_matcher(self):
+        """Test checking lines and blocks of lines with the default rules"""
+        matcher = ErrorMatcher(LogRequestHandler.simple_tests, LogRequestHandler.re_tests)
+        self.assertEqual(matcher.search("Traceback (most recent call last):"), "Traceback (")
+        self.assertEqual(matcher.search("anaconda:packaging: foo requires bar"), r"packaging: .* requires .*")
+        self.assertEqual(matcher.search("IGNORED: Traceback (most recent call last):"), None)
+        self.assertEqual(matcher.search("packaging: base repo (CDROM/file:///mnt) not valid"), None)
+
+        text = "\n".join(["Just a line",
+                          "Process 1234 (anaconda) of user 0 dumped core",
+                          "IGNORED: Call Trace:",
+                          "packaging: foo requires bar and Out of memory: too",
+                          "last line without a Traceback (newline"])
+        self.assertEqual(matcher.scan(text),
+                         [(r"Process [0-9]+ \(anaconda\) of user [0-9]+ dumped core",
+                           "Process 1234 (anaconda) of user 0 dumped core"),
+                          # The substrings are checked first, like search does
+                          ("Out of memory:", "packaging: foo requires bar and Out of memory: too"),
+                          ("Traceback (", "last line without a Traceback (newline")])
+        for line in text.split("\n"):
+            self.assertEqual(matcher.search(line), dict((l, r) for r, l in matcher.scan(text)).get(line))
+
+    def test_error_rules(self):
+        """Test adding rules from a file"""
+        with tempfile.NamedTemporaryFile("w", prefix="lorax.test.rules.") as rules:
+            rules.write("# A comment\nkernel panic\nre:dracut-[a-z]+: FATAL\n\n")
+            rules.flush()
+            self.assertEqual(load_error_rules(rules.name), (["kernel panic"], ["dracut-[a-z]+: FATAL"]))
+
+            monitor = LogMonitor(timeout=1, error_rules=rules.name)
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.connect((monitor.host, monitor.port))
+                    s.sendall(b"Just a test string\ndracut-initqueue: FATAL: no root\n")
+                    time.sleep(1)
+                    self.assertTrue(monitor.server.log_check())
+                    self.assertEqual(monitor.server.error_line, "dracut-initqueue: FATAL: no root")
+                    self.assertEqual(monitor.metrics().error_rule, "dracut-[a-z]+: FATAL")
+            finally:
+                monitor.shutdown()
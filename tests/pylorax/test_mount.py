@@ -21,6 +21,26 @@ def mktestiso(rootdir, volid):
                 "-graft-points", "/=%s" % joinpaths(rootdir, "sysroot")]
     subprocess.check_call(make_iso)
 
+class IsoReaderMountpointTest(unittest.TestCase):
+    def test_no_mount(self):
+        """Test reading the iso without mounting it"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            mktestiso(work_dir, "Fedora-test-iso-x86_64")
+
+            iso = IsoMountpoint(joinpaths(work_dir, "test.iso"))
+            self.addCleanup(iso.umount)
+            self.assertFalse(iso.mounted)
+            self.assertIsNone(iso.repo)
+            self.assertTrue(iso.stage2)
+            self.assertEqual(iso.label, "Fedora-test-iso-x86_64")
+            with open(iso.kernel) as f:
+                self.assertEqual(f.read(), "I AM FAKE FILE /IMAGES/PXEBOOT/VMLINUZ")
+            with open(iso.initrd) as f:
+                self.assertEqual(f.read(), "I AM FAKE FILE /IMAGES/PXEBOOT/INITRD.IMG")
+
+            iso.umount()
+            self.assertFalse(os.path.exists(iso.kernel))
+
 @unittest.skipUnless(os.geteuid() == 0 and not os.path.exists("/.in-container"), "requires root privileges, and no containers")
 class IsoMountpointTest(unittest.TestCase):
     def test_volid(self):
@@ -0,0 +1,97 @@
+#
+# Copyright (C) 2026 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import tempfile
+import time
+import unittest
+
+from pylorax.pkgcache import PackageCache
+from pylorax.sysutils import joinpaths
+
+class FakeChecksum(object):
+    def __init__(self, value):
+        self.value = value
+
+    def get_checksum(self):
+        return self.value
+
+    def get_type_str(self):
+        return "sha256"
+
+class FakePackage(object):
+    """Just enough of libdnf5.rpm.Package for PackageCache"""
+    def __init__(self, name, checksum, dnfcache):
+        self.name = name
+        self.checksum = checksum
+        self.path = joinpaths(dnfcache, "packages", name + ".rpm")
+
+    def get_checksum(self):
+        return FakeChecksum(self.checksum)
+
+    def get_package_path(self):
+        return self.path
+
+    def get_download_size(self):
+        return 1024
+
+    def download(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 1024)
+
+class PackageCacheTest(unittest.TestCase):
+    def test_hit_miss(self):
+        """Test storing and reusing packages"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            store = joinpaths(tmpdir, "store")
+            pkgs = [FakePackage("pkg-%d" % i, "%064x" % i, joinpaths(tmpdir, "dnf.1")) for i in range(3)]
+
+            cache = PackageCache(store)
+            cache.link_packages(pkgs)
+            self.assertEqual((cache.hits, cache.misses), (0, 3))
+            for p in pkgs:
+                p.download()
+            cache.store_packages()
+
+            # A second build finds them all in the store, hard linked into its dnf cache
+            pkgs = [FakePackage("pkg-%d" % i, "%064x" % i, joinpaths(tmpdir, "dnf.2")) for i in range(3)]
+            cache = PackageCache(store)
+            cache.link_packages(pkgs)
+            self.assertEqual((cache.hits, cache.misses), (3, 0))
+            for p in pkgs:
+                self.assertTrue(os.path.exists(p.path))
+                self.assertEqual(os.stat(p.path).st_nlink, 3)
+
+    def test_evict(self):
+        """Test removing the least recently used packages"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            store = joinpaths(tmpdir, "store")
+            pkgs = [FakePackage("pkg-%d" % i, "%064x" % i, joinpaths(tmpdir, "dnf")) for i in range(4)]
+            cache = PackageCache(store)
+            cache.link_packages(pkgs)
+            for p in pkgs:
+                p.download()
+            cache.store_packages()
+
+            # Make pkg-0 the most recently used
+            now = time.time()
+            for i, p in enumerate(pkgs):
+                os.utime(cache._path(cache._checksum(p)), (now - i, now - i))
+            cache.size = 2048
+            cache.evict()
+            remaining = [p.name for p in pkgs if os.path.exists(cache._path(cache._checksum(p)))]
+            self.assertEqual(remaining, ["pkg-0", "pkg-1"])
@@ -20,7 +20,8 @@ import tempfile
 import os
 
 from pylorax.executils import execWithRedirect
-from pylorax.sysutils import joinpaths, touch, replace, chown_, chmod_, remove, linktree
+from pylorax.sysutils import joinpaths, touch, replace, chown_, chmod_, remove, linktree, copy_tree
+from pylorax.sysutils import clone_file, copy_into
 from pylorax.sysutils import safe_joinpaths, _read_file_end
 
 class SysUtilsTest(unittest.TestCase):
@@ -114,6 +115,86 @@ class SysUtilsTest(unittest.TestCase):
             linktree(os.path.join(tdname, "one"), os.path.join(tdname, "copy"))
 
             self.assertTrue(os.path.exists(os.path.join(tdname, "copy", "two", "three", "lorax-link-test-file")))
+            self.assertEqual(os.stat(os.path.join(tdname, "copy", "two", "three", "lorax-link-test-file")).st_nlink, 2)
+
+    def test_copy_tree(self):
+        """Test copying a tree with hard links, symlinks, sparse and large files"""
+        with tempfile.TemporaryDirectory() as tdname:
+            src = os.path.join(tdname, "src")
+            os.makedirs(os.path.join(src, "sub"))
+            with open(os.path.join(src, "sub", "file"), "w") as f:
+                f.write("test was here")
+            os.chmod(os.path.join(src, "sub", "file"), 0o640)
+            os.link(os.path.join(src, "sub", "file"), os.path.join(src, "hardlink"))
+            os.symlink("sub/file", os.path.join(src, "symlink"))
+            with open(os.path.join(src, "sparse"), "wb") as f:
+                f.truncate(8 * 1024**2)
+                f.seek(4 * 1024**2)
+                f.write(b"data in the middle")
+            with open(os.path.join(src, "large"), "wb") as f:
+                f.write(os.urandom(1024**2))
+            # A large file with a link that is copied before it
+            os.link(os.path.join(src, "large"), os.path.join(src, "sub", "large-link"))
+            os.utime(os.path.join(src, "sub"), (1000000000, 1000000000))
+
+            dst = os.path.join(tdname, "dst")
+            copy_tree(src, dst, large_file=1024**2)
+            for name in ["sub/file", "hardlink", "sparse", "large"]:
+                with open(os.path.join(src, name), "rb") as a, open(os.path.join(dst, name), "rb") as b:
+                    self.assertEqual(a.read(), b.read())
+            self.assertEqual(os.stat(os.path.join(dst, "sub", "file")).st_ino,
+                             os.stat(os.path.join(dst, "hardlink")).st_ino)
+            self.assertEqual(os.stat(os.path.join(dst, "large")).st_ino,
+                             os.stat(os.path.join(dst, "sub", "large-link")).st_ino)
+            self.assertEqual(os.readlink(os.path.join(dst, "symlink")), "sub/file")
+            self.assertEqual(os.stat(os.path.join(dst, "sub", "file")).st_mode & 0o777, 0o640)
+            self.assertEqual(os.stat(os.path.join(dst, "sub")).st_mtime, 1000000000)
+            self.assertLess(os.stat(os.path.join(dst, "sparse")).st_blocks * 512, 8 * 1024**2)
+
+            # Without preserving, symlinks are followed and hard links are copied
+            dst = os.path.join(tdname, "follow")
+            copy_tree(src, dst, preserve=False)
+            self.assertFalse(os.path.islink(os.path.join(dst, "symlink")))
+            with open(os.path.join(dst, "symlink"), "r") as f:
+                self.assertEqual(f.read(), "test was here")
+            self.assertNotEqual(os.stat(os.path.join(dst, "sub", "file")).st_ino,
+                                os.stat(os.path.join(dst, "hardlink")).st_ino)
+
+    def test_clone_file(self):
+        """Test cloning a sparse file"""
+        with tempfile.TemporaryDirectory() as tdname:
+            src = os.path.join(tdname, "disk.img")
+            with open(src, "wb") as f:
+                f.truncate(8 * 1024**2)
+                f.seek(4 * 1024**2)
+                f.write(b"data in the middle")
+            dst = os.path.join(tdname, "snapshot.img")
+            clone_file(src, dst)
+            with open(src, "rb") as a, open(dst, "rb") as b:
+                self.assertEqual(a.read(), b.read())
+            self.assertLess(os.stat(dst).st_blocks * 512, 8 * 1024**2)
+
+            # Writing to the clone leaves the original alone
+            with open(dst, "r+b") as f:
+                f.write(b"changed")
+            with open(src, "rb") as f:
+                self.assertEqual(f.read(7), bytes(7))
+
+    def test_copy_into(self):
+        """Test copying a file into part of another file"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as work_dir:
+            src = os.path.join(work_dir, "src")
+            with open(src, "wb") as f:
+                f.write(b"lorax" * 1000)
+            with open(os.path.join(work_dir, "image"), "w+b") as f:
+                f.truncate(16384)
+                copy_into(src, f.fileno(), 4096, 5000)
+                self.assertEqual(f.read(4096), bytes(4096))
+                self.assertEqual(f.read(5000), b"lorax" * 1000)
+                self.assertEqual(f.read(), bytes(16384 - 4096 - 5000))
+
+                with self.assertRaises(RuntimeError):
+                    copy_into(src, f.fileno(), 0, 6000)
 
     def _generate_lines(self, unicode=False):
         # helper to generate several KiB of lines of text
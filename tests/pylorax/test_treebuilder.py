@@ -15,9 +15,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from contextlib import contextmanager
+import gzip
+import json
+import lzma
 import os
 from rpmfluff import SimpleRpmBuild, SourceFile, expectedArch
 import shutil
+import struct
 import tempfile
 import unittest
 
@@ -26,6 +30,7 @@ from pylorax.dnfbase import get_dnf_base_object
 from pylorax.executils import execWithRedirect
 from pylorax.sysutils import joinpaths
 from pylorax.treebuilder import RuntimeBuilder, findkernels, _write_modinfo
+from pylorax.treebuilder import generate_module_info, module_description
 
 # TODO Put these into a common test library location
 @contextmanager
@@ -192,7 +197,84 @@ class FindkernelsTestCase(unittest.TestCase):
                               "7.0.1-100.fc43.x86_64",
                               "7.0.1-101.fc43.x86_64"], kernel_versions)
 
+def make_fake_module(modinfo):
+    """Return a 64 bit ELF file with a .modinfo section and no code
+
+    :param modinfo: The modinfo fields
+    :type modinfo: list of str
+    """
+    modinfo = b"".join(f.encode("utf-8") + b"\0" for f in modinfo)
+    shstrtab = b"\0.modinfo\0.shstrtab\0"
+    shoff = 64 + len(modinfo) + len(shstrtab)
+    data = b"\x7fELF\x02\x01\x01" + b"\0" * 9
+    data += struct.pack("<HHIQQQIHHHHHH", 1, 62, 1, 0, 0, shoff, 0, 64, 0, 0, 64, 3, 2)
+    data += modinfo + shstrtab
+    data += b"\0" * 64
+    data += struct.pack("<IIQQQQIIQQ", 1, 1, 0, 0, 64, len(modinfo), 0, 0, 1, 0)
+    data += struct.pack("<IIQQQQIIQQ", 10, 3, 0, 0, 64 + len(modinfo), len(shstrtab), 0, 0, 1, 0)
+    return data
+
 class ModInfoTestCase(unittest.TestCase):
+    def test_module_description(self):
+        """Test reading the description from a module"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as tmpdir:
+            with open(joinpaths(tmpdir, "foo.ko"), "wb") as f:
+                f.write(make_fake_module(["license=GPL", "description=Foo SCSI driver"]))
+            with open(joinpaths(tmpdir, "bar.ko.xz"), "wb") as f:
+                f.write(lzma.compress(make_fake_module(["license=GPL"]), check=lzma.CHECK_CRC32))
+
+            self.assertEqual(module_description(joinpaths(tmpdir, "foo.ko")), "Foo SCSI driver")
+            self.assertEqual(module_description(joinpaths(tmpdir, "bar.ko.xz")), "")
+
+    def test_module_info_corrupt(self):
+        """Test that corrupt compressed modules get an empty description"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as moddir:
+            os.makedirs(joinpaths(moddir, "kernel/drivers/scsi"))
+            data = gzip.compress(make_fake_module(["description=Foo SCSI driver"]))
+            with open(joinpaths(moddir, "kernel/drivers/scsi/foo.ko.gz"), "wb") as f:
+                f.write(data[:len(data)//2])
+            with open(joinpaths(moddir, "kernel/drivers/scsi/bar.ko.gz"), "wb") as f:
+                f.write(data[:10] + b"\xff" * (len(data)-10))
+            with open(joinpaths(moddir, "modules.block"), "w") as f:
+                f.write("foo.ko.gz\nbar.ko.gz\n")
+            with open(joinpaths(moddir, "modules.networking"), "w") as f:
+                f.write("")
+
+            generate_module_info(moddir)
+            with open(joinpaths(moddir, "module-info"), "r", encoding="UTF-8") as f:
+                self.assertEqual(f.read(), 'Version 0\nbar.ko\n\tscsi\n\t"bar.ko driver"\n'
+                                           'foo.ko\n\tscsi\n\t"foo.ko driver"\n')
+
+    def test_generate_module_info(self):
+        """Test generating module-info with a cache"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as moddir:
+            os.makedirs(joinpaths(moddir, "kernel/drivers/scsi"))
+            os.makedirs(joinpaths(moddir, "kernel/drivers/net"))
+            with open(joinpaths(moddir, "kernel/drivers/scsi/foo.ko.xz"), "wb") as f:
+                f.write(lzma.compress(make_fake_module(["description=Foo SCSI driver"]), check=lzma.CHECK_CRC32))
+            with open(joinpaths(moddir, "kernel/drivers/net/bar.ko"), "wb") as f:
+                f.write(make_fake_module(["license=GPL"]))
+            with open(joinpaths(moddir, "modules.block"), "w") as f:
+                f.write("foo.ko.xz\n")
+            with open(joinpaths(moddir, "modules.networking"), "w") as f:
+                f.write("bar.ko\n")
+
+            cachefile = joinpaths(moddir, "modinfo.cache")
+            generate_module_info(moddir, cachefile=cachefile)
+            with open(joinpaths(moddir, "module-info"), "r", encoding="UTF-8") as f:
+                self.assertEqual(f.read(), 'Version 0\nbar\n\teth\n\t"bar driver"\n'
+                                           'foo.ko\n\tscsi\n\t"Foo SCSI driver"\n')
+
+            # The cached descriptions are used when the module hasn't changed
+            with open(cachefile, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            self.assertEqual(sorted(cache.values()), ["", "Foo SCSI driver"])
+            with open(cachefile, "w", encoding="utf-8") as f:
+                json.dump({k: v and "Cached driver" for k, v in cache.items()}, f)
+            generate_module_info(moddir, cachefile=cachefile)
+            with open(joinpaths(moddir, "module-info"), "r", encoding="UTF-8") as f:
+                self.assertTrue('"Cached driver"' in f.read())
+
     def test_write_modinfo(self):
         modinfo = [{"name": "foo", "type": "scsi", "desc": "foo driver"}]
 